@@ -99,12 +99,7 @@ class Bind9MasterDomainBackend(ServiceController):
     
     def commit(self):
         """ reload bind if needed """
-        self.append(textwrap.dedent("""
-            # Apply changes
-            if [[ $UPDATED == 1 ]]; then
-                service bind9 reload
-            fi""")
-        )
+        self.reload('bind9', 'service bind9 reload', condition='$UPDATED == 1')
     
     def get_servers(self, domain, backend):
         """ Get related server IPs from registered backend routes """
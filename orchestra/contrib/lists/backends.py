@@ -55,13 +55,8 @@ class MailmanVirtualDomainBackend(ServiceController):
         self.include_virtual_alias_domain(context)
     
     def commit(self):
-        context = self.get_context_files()
-        self.append(textwrap.dedent("""
-            # Apply changes if needed
-            if [[ $UPDATED_VIRTUAL_ALIAS_DOMAINS == 1 ]]; then
-                service postfix reload
-            fi""") % context
-        )
+        self.reload('postfix', 'service postfix reload',
+            condition='$UPDATED_VIRTUAL_ALIAS_DOMAINS == 1')
         super(MailmanVirtualDomainBackend, self).commit()
     
     def get_context_files(self):
@@ -188,12 +183,11 @@ class MailmanBackend(MailmanVirtualDomainBackend):
             # Apply changes if needed
             if [[ $UPDATED_VIRTUAL_ALIAS == 1 ]]; then
                 postmap %(virtual_alias)s
-            fi
-            if [[ $UPDATED_VIRTUAL_ALIAS_DOMAINS == 1 ]]; then
-                service postfix reload
-            fi
-            exit $exit_code""") % context
+            fi""") % context
         )
+        self.reload('postfix', 'service postfix reload',
+            condition='$UPDATED_VIRTUAL_ALIAS_DOMAINS == 1')
+        self.append('exit $exit_code')
     
     def get_context_files(self):
         return {
@@ -3,14 +3,16 @@ import os
 import re
 import textwrap
 
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
 from orchestra.contrib.orchestration import ServiceController
 from orchestra.contrib.resources import ServiceMonitor
 
 from . import settings
-from .models import Address
+from .models import Address, Mailbox
 
 
 logger = logging.getLogger(__name__)
@@ -53,6 +55,57 @@ class SieveFilteringMixin(object):
         self.append('chown %(user)s:%(group)s %(filtering_path)s' % context)
 
 
+class FullMapMixin(object):
+    """
+    Regenerates whole map files from the database instead of editing them entry by entry.
+    
+    The whole map is sent on every execution and atomically moved in place when its content
+    has changed. Route match expressions are applied to the objects of the maps.
+    """
+    def filter_by_routes(self, queryset):
+        """ objects of queryset matched by the route of this backend on the server """
+        from orchestra.contrib.orchestration.models import Route
+        if self.server is None:
+            return queryset
+        route = Route.objects.filter(backend=self.get_name(), host=self.server, is_active=True)
+        route = route.first()
+        if route is None or route.match.strip() in ('', 'True'):
+            return queryset
+        return queryset.filter(pk__in=[obj.pk for obj in queryset.iterator() if route.matches(obj)])
+    
+    def install_map(self, path, lines, updated_var):
+        """ lines: whole map, tab separated key and value lines """
+        # Same order as LC_ALL=C sort
+        lines = sorted(lines)
+        context = {
+            'path': path,
+            'content': '\n'.join(lines),
+            'updated_var': updated_var,
+        }
+        if lines:
+            self.append(textwrap.dedent("""
+                # Regenerate %(path)s
+                cat << 'EOF_FULL_MAP' > %(path)s.tmp
+                %(content)s
+                EOF_FULL_MAP""") % context
+            )
+        else:
+            self.append("> %(path)s.tmp" % context)
+        self.append(textwrap.dedent("""
+            # Replace %(path)s if its content has changed
+            if ! cmp -s %(path)s.tmp %(path)s; then
+                if [[ -e %(path)s ]]; then
+                    chown --reference=%(path)s %(path)s.tmp
+                    chmod --reference=%(path)s %(path)s.tmp
+                fi
+                mv %(path)s.tmp %(path)s
+                %(updated_var)s=1
+            else
+                rm %(path)s.tmp
+            fi""") % context
+        )
+
+
 class UNIXUserMaildirBackend(SieveFilteringMixin, ServiceController):
     """
     Assumes that all system users on this servers all mail accounts.
@@ -171,15 +224,20 @@ class DovecotPostfixPasswdVirtualUserBackend(SieveFilteringMixin, ServiceControl
         self.set_mailbox(context)
         self.generate_filter(mailbox, context)
     
-    def delete(self, mailbox):
-        context = self.get_context(mailbox)
+    def exclude_mailbox(self, context):
         self.append(textwrap.dedent("""
-            nohup bash -c 'sleep 2 && killall -u %(uid)s -s KILL' &> /dev/null &
-            killall -u %(uid)s || true
             sed -i '/^%(user)s:.*/d' %(passwd_path)s
             sed -i '/^%(user)s@%(mailbox_domain)s\s.*/d' %(virtual_mailbox_maps)s
             UPDATED_VIRTUAL_MAILBOX_MAPS=1""") % context
         )
+    
+    def delete(self, mailbox):
+        context = self.get_context(mailbox)
+        self.append(textwrap.dedent("""
+            nohup bash -c 'sleep 2 && killall -u %(uid)s -s KILL' &> /dev/null &
+            killall -u %(uid)s || true""") % context
+        )
+        self.exclude_mailbox(context)
         if context['deleted_home']:
             self.append("mv %(home)s %(deleted_home)s || exit_code=$?" % context)
         else:
@@ -230,6 +288,72 @@ class DovecotPostfixPasswdVirtualUserBackend(SieveFilteringMixin, ServiceControl
         return context
 
 
+class DovecotPostfixPasswdVirtualUserFullMapBackend(FullMapMixin,
+                                                    DovecotPostfixPasswdVirtualUserBackend):
+    """
+    Same as <tt>DovecotPostfixPasswdVirtualUserBackend</tt> but the passwd file and the virtual
+    mailbox maps are regenerated as a whole, with all the mailboxes of the database matched by
+    the route, on each execution.
+    Suited for servers with many mailboxes, bulk changes and resynchronizations.
+    """
+    verbose_name = _("Dovecot-Postfix virtualuser full map")
+    
+    def set_user(self, context):
+        self.append("mkdir -p %(home)s" % context)
+        self.append("chown %(uid)s:%(gid)s %(home)s" % context)
+    
+    def set_mailbox(self, context):
+        # Regenerated on commit
+        pass
+    
+    def exclude_mailbox(self, context):
+        # Regenerated on commit
+        pass
+    
+    @cached_property
+    def quotas(self):
+        """ {mailbox_id: allocated} and the default allocation, or None without disk resource """
+        from orchestra.contrib.resources.models import Resource, ResourceData
+        ct = ContentType.objects.get_for_model(Mailbox)
+        try:
+            resource = Resource.objects.get(content_type=ct, name='disk', is_active=True)
+        except Resource.DoesNotExist:
+            return None
+        allocations = ResourceData.objects.filter(resource=resource, content_type=ct)
+        return (
+            dict(allocations.values_list('object_id', 'allocated')),
+            resource.default_allocation,
+            resource.unit[0].upper(),
+        )
+    
+    def get_quota(self, mailbox):
+        if self.quotas is None:
+            return ''
+        allocations, default, unit = self.quotas
+        quota = allocations.get(mailbox.pk, default)
+        if quota is None:
+            return ''
+        return 'userdb_quota_rule=*:bytes=%i%s' % (quota, unit)
+    
+    def get_passwd_lines(self, mailboxes):
+        for mailbox in mailboxes:
+            yield self.get_context(mailbox)['passwd']
+    
+    def get_virtual_mailbox_lines(self, mailboxes):
+        domain = settings.MAILBOXES_VIRTUAL_MAILBOX_DEFAULT_DOMAIN
+        for name in mailboxes.values_list('name', flat=True).iterator():
+            yield '%s@%s\tOK' % (name, domain)
+    
+    def commit(self):
+        mailboxes = self.filter_by_routes(Mailbox.objects.all())
+        mailboxes = mailboxes.select_related('account').order_by('name')
+        self.install_map(settings.MAILBOXES_PASSWD_PATH,
+            self.get_passwd_lines(mailboxes.iterator()), 'UPDATED_PASSWD')
+        self.install_map(settings.MAILBOXES_VIRTUAL_MAILBOX_MAPS_PATH,
+            self.get_virtual_mailbox_lines(mailboxes), 'UPDATED_VIRTUAL_MAILBOX_MAPS')
+        super(DovecotPostfixPasswdVirtualUserFullMapBackend, self).commit()
+
+
 class PostfixAddressVirtualDomainBackend(ServiceController):
     """
     Secondary SMTP server without mailboxes in it, only syncs virtual domains.
@@ -283,14 +407,9 @@ class PostfixAddressVirtualDomainBackend(ServiceController):
         return context
     
     def commit(self):
-        context = self.get_context_files()
-        self.append(textwrap.dedent("""
-            [[ $UPDATED_VIRTUAL_ALIAS_DOMAINS == 1 ]] && {
-                service postfix reload
-            }
-            exit $exit_code
-            """) % context
-        )
+        self.reload('postfix', 'service postfix reload',
+            condition='$UPDATED_VIRTUAL_ALIAS_DOMAINS == 1')
+        self.append('exit $exit_code')
     
     def get_context_files(self):
         return {
@@ -370,15 +489,60 @@ class PostfixAddressBackend(PostfixAddressVirtualDomainBackend):
         context = self.get_context_files()
         self.append(textwrap.dedent("""
             # Apply changes if needed
-            [[ $UPDATED_VIRTUAL_ALIAS_DOMAINS == 1 ]] && {
-                service postfix reload
-            }
             [[ $UPDATED_VIRTUAL_ALIAS_MAPS == 1 ]] && {
                 postmap %(virtual_alias_maps)s
-            }
-            exit $exit_code
-            """) % context
+            }""") % context
         )
+        self.reload('postfix', 'service postfix reload',
+            condition='$UPDATED_VIRTUAL_ALIAS_DOMAINS == 1')
+        self.append('exit $exit_code')
+
+
+class PostfixAddressFullMapBackend(FullMapMixin, PostfixAddressBackend):
+    """
+    Same as <tt>PostfixAddressBackend</tt> but the virtual alias domains and maps are regenerated
+    as a whole, with all the addresses of the database matched by the route, on each execution.
+    <tt>postmap</tt> only runs when the content of the maps changes.
+    Suited for servers with many addresses, bulk changes and resynchronizations.
+    """
+    verbose_name = _("Postfix address full map")
+    force_empty_action_execution = True
+    
+    def save(self, address):
+        self.append("# %s entries are updated on commit" % address.email)
+    
+    def delete(self, address):
+        self.save(address)
+    
+    def get_virtual_alias_domains_lines(self, addresses):
+        domain_model = Address._meta.get_field('domain').rel.to
+        local_domain = settings.MAILBOXES_LOCAL_DOMAIN
+        domains = domain_model.objects.filter(addresses__in=addresses).exclude(name=local_domain)
+        for domain in domains.distinct().order_by('name').iterator():
+            if self.is_hosted_domain(domain):
+                yield domain.name
+    
+    def get_virtual_alias_maps_lines(self, addresses):
+        mailboxes = {}
+        through = Address.mailboxes.through.objects.filter(address__in=addresses)
+        through = through.order_by('address_id', 'mailbox__name')
+        for address_id, mailbox in through.values_list('address_id', 'mailbox__name').iterator():
+            mailboxes.setdefault(address_id, []).append(mailbox)
+        addresses = addresses.order_by('domain__name', 'name')
+        addresses = addresses.values_list('id', 'name', 'domain__name', 'forward')
+        for address_id, name, domain, forward in addresses.iterator():
+            destination = mailboxes.get(address_id, []) + forward.split()
+            if destination:
+                yield '%s@%s\t%s' % (name, domain, ' '.join(destination))
+    
+    def commit(self):
+        context = self.get_context_files()
+        addresses = self.filter_by_routes(Address.objects.all())
+        self.install_map(context['virtual_alias_domains'],
+            self.get_virtual_alias_domains_lines(addresses), 'UPDATED_VIRTUAL_ALIAS_DOMAINS')
+        self.install_map(context['virtual_alias_maps'],
+            self.get_virtual_alias_maps_lines(addresses), 'UPDATED_VIRTUAL_ALIAS_MAPS')
+        super(PostfixAddressFullMapBackend, self).commit()
 
 
 class AutoresponseBackend(ServiceController):
@@ -427,6 +591,7 @@ class PostfixMailscannerTraffic(ServiceMonitor):
     """
     A high-performance log parser.
     Reads the mail.log file only once, for all users.
+    Only new log lines are read when <tt>RESOURCES_MONITOR_LOG_OFFSETS_DIR</tt> is set.
     """
     model = 'mailboxes.Mailbox'
     resource = ServiceMonitor.TRAFFIC
@@ -443,6 +608,7 @@ class PostfixMailscannerTraffic(ServiceMonitor):
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
             'mail_logs': str((mail_log, mail_log+'.1')),
         }
+        self.append(self.get_log_reader())
         self.append(textwrap.dedent("""\
             import re
             import sys
@@ -459,6 +625,9 @@ class PostfixMailscannerTraffic(ServiceMonitor):
             maillogs = {mail_logs}
             end_datetime = to_local_timezone('{current_date}')
             end_date = int(end_datetime.strftime('%Y%m%d%H%M%S'))
+            if LogReader.offsets_dir:
+                # Lines read incrementally are accounted even if written after current_date
+                end_date = 99999999999999
             months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
             months = dict((m, '%02d' % n) for n, m in enumerate(months, 1))
             
@@ -484,6 +653,7 @@ class PostfixMailscannerTraffic(ServiceMonitor):
                 global users
                 global delivers
                 global reverse
+                LogReader.last_dates[mailbox] = ini_date
                 ini_date = to_local_timezone(ini_date)
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 users[mailbox] = (ini_date, object_id)
@@ -494,68 +664,67 @@ class PostfixMailscannerTraffic(ServiceMonitor):
                 targets = {{}}
                 counter = {{}}
                 user_regex = re.compile(r'\(Authenticated sender: ([^ ]+)\)')
-                for maillog in maillogs:
-                    try:
-                        with open(maillog, 'r') as maillog:
-                            for line in maillog.readlines():
-                                # Only search for Authenticated sendings
-                                if '(Authenticated sender: ' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        sender = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        month, day, time, __, proc, id = line.split()[:6]
-                                        if inside_period(month, day, time, sender[0]):
-                                            # Add new email
-                                            delivers[id[:-1]] = username
-                                # Look for a MailScanner requeue ID
-                                elif ' Requeue: ' in line:
-                                    id, __, req_id = line.split()[6:9]
-                                    id = id.split('.')[0]
-                                    try:
-                                        username = delivers[id]
-                                    except KeyError:
-                                        pass
-                                    else:
-                                        targets[req_id] = (username, 0)
-                                        reverse[username].add(req_id)
-                                # Look for the mail size and count the number of recipients of each email
+                reader = LogReader(maillogs)
+                for line in reader.readlines(users):
+                    # Only search for Authenticated sendings
+                    if '(Authenticated sender: ' in line:
+                        username = user_regex.search(line).groups()[0]
+                        try:
+                            sender = users[username]
+                        except KeyError:
+                            continue
+                        else:
+                            if not reader.is_new(username):
+                                continue
+                            month, day, time, __, proc, id = line.split()[:6]
+                            if inside_period(month, day, time, sender[0]):
+                                # Add new email
+                                delivers[id[:-1]] = username
+                    # Look for a MailScanner requeue ID
+                    elif ' Requeue: ' in line:
+                        id, __, req_id = line.split()[6:9]
+                        id = id.split('.')[0]
+                        try:
+                            username = delivers[id]
+                        except KeyError:
+                            pass
+                        else:
+                            targets[req_id] = (username, 0)
+                            reverse[username].add(req_id)
+                    # Look for the mail size and count the number of recipients of each email
+                    else:
+                        try:
+                            month, day, time, __, proc, req_id, __, msize = line.split()[:8]
+                        except ValueError:
+                            # not interested in this line
+                            continue
+                        if proc.startswith('postfix/'):
+                            req_id = req_id[:-1]
+                            if msize.startswith('size='):
+                                try:
+                                    target = targets[req_id]
+                                except KeyError:
+                                    pass
+                                else:
+                                    targets[req_id] = (target[0], int(msize[5:-1]))
+                            elif proc.startswith('postfix/smtp'):
+                                try:
+                                    target = targets[req_id]
+                                except KeyError:
+                                    pass
                                 else:
-                                    try:
-                                        month, day, time, __, proc, req_id, __, msize = line.split()[:8]
-                                    except ValueError:
-                                        # not interested in this line
-                                        continue
-                                    if proc.startswith('postfix/'):
-                                        req_id = req_id[:-1]
-                                        if msize.startswith('size='):
-                                            try:
-                                                target = targets[req_id]
-                                            except KeyError:
-                                                pass
-                                            else:
-                                                targets[req_id] = (target[0], int(msize[5:-1]))
-                                        elif proc.startswith('postfix/smtp'):
-                                            try:
-                                                target = targets[req_id]
-                                            except KeyError:
-                                                pass
-                                            else:
-                                                if inside_period(month, day, time, users[target[0]][0]):
-                                                    try:
-                                                        counter[req_id] += 1
-                                                    except KeyError:
-                                                        counter[req_id] = 1
-                    except IOError as e:
-                        sys.stderr.write(str(e)+'\\n')
-                    
+                                    if inside_period(month, day, time, users[target[0]][0]):
+                                        try:
+                                            counter[req_id] += 1
+                                        except KeyError:
+                                            counter[req_id] = 1
+                
                 for username, opts in users.iteritems():
                     size = 0
                     for req_id in reverse[username]:
                         size += targets[req_id][1] * counter.get(req_id, 0)
                     print opts[1], size
+                reader.save()
             """).format(**context)
         )
     
@@ -0,0 +1,43 @@
+from orchestra.contrib.orchestration.models import Route, Server
+from orchestra.utils.python import AttrDict
+from orchestra.utils.tests import BaseTestCase
+
+from ..backends import PostfixAddressFullMapBackend
+
+
+class PostfixAddressFullMapBackendTests(BaseTestCase):
+    def get_address(self, name, domain):
+        return AttrDict(name=name, email='%s@%s' % (name, domain), domain=AttrDict(name=domain))
+    
+    def get_script(self, backend):
+        return '\n'.join(cmd for method, cmds in backend.scripts for cmd in cmds)
+    
+    def test_save_generates_script(self):
+        backend = PostfixAddressFullMapBackend()
+        backend.prepare()
+        backend.save(self.get_address('info', 'example.com'))
+        self.assertTrue(backend.has_to_run())
+        self.assertIn('info@example.com', self.get_script(backend))
+    
+    def test_whole_map_is_sent(self):
+        backend = PostfixAddressFullMapBackend()
+        backend.set_tail()
+        lines = ['sales@example.com\tsales', 'info@example.com\tinfo', 'abuse@example.org\tadmin']
+        backend.install_map('/etc/postfix/virtual', lines, 'UPDATED')
+        script = self.get_script(backend)
+        self.assertIn('\n'.join(sorted(lines)), script)
+        self.assertIn('mv /etc/postfix/virtual.tmp /etc/postfix/virtual', script)
+        self.assertNotIn('exit 3', script)
+    
+    def test_route_matches_are_applied(self):
+        server = Server.objects.create(name='mail.example.com')
+        other = Server.objects.create(name='web.example.com')
+        backend = PostfixAddressFullMapBackend(server=server)
+        queryset = Server.objects.all()
+        self.assertEqual(2, backend.filter_by_routes(queryset).count())
+        route = Route.objects.create(backend=backend.get_name(), host=server,
+            match="instance.name == 'web.example.com'")
+        self.assertEqual([other], list(backend.filter_by_routes(queryset)))
+        route.match = 'True'
+        route.save()
+        self.assertEqual(2, backend.filter_by_routes(queryset).count())
@@ -7,7 +7,21 @@ from .backends import ServiceBackend, ServiceController, replace
 default_app_config = 'orchestra.contrib.orchestration.apps.OrchestrationConfig'
 
 
-class Operation():
+class Operation(object):
+    """
+    Compact operation record, identified by (backend, model, pk, action)
+    
+    The instance is referenced, not copied, hence save operations use the last object state:
+    changes made to the instance after collecting the operation, and before generating its
+    script, are part of the script. Collecting the same object twice yields a single operation.
+    Delete operations take a snapshot of the instance before it gets deleted, see
+    preload_context(): manager.collect() preloads the routed ones, create_for_action() all of them.
+    """
+    __slots__ = (
+        'backend', 'model', 'pk', 'action', 'routes', 'route_time', 'digest', '_instance',
+        '_snapshot', '_hash',
+    )
+    
     DELETE = 'delete'
     SAVE = 'save'
     MONITOR = 'monitor'
@@ -22,19 +36,47 @@ class Operation():
     
     def __hash__(self):
         """ set() """
-        return hash((self.backend, self.instance, self.action))
+        return self._hash
     
     def __eq__(self, operation):
         """ set() """
-        return hash(self) == hash(operation)
+        return (isinstance(operation, Operation) and self._hash == operation._hash and
+                self.get_key() == operation.get_key())
     
-    def __init__(self, backend, instance, action, routes=None):
+    def __init__(self, backend, instance, action, routes=None, preload=False):
         self.backend = backend
-        # instance should maintain any dynamic attribute until backend execution
-        # deep copy is prefered over copy otherwise objects will share same atributes (queryset cache)
-        self.instance = copy.deepcopy(instance)
+        # deferred instances have their own dynamically created class
+        self.model = instance._meta.concrete_model
+        self.pk = instance.pk
         self.action = action
         self.routes = routes
+        # seconds spent resolving the routes
+        self.route_time = 0
+        # sha256 of the generated script fragment, see manager.generate_backend()
+        self.digest = None
+        self._instance = instance
+        self._snapshot = None
+        self._hash = hash(self.get_key())
+        if preload:
+            self.preload_context()
+    
+    def get_key(self):
+        return (self.backend, self.model, self.pk, self.action)
+    
+    @property
+    def instance(self):
+        if self._snapshot is not None:
+            return self._snapshot
+        return self._instance
+    
+    def take_snapshot(self):
+        """
+        Django clears the pk of deleted instances, and their related objects are gone.
+        Deep copy is prefered over copy otherwise objects will share same atributes (queryset cache)
+        """
+        if self._snapshot is None:
+            self._snapshot = copy.deepcopy(self._instance)
+        return self._snapshot
     
     @classmethod
     def execute(cls, operations, serialize=False, async=None):
@@ -51,7 +93,7 @@ class Operation():
             backends = ServiceBackend.get_backends(instance=instance, action=action)
             for backend_cls in backends:
                 operations.append(
-                    cls(backend_cls, instance, action)
+                    cls(backend_cls, instance, action, preload=True)
                 )
         return operations
     
@@ -66,8 +108,9 @@ class Operation():
         Heuristic: Running get_context will prevent most of related objects do not exist errors
         """
         if self.action == self.DELETE:
+            snapshot = self.take_snapshot()
             if hasattr(self.backend, 'get_context'):
-                self.backend().get_context(self.instance)
+                self.backend().get_context(snapshot)
     
     def store(self, log):
         from .models import BackendOperation
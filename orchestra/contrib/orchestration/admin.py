@@ -1,4 +1,9 @@
+from datetime import timedelta
+
+from django.conf.urls import url
 from django.contrib import admin, messages
+from django.template.response import TemplateResponse
+from django.utils import timezone
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
@@ -7,7 +12,7 @@ from orchestra.admin import ExtendedModelAdmin
 from orchestra.admin.utils import admin_link, admin_date, admin_colored, display_mono, display_code
 from orchestra.plugins.admin import display_plugin_field
 
-from . import settings, helpers
+from . import settings, helpers, methods, views
 from .backends import ServiceBackend
 from .forms import RouteForm
 from .models import Server, Route, BackendLog, BackendOperation
@@ -140,7 +145,7 @@ class BackendLogAdmin(admin.ModelAdmin):
         'backend', 'server_link', 'state', 'display_script', 'mono_stdout',
         'mono_stderr', 'mono_traceback', 'exit_code', 'task_id', 'display_created',
         'execution_time'
-    )
+    ) + BackendLog.TIMING_FIELDS
     readonly_fields = fields
     
     server_link = admin_link('server')
@@ -156,6 +161,49 @@ class BackendLogAdmin(admin.ModelAdmin):
             'all': ('orchestra/css/pygments/github.css',)
         }
     
+    def get_urls(self):
+        urls = super(BackendLogAdmin, self).get_urls()
+        admin_site = self.admin_site
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            url(r'^timings/$',
+                admin_site.admin_view(self.timings_view),
+                name='%s_%s_timings' % info
+            ),
+            url(r'^metrics/$',
+                admin_site.admin_view(self.metrics_view),
+                name='%s_%s_metrics' % info
+            ),
+        ] + urls
+    
+    def get_timings_queryset(self, request):
+        logs = BackendLog.objects.all()
+        days = request.GET.get('days', '')
+        if days.isdigit():
+            logs = logs.filter(created_at__gte=timezone.now()-timedelta(days=int(days)))
+        return logs
+    
+    def timings_view(self, request):
+        """ average time spent on each execution phase, per backend and per server """
+        opts = self.model._meta
+        logs = self.get_timings_queryset(request)
+        context = {
+            'title': _("Execution timings"),
+            'opts': opts,
+            'app_label': opts.app_label,
+            'phases': [opts.get_field(field).verbose_name for field in BackendLog.TIMING_FIELDS],
+            'backends': helpers.get_timings(logs, 'backend'),
+            'servers': helpers.get_timings(logs, 'server__name'),
+            # Executions running on this process, workers keep their own pool
+            'ssh_pool': methods.paramiko_connections.get_stats(),
+            'days': request.GET.get('days', ''),
+        }
+        return TemplateResponse(request, 'admin/orchestration/backendlog/timings.html', context)
+    
+    def metrics_view(self, request):
+        """ Prometheus text format, scrapers use views.metrics """
+        return views.render_metrics(request)
+    
     def get_queryset(self, request):
         """ Order by structured name and imporve performance """
         qs = super(BackendLogAdmin, self).get_queryset(request)
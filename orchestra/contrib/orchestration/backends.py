@@ -1,3 +1,6 @@
+import hashlib
+import re
+import shlex
 import textwrap
 from functools import partial
 
@@ -7,7 +10,7 @@ from django.utils.translation import ugettext_lazy as _
 
 from orchestra import plugins
 
-from . import methods
+from . import methods, settings
 
 
 def replace(context, pattern, repl):
@@ -19,11 +22,16 @@ def replace(context, pattern, repl):
 
 
 class ServiceMount(plugins.PluginMount):
+    # {model: [(backend, related_field)]}, see ServiceBackend.get_model_index()
+    model_index = None
+    
     def __init__(cls, name, bases, attrs):
         # Make sure backends specify a model attribute
         if not (attrs.get('abstract', False) or name == 'ServiceBackend' or cls.model):
             raise AttributeError("'%s' does not have a defined model attribute." % cls)
         super(ServiceMount, cls).__init__(name, bases, attrs)
+        # Rebuild the model index with the new backend
+        ServiceMount.model_index = None
 
 
 class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
@@ -54,10 +62,18 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
     def __str__(self):
         return type(self).__name__
     
-    def __init__(self):
+    def __init__(self, server=None):
+        # Server the script is generated for, when known
+        self.server = server
         self.head = []
         self.content = []
         self.tail = []
+        # Operations left out of the script because their fragment was already applied
+        self.skipped_operations = []
+        # Services reloaded by the script, see reload()
+        self.reloads = []
+        # Seconds spent generating the script, see manager.generate()
+        self.timings = {}
     
     def __getattribute__(self, attr):
         """ Select head, content or tail section depending on the method name """
@@ -116,6 +132,25 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
                 return related
         return None
     
+    @classmethod
+    def get_model_index(cls):
+        """
+        {model: [(backend, related_field)]} of all the backends, in registration order
+        related_field is None when model is the backend main model
+        """
+        if ServiceMount.model_index is None:
+            index = {}
+            for backend in ServiceBackend.get_backends():
+                index.setdefault(backend.model, []).append((backend, None))
+                models = set([backend.model])
+                for rel_model, field in backend.related_models:
+                    # get_related() only follows the first field of each model
+                    if rel_model not in models:
+                        models.add(rel_model)
+                        index.setdefault(rel_model, []).append((backend, field))
+            ServiceMount.model_index = index
+        return ServiceMount.model_index
+    
     @classmethod
     def get_backends(cls, instance=None, action=None):
         backends = cls.get_plugins()
@@ -145,10 +180,13 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
     @property
     def scripts(self):
         """ group commands based on their method """
-        if not self.content:
-            return []
+        sections = self.content
+        if not sections:
+            if not self.force_empty_action_execution:
+                return []
+            sections = self.head + self.tail
         scripts = {}
-        for method, cmd in self.content:
+        for method, cmd in sections:
             scripts[method] = []
         for method, commands in self.head + self.content + self.tail:
             try:
@@ -162,17 +200,20 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
         time = now.strftime("%h %d, %Y %I:%M:%S %Z")
         return "Generated by Orchestra at %s" % time
     
+    def has_to_run(self):
+        return bool(self.scripts) or (self.force_empty_action_execution or bool(self.content))
+    
     def create_log(self, server, **kwargs):
         from .models import BackendLog
         state = BackendLog.RECEIVED
-        run = bool(self.scripts) or (self.force_empty_action_execution or bool(self.content))
-        if not run:
+        if not self.has_to_run():
             state = BackendLog.NOTHING
         using = kwargs.pop('using', None)
         manager = BackendLog.objects
         if using:
             manager = manager.using(using)
-        log = manager.create(backend=self.get_name(), state=state, server=server)
+        log = manager.create(backend=self.get_name(), state=state, server=server,
+            generate_time=self.timings.get('generate'), route_time=self.timings.get('route'))
         return log
     
     def execute(self, server, async=False, log=None):
@@ -201,9 +242,155 @@ class ServiceBackend(plugins.Plugin, metaclass=ServiceMount):
         else:
             self.cmd_section[-1][1].append(cmd)
     
+    def get_content_mark(self):
+        """ current position of the content section """
+        if not self.content:
+            return (0, 0)
+        return (len(self.content), len(self.content[-1][1]))
+    
+    def get_content_since(self, mark):
+        sections, commands = mark
+        content = []
+        if sections:
+            content.extend(self.content[sections-1][1][commands:])
+        for method, cmds in self.content[sections:]:
+            content.extend(cmds)
+        return content
+    
+    def truncate_content(self, mark):
+        sections, commands = mark
+        del self.content[sections:]
+        if sections:
+            del self.content[sections-1][1][commands:]
+    
+    def get_content_digest(self, mark):
+        """
+        sha256 of the content generated since mark, ignoring banner timestamps
+        None when there is no content or it includes python functions
+        """
+        content = self.get_content_since(mark)
+        if not content or not all(isinstance(cmd, str) for cmd in content):
+            return None
+        content = '\n'.join(content)
+        content = re.sub(r'Generated by Orchestra at [^\n]*', '', content)
+        return hashlib.sha256(content.encode('utf8')).hexdigest()
+    
     def get_context(self, obj):
         return {}
     
+    def reload(self, service, command, condition=None):
+        """
+        reloads service with command at the end of the execution, when condition holds
+        backends running on the same server reload each service once, after all of them have
+        applied their changes, see coordinate_reloads()
+        """
+        if not self.reloads:
+            # Scripts without reload coordination reload right away
+            self.prepend(textwrap.dedent("""\
+                declare -F reload_service > /dev/null || function reload_service () {
+                    eval "$2"
+                }"""))
+        self.reloads.append(service)
+        cmd = 'reload_service %s %s' % (shlex.quote(service), shlex.quote(command))
+        if condition:
+            cmd = textwrap.dedent("""
+                if [[ %s ]]; then
+                    %s
+                fi""") % (condition, cmd)
+        self.append(cmd)
+    
+    def prepend(self, cmd):
+        """ inserts cmd at the beginning of the script """
+        for method, commands in self.head:
+            if method == self.script_method:
+                commands.insert(0, cmd)
+                break
+        else:
+            self.head.insert(0, (self.script_method, [cmd]))
+    
+    def coordinate_reloads(self, batch, participants=1, participant=0):
+        """
+        prepends the reload coordination to the script, the last of the participants of batch
+        to exit runs the requested reloads, rate limited by ORCHESTRATION_RELOAD_INTERVAL
+        participant: index of the backend in the batch, retried executions are counted once
+        
+        The first participant to exit leaves a watchdog that runs the reloads of the batch
+        after ORCHESTRATION_RELOAD_BATCH_TIMEOUT minutes, in case another one never runs.
+        """
+        context = {
+            'spool': settings.ORCHESTRATION_RELOAD_SPOOL_DIR,
+            'batch': batch,
+            'participants': participants,
+            'participant': participant,
+            'interval': settings.ORCHESTRATION_RELOAD_INTERVAL,
+            'timeout': settings.ORCHESTRATION_RELOAD_BATCH_TIMEOUT,
+        }
+        self.prepend(textwrap.dedent("""\
+            # Coordinate service reloads with the other backends of this execution
+            reload_spool=%(spool)s
+            reload_batch="${reload_spool}/%(batch)s"
+            mkdir -p "$reload_batch"
+            function reload_service () {
+                echo "$2" > "${reload_batch}/$1"
+            }
+            function run_reloads () {
+                # Runs the reloads of the given batches, the spool lock is held by the caller
+                local status=0 batch intent service requested last wait code
+                local -A commands requests
+                for batch in "$@"; do
+                    for intent in "$batch"/*; do
+                        [[ -f "$intent" ]] || continue
+                        service=$(basename "$intent")
+                        commands[$service]="$(cat "$intent")"
+                        requested=$(stat -c %%Y "$intent")
+                        [[ ${requests[$service]:-0} -ge $requested ]] || requests[$service]=$requested
+                    done
+                    rm -rf "$batch"
+                done
+                for service in "${!commands[@]}"; do
+                    last=$(cat "${reload_spool}/${service}.last" 2> /dev/null || echo 0)
+                    if [[ $last -gt ${requests[$service]} ]]; then
+                        echo "${service} has already been reloaded by another execution"
+                        continue
+                    fi
+                    wait=$((last + %(interval)s - $(date +%%s)))
+                    [[ $wait -gt 0 ]] && sleep $wait
+                    date +%%s > "${reload_spool}/${service}.last"
+                    echo "Reloading ${service}"
+                    eval "${commands[$service]}" || {
+                        code=$?
+                        [[ $status -eq 0 ]] && status=$code
+                    }
+                done
+                return $status
+            }
+            function reload_services () {
+                local status=$? batches exited code
+                set +e
+                exec 9> "${reload_spool}/.lock"
+                flock 9
+                touch "${reload_batch}/.exited-%(participant)s"
+                # Including the reloads of executions that never completed
+                batches=$(find "$reload_spool" -mindepth 1 -maxdepth 1 -type d -mmin +%(timeout)s)
+                exited=$(find "$reload_batch" -maxdepth 1 -name '.exited-*' | wc -l)
+                if [[ $exited -ge %(participants)s ]]; then
+                    batches="$reload_batch $batches"
+                elif mkdir "${reload_batch}/.watchdog" 2> /dev/null; then
+                    (
+                        sleep $((%(timeout)s*60))
+                        exec 9> "${reload_spool}/.lock"
+                        flock 9
+                        [[ -d "$reload_batch" ]] && run_reloads "$reload_batch"
+                    ) < /dev/null &> /dev/null 9>&- &
+                fi
+                run_reloads $batches
+                code=$?
+                [[ $status -eq 0 ]] && status=$code
+                flock -u 9
+                exit $status
+            }
+            trap reload_services EXIT""") % context)
+    
     def prepare(self):
         """
         hook for executing something at the beging
@@ -154,3 +154,59 @@ def message_user(request, logs):
     else:
         msg = async_msg.format(url=url, async_url=async_url, async=async)
         messages.success(request, mark_safe(msg + '.'))
+
+
+def get_timings(logs, field):
+    """ [(value, executions, [average seconds per phase])] of logs grouped by field """
+    timings = []
+    for row in logs.get_timings(field):
+        averages = []
+        for phase in logs.model.TIMING_FIELDS:
+            count = row[phase + '__count']
+            averages.append(row[phase + '__sum']/count if count else None)
+        timings.append((row[field], row['id__count'], averages))
+    return timings
+
+
+def get_prometheus_metrics(logs, days):
+    """
+    Prometheus text exposition of the execution counts and phase timings of the last days
+    Gauges, since old logs get deleted and the values of a window also go down
+    """
+    def labels(**values):
+        values = ('%s="%s"' % (key, escape_label(value)) for key, value in sorted(values.items()))
+        return '{%s}' % ','.join(values)
+    
+    def escape_label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    
+    executions = [
+        '# HELP orchestra_backend_executions Backend executions by state, last %i days.' % days,
+        '# TYPE orchestra_backend_executions gauge',
+    ]
+    seconds = [
+        '# HELP orchestra_backend_phase_seconds Time spent on each phase of backend executions, '
+            'last %i days.' % days,
+        '# TYPE orchestra_backend_phase_seconds gauge',
+    ]
+    counts = [
+        '# HELP orchestra_backend_phase_executions Executions measured on each phase, '
+            'last %i days.' % days,
+        '# TYPE orchestra_backend_phase_executions gauge',
+    ]
+    phases = {}
+    for row in logs.get_timings('backend', 'server__name', 'state'):
+        backend, server = row['backend'], row['server__name']
+        executions.append('orchestra_backend_executions%s %i' % (
+            labels(backend=backend, server=server, state=row['state']), row['id__count']))
+        for field in logs.model.TIMING_FIELDS:
+            total, count = phases.get((backend, server, field), (0, 0))
+            total += row[field + '__sum'] or 0
+            count += row[field + '__count']
+            phases[(backend, server, field)] = (total, count)
+    for (backend, server, field), (total, count) in sorted(phases.items()):
+        if count:
+            phase_labels = labels(backend=backend, server=server, phase=field[:-len('_time')])
+            seconds.append('orchestra_backend_phase_seconds%s %f' % (phase_labels, total))
+            counts.append('orchestra_backend_phase_executions%s %i' % (phase_labels, count))
+    return '\n'.join(executions + seconds + counts) + '\n'
@@ -75,9 +75,9 @@ class Command(BaseCommand):
                     backend = import_class(backend)
                     operations.add(Operation(backend, instance, action, routes=routes))
         else:
-            for instance in queryset:
-                manager.collect(instance, action, operations=operations, route_cache=route_cache)
-        scripts, serialize = manager.generate(operations)
+            manager.collect_queryset(queryset, action, operations=operations,
+                route_cache=route_cache)
+        scripts, serialize = manager.generate(operations, skip_unchanged=False)
         servers = []
         # Print scripts
         for key, value in scripts.items():
@@ -0,0 +1,222 @@
+import json
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from orchestra.contrib.orchestration import manager, settings, Operation
+from orchestra.contrib.orchestration.backends import ServiceBackend, ServiceController
+from orchestra.contrib.orchestration.models import Route, Server
+from orchestra.utils.apps import isinstalled
+from orchestra.utils.python import OrderedSet, random_ascii
+
+
+class Command(BaseCommand):
+    help = ('Measures the orchestration throughput. Populates accounts with their domains, '
+            'websites and mailboxes, and runs collect, generate and execute for saving and '
+            'deleting them. Scripts are executed on this host by the Local method, '
+            'never on the real servers.')
+    
+    SERVER_NAME = 'orchestration-benchmark'
+    MODELS = (
+        ('accounts.Account', 'pk__in'),
+        ('systemusers.SystemUser', 'account__in'),
+        ('domains.Domain', 'account__in'),
+        ('websites.Website', 'account__in'),
+        ('mailboxes.Mailbox', 'account__in'),
+    )
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--accounts', dest='accounts', type=int, default=10,
+            help='Number of accounts, each one with a domain, a website and a mailbox.')
+        parser.add_argument('--backends', dest='backends', default='',
+            help='Comma separated backends, defaults to the ones with active routes.')
+        parser.add_argument('--run', action='store_true', dest='run', default=False,
+            help='Execute the scripts on the sandbox, they are only parsed (bash -n) otherwise.')
+        parser.add_argument('--sandbox', dest='sandbox', default='',
+            help='Working directory of the executed scripts, a temporary one by default.')
+        parser.add_argument('--trace-memory', action='store_true', dest='trace_memory',
+            default=False, help='Measure the memory peak of each phase, slows down the rest.')
+        parser.add_argument('--json', action='store_true', dest='json', default=False,
+            help='Print the results as JSON.')
+        parser.add_argument('--max-queries', dest='max_queries', type=float, default=0,
+            help='Fail when a phase exceeds this number of queries per operation, for CI.')
+    
+    def handle(self, *args, **options):
+        self.options = options
+        self.results = []
+        # Populated accounts, deleted even if the benchmark fails or is interrupted
+        self.accounts = []
+        server, created = Server.objects.get_or_create(name=self.SERVER_NAME)
+        route_cache = self.get_route_cache(server, options.get('backends'))
+        method = settings.ORCHESTRATION_SSH_METHOD_BACKEND
+        noexec = settings.ORCHESTRATION_LOCAL_NOEXEC
+        sandbox = settings.ORCHESTRATION_LOCAL_SANDBOX_DIR
+        slots_dir = settings.ORCHESTRATION_EXECUTION_SLOTS_DIR
+        settings.ORCHESTRATION_SSH_METHOD_BACKEND = 'orchestra.contrib.orchestration.methods.Local'
+        settings.ORCHESTRATION_LOCAL_NOEXEC = not options.get('run')
+        settings.ORCHESTRATION_LOCAL_SANDBOX_DIR = (
+            options.get('sandbox') or tempfile.mkdtemp(prefix='orchestra-benchmark-'))
+        # Do not compete with the live processes of this host for their execution slots
+        settings.ORCHESTRATION_EXECUTION_SLOTS_DIR = tempfile.mkdtemp(
+            prefix='orchestra-benchmark-slots-')
+        try:
+            accounts = self.measure('populate', self.populate, options.get('accounts'))
+            operations = self.measure('collect save', self.collect, accounts, Operation.SAVE,
+                route_cache)
+            self.run_operations('save', operations)
+            operations = self.measure('collect delete', self.collect, accounts,
+                Operation.DELETE, route_cache)
+            self.delete_accounts()
+            self.run_operations('delete', operations)
+        finally:
+            self.delete_accounts()
+            shutil.rmtree(settings.ORCHESTRATION_EXECUTION_SLOTS_DIR, ignore_errors=True)
+            settings.ORCHESTRATION_SSH_METHOD_BACKEND = method
+            settings.ORCHESTRATION_LOCAL_NOEXEC = noexec
+            settings.ORCHESTRATION_LOCAL_SANDBOX_DIR = sandbox
+            settings.ORCHESTRATION_EXECUTION_SLOTS_DIR = slots_dir
+            if created:
+                # Logs, operations and digests of the benchmark
+                server.delete()
+        self.report()
+    
+    def delete_accounts(self):
+        while self.accounts:
+            self.accounts.pop().delete()
+    
+    def get_route_cache(self, server, backends):
+        """
+        route table of the benchmark server, mirroring the active routes
+        routes are not saved in order to keep the real route table untouched
+        """
+        if backends:
+            routes = [
+                Route(backend=ServiceBackend.get_backend(name).get_name(), match='True')
+                    for name in backends.split(',')
+            ]
+        else:
+            routes = list(Route.objects.filter(is_active=True))
+            if not routes:
+                routes = [
+                    Route(backend=backend.get_name(), match='True')
+                        for backend in ServiceController.get_backends()
+                ]
+        table = {}
+        for pk, route in enumerate(routes, start=1):
+            route = Route(pk=-pk, backend=route.backend, host=server, match=route.match,
+                async=False, async_actions=route.async_actions)
+            for action in route.backend_class.get_actions():
+                table.setdefault((route.backend, action), []).append(route)
+        return table
+    
+    def populate(self, num):
+        Account = apps.get_model('accounts.Account')
+        prefix = 'bench%s' % random_ascii(5)
+        accounts = []
+        for ix in range(num):
+            username = '%s%i' % (prefix, ix)
+            account = Account.objects.create_user(username, password='orchestra',
+                email='%s@orchestra.lan' % username)
+            self.accounts.append(account)
+            if isinstalled('orchestra.contrib.domains'):
+                domain = account.domains.create(name='%s.orchestra.lan' % username)
+            if isinstalled('orchestra.contrib.websites'):
+                website = account.websites.create(name=username)
+                if isinstalled('orchestra.contrib.domains'):
+                    website.domains.add(domain)
+            if isinstalled('orchestra.contrib.mailboxes'):
+                mailbox = account.mailboxes.model(name=username, account=account)
+                mailbox.set_password('orchestra')
+                mailbox.save()
+            accounts.append(account)
+        return accounts
+    
+    def collect(self, accounts, action, route_cache):
+        operations = OrderedSet()
+        for label, lookup in self.MODELS:
+            app_label = label.split('.')[0]
+            if not isinstalled('orchestra.contrib.%s' % app_label):
+                continue
+            model = apps.get_model(label)
+            queryset = model.objects.filter(**{lookup: accounts})
+            manager.collect_queryset(queryset, action, operations=operations,
+                route_cache=route_cache)
+        return operations
+    
+    def run_operations(self, name, operations):
+        scripts, serialize = self.measure('generate %s' % name, manager.generate, operations,
+            skip_unchanged=False, operations=len(operations))
+        logs = self.measure('execute %s' % name, manager.execute, scripts, serialize=serialize,
+            async=False, operations=len(operations))
+        failures = [log for log in logs if not log.is_success]
+        if failures:
+            self.stderr.write('%i of %i %s executions failed: %s' % (
+                len(failures), len(logs), name, ', '.join(map(str, failures))))
+    
+    def measure(self, phase, func, *args, **kwargs):
+        """ runs func, recording its time, queries and memory """
+        operations = kwargs.pop('operations', None)
+        trace_memory = self.options.get('trace_memory')
+        if trace_memory:
+            tracemalloc.start()
+        start = time.time()
+        with CaptureQueriesContext(connection) as queries:
+            result = func(*args, **kwargs)
+        seconds = time.time() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if operations is None:
+            operations = len(result)
+        self.results.append({
+            'phase': phase,
+            'operations': operations,
+            'seconds': seconds,
+            'ops_per_second': operations/seconds if seconds else None,
+            # Queries of this thread, execution threads have their own connections
+            'queries': len(queries),
+            'queries_per_operation': len(queries)/operations if operations else None,
+            'memory_peak': peak,
+        })
+        return result
+    
+    def report(self):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.options.get('json'):
+            self.stdout.write(json.dumps({
+                'phases': self.results,
+                'max_rss': max_rss,
+            }, indent=4))
+        else:
+            line = '%-16s %10s %10s %10s %10s %10s %12s'
+            self.stdout.write(line % (
+                'phase', 'operations', 'seconds', 'ops/s', 'queries', 'queries/op',
+                'memory peak'))
+            for result in self.results:
+                self.stdout.write(line % (
+                    result['phase'],
+                    result['operations'],
+                    '%.3f' % result['seconds'],
+                    '%.1f' % result['ops_per_second'] if result['ops_per_second'] else '-',
+                    result['queries'],
+                    '%.2f' % result['queries_per_operation']
+                        if result['queries_per_operation'] is not None else '-',
+                    '%i KiB' % (result['memory_peak']/1024) if result['memory_peak'] else '-',
+                ))
+            self.stdout.write('max RSS %i KiB' % max_rss)
+        max_queries = self.options.get('max_queries')
+        if max_queries:
+            for result in self.results[1:]:
+                # Population is not part of the orchestration
+                per_operation = result['queries_per_operation']
+                if per_operation and per_operation > max_queries:
+                    raise CommandError("%s exceeds %s queries per operation: %.2f" % (
+                        result['phase'], max_queries, per_operation))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from orchestra.contrib.orchestration import manager
+from orchestra.contrib.orchestration.methods import paramiko_connections
+
+
+class Command(BaseCommand):
+    help = ('Executes the queued orchestration jobs and the coalesced operations, '
+            'run as many workers as needed.')
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', dest='interval', type=float, default=1,
+            help='Seconds between checks for new jobs when the queue is empty.')
+        parser.add_argument('--once', action='store_true', dest='once', default=False,
+            help='Exit when there are no more available jobs.')
+    
+    def handle(self, *args, **options):
+        interval = options.get('interval')
+        while True:
+            manager.flush_coalesced()
+            executed = manager.process_jobs()
+            if executed:
+                self.stdout.write('Executed %i jobs' % executed)
+                if int(options.get('verbosity')) > 1:
+                    stats = paramiko_connections.get_stats()
+                    self.stdout.write('SSH pool: ' + ', '.join(
+                        '%s=%s' % (key, value) for key, value in sorted(stats.items())))
+            elif options.get('once'):
+                return
+            else:
+                time.sleep(interval)
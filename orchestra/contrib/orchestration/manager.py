@@ -1,23 +1,199 @@
+import datetime
+import errno
+import fcntl
+import json
 import logging
+import os
+import socket
 import threading
+import time
 import traceback
-from collections import OrderedDict
+import uuid
+from collections import OrderedDict, deque
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 
+from django.contrib.contenttypes.models import ContentType
 from django.core.mail import mail_admins
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
 
+from orchestra.contrib.tasks import settings as tasks_settings
 from orchestra.utils import db
 from orchestra.utils.python import import_class, OrderedSet
 
 from . import settings, Operation
 from .backends import ServiceBackend
 from .helpers import send_report
-from .models import BackendLog
+from .models import BackendLog, BackendJob, CoalescedOperation, ScriptDigest
 from .signals import pre_action, post_action, pre_commit, post_commit, pre_prepare, post_prepare
 
 
 logger = logging.getLogger(__name__)
 router = import_class(settings.ORCHESTRATION_ROUTER)
 
+# See get_execution_executor() and get_background_executor()
+execution_executor = None
+background_executor = None
+executors_lock = threading.Lock()
+
+
+class ExecutionSlots(object):
+    """
+    Counting semaphore shared by processes, made of one lock file per slot
+    
+    Processes using the same ORCHESTRATION_EXECUTION_SLOTS_DIR share the slots,
+    the locks of dead processes are released by the kernel.
+    """
+    POLL_INTERVAL = 0.2
+    
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+    
+    @classmethod
+    def for_server(cls, server):
+        return cls('server-%i' % server.pk,
+            settings.ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS_PER_SERVER)
+    
+    @classmethod
+    def for_all(cls):
+        return cls('all', settings.ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS)
+    
+    def get_path(self, slot):
+        return os.path.join(settings.ORCHESTRATION_EXECUTION_SLOTS_DIR,
+            '%s-%i.lock' % (self.name, slot))
+    
+    def try_acquire(self):
+        """ returns the locked file descriptor of a free slot, None if all are taken """
+        os.makedirs(settings.ORCHESTRATION_EXECUTION_SLOTS_DIR, exist_ok=True)
+        for slot in range(self.size):
+            fd = os.open(self.get_path(slot), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as exception:
+                os.close(fd)
+                if exception.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            else:
+                return fd
+        return None
+    
+    @staticmethod
+    def release(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    
+    @contextmanager
+    def hold(self):
+        fd = self.try_acquire()
+        while fd is None:
+            time.sleep(self.POLL_INTERVAL)
+            fd = self.try_acquire()
+        try:
+            yield
+        finally:
+            self.release(fd)
+
+
+def limit_concurrency(execute, server, start=None):
+    """
+    Blocks until the server and the host have a free execution slot
+    
+    The per-server slot is acquired first, in order to wait for busy servers
+    without holding a global slot.
+    start: time the backend was queued at, the waiting time is recorded on the log
+    """
+    def wrapper(*args, **kwargs):
+        wait_start = time.time() if start is None else start
+        with ExecutionSlots.for_server(server).hold():
+            with ExecutionSlots.for_all().hold():
+                log = kwargs.get('log')
+                if log is not None:
+                    log.add_time('wait', wait_start)
+                return execute(*args, **kwargs)
+    return wrapper
+
+
+class ExecutionDispatcher(object):
+    """
+    Queues backends per server and submits them to the execution pool once they hold
+    a slot of their server, see get_execution_executor()
+    
+    Pool workers only wait for the global slots, never for a busy server, so backends of
+    other servers are not held back. Finished backends hand over the slot to the next
+    backend of their server, slots taken by other processes are polled with a timer.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.timers = {}
+    
+    def submit(self, server, fn, *args, **kwargs):
+        """ returns a Future of fn(*args, **kwargs), queued on server """
+        future = futures.Future()
+        with self.lock:
+            queue = self.queues.setdefault(server.pk, deque())
+            queue.append((future, fn, args, kwargs, time.time()))
+        self.dispatch(server)
+        return future
+    
+    def dispatch(self, server):
+        """ submits the queued backends of server for as long as it has free slots """
+        slots = ExecutionSlots.for_server(server)
+        with self.lock:
+            queue = self.queues.get(server.pk)
+            while queue:
+                fd = slots.try_acquire()
+                if fd is None:
+                    if server.pk not in self.timers:
+                        timer = threading.Timer(ExecutionSlots.POLL_INTERVAL, self.poll, (server,))
+                        timer.daemon = True
+                        self.timers[server.pk] = timer
+                        timer.start()
+                    return
+                item = queue.popleft()
+                get_execution_executor().submit(self.run, server, fd, *item)
+            self.queues.pop(server.pk, None)
+    
+    def poll(self, server):
+        with self.lock:
+            self.timers.pop(server.pk, None)
+        self.dispatch(server)
+    
+    def run(self, server, fd, future, fn, args, kwargs, start):
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    with ExecutionSlots.for_all().hold():
+                        log = kwargs.get('log')
+                        if log is not None:
+                            log.add_time('wait', start)
+                        result = fn(*args, **kwargs)
+                except BaseException as exception:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+        finally:
+            ExecutionSlots.release(fd)
+            self.dispatch(server)
+
+
+dispatcher = ExecutionDispatcher()
+
+
+def get_execution_executor():
+    """ process-wide pool of ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS workers, lazily created """
+    global execution_executor
+    with executors_lock:
+        if execution_executor is None:
+            execution_executor = ThreadPoolExecutor(
+                max_workers=settings.ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS)
+        return execution_executor
+
 
 def keep_log(execute, log, operations):
     def wrapper(*args, **kwargs):
@@ -39,9 +215,14 @@ def keep_log(execute, log, operations):
             # We don't propagate the exception further to avoid transaction rollback
         finally:
             # Store and log the operation
+            start = time.time()
             for operation in operations:
                 logger.info("Executed %s" % operation)
                 operation.store(log)
+            if log.state == log.SUCCESS and settings.ORCHESTRATION_SKIP_UNCHANGED_OPERATIONS:
+                ScriptDigest.objects.store(log.server, operations)
+            log.add_time('store', start)
+            log.save_timings()
             if not log.is_success:
                 send_report(execute, args, log)
             stdout = log.stdout.strip()
@@ -51,66 +232,222 @@ def keep_log(execute, log, operations):
     return wrapper
 
 
-def generate(operations):
-    scripts = OrderedDict()
+def group(operations):
+    """ groups operations by (route, backend, async_action), in operations order """
+    groups = OrderedDict()
     cache = {}
-    serialize = False
-    # Generate scripts per route+backend
     for operation in operations:
         logger.debug("Queued %s" % operation)
         if operation.routes is None:
+            start = time.time()
             operation.routes = router.objects.get_for_operation(operation, cache=cache)
+            operation.route_time += time.time() - start
         for route in operation.routes:
             # TODO key by action.async
             async_action = route.action_is_async(operation.action)
             key = (route, operation.backend, async_action)
-            if key not in scripts:
-                backend, operations = (operation.backend(), [operation])
-                scripts[key] = (backend, operations)
-                backend.set_head()
-                pre_prepare.send(sender=backend.__class__, backend=backend)
-                backend.prepare()
-                post_prepare.send(sender=backend.__class__, backend=backend)
-            else:
-                scripts[key][1].append(operation)
-            # Get and call backend action method
-            backend = scripts[key][0]
-            method = getattr(backend, operation.action)
-            kwargs = {
-                'sender': backend.__class__,
-                'backend': backend,
-                'instance': operation.instance,
-                'action': operation.action,
-            }
-            backend.set_content()
-            pre_action.send(**kwargs)
-            method(operation.instance)
-            post_action.send(**kwargs)
-            if backend.serialize:
-                serialize = True
-    for value in scripts.values():
-        backend, operations = value
-        backend.set_tail()
-        pre_commit.send(sender=backend.__class__, backend=backend)
-        backend.commit()
-        post_commit.send(sender=backend.__class__, backend=backend)
+            groups.setdefault(key, []).append(operation)
+    return groups
+
+
+def generate_backend(backend_cls, operations, server=None, skip_unchanged=False):
+    """
+    generates the script of a backend for the given operations
+    
+    skip_unchanged: leave out of the script the save operations whose fragment digest is
+    the same than the last one successfully executed on server (backend.skipped_operations)
+    """
+    start = time.time()
+    backend = backend_cls(server=server)
+    # prepare() and commit() only backends do not have per object fragments
+    skip_unchanged = skip_unchanged and server and not backend.force_empty_action_execution
+    if skip_unchanged:
+        digests = ScriptDigest.objects.get_for_operations(backend_cls, server, operations)
+    backend.set_head()
+    pre_prepare.send(sender=backend_cls, backend=backend)
+    backend.prepare()
+    post_prepare.send(sender=backend_cls, backend=backend)
+    for operation in operations:
+        # Get and call backend action method
+        method = getattr(backend, operation.action)
+        kwargs = {
+            'sender': backend_cls,
+            'backend': backend,
+            'instance': operation.instance,
+            'action': operation.action,
+        }
+        backend.set_content()
+        mark = backend.get_content_mark()
+        pre_action.send(**kwargs)
+        method(operation.instance)
+        post_action.send(**kwargs)
+        if operation.action == Operation.SAVE:
+            operation.digest = backend.get_content_digest(mark)
+            if skip_unchanged and operation.digest and operation.digest == digests.get(operation.pk):
+                logger.debug("Skipped unchanged %s" % operation)
+                backend.truncate_content(mark)
+                backend.skipped_operations.append(operation)
+    backend.set_tail()
+    pre_commit.send(sender=backend_cls, backend=backend)
+    backend.commit()
+    post_commit.send(sender=backend_cls, backend=backend)
+    backend.timings['generate'] = time.time() - start
+    return backend
+
+
+def generate_backend_groups(groups, skip_unchanged=False):
+    """ generates groups of (key, operations) sequentially, on its own database connection """
+    try:
+        return [
+            (key, generate_backend(key[1], operations, server=key[0].host,
+                skip_unchanged=skip_unchanged))
+            for key, operations in groups
+        ]
+    finally:
+        connection.close()
+
+
+def generate(operations, threads=None, skip_unchanged=None):
+    """
+    generates the scripts per route+backend, returns them in operations order
+    
+    threads: size of the generation worker pool, defaults to ORCHESTRATION_GENERATE_THREADS
+    Scripts of the same backend are generated by the same worker, one after the other,
+    since backends and signal receivers are not required to be thread safe.
+    Workers have their own database connections and therefore can not see the changes of
+    an ongoing transaction, generation is sequential inside atomic blocks.
+    
+    skip_unchanged: defaults to ORCHESTRATION_SKIP_UNCHANGED_OPERATIONS, see generate_backend()
+    """
+    groups = group(operations)
+    if threads is None:
+        threads = settings.ORCHESTRATION_GENERATE_THREADS
+    if skip_unchanged is None:
+        skip_unchanged = settings.ORCHESTRATION_SKIP_UNCHANGED_OPERATIONS
+    backends = OrderedDict()
+    for key, key_operations in groups.items():
+        backends.setdefault(key[1], []).append((key, key_operations))
+    generated = {}
+    if threads > 1 and len(backends) > 1 and not connection.in_atomic_block:
+        with ThreadPoolExecutor(max_workers=min(threads, len(backends))) as executor:
+            generate_groups = partial(generate_backend_groups, skip_unchanged=skip_unchanged)
+            for results in executor.map(generate_groups, backends.values()):
+                generated.update(results)
+    else:
+        for key, key_operations in groups.items():
+            generated[key] = generate_backend(key[1], key_operations, server=key[0].host,
+                skip_unchanged=skip_unchanged)
+    scripts = OrderedDict()
+    serialize = False
+    for key, key_operations in groups.items():
+        backend = generated[key]
+        backend.timings['route'] = sum(operation.route_time for operation in key_operations)
+        if backend.skipped_operations:
+            skipped = set(map(id, backend.skipped_operations))
+            key_operations = [
+                operation for operation in key_operations if id(operation) not in skipped
+            ]
+        scripts[key] = (backend, key_operations)
+        if backend.serialize:
+            serialize = True
+    coordinate_reloads(scripts)
     return scripts, serialize
 
 
-def execute(scripts, serialize=False, async=None):
+def coordinate_reloads(scripts):
+    """ backends reloading services on the same server share a reload batch """
+    participants = OrderedDict()
+    for (route, __, __), (backend, __) in scripts.items():
+        if backend.reloads and backend.has_to_run():
+            participants.setdefault(route.host_id, []).append(backend)
+    for backends in participants.values():
+        batch = uuid.uuid4().hex
+        for participant, backend in enumerate(backends):
+            backend.coordinate_reloads(batch, participants=len(backends), participant=participant)
+
+
+def get_background_executor():
+    """ process-wide pool of ORCHESTRATION_BACKGROUND_THREADS workers, lazily created """
+    global background_executor
+    with executors_lock:
+        if background_executor is None:
+            background_executor = ThreadPoolExecutor(
+                max_workers=settings.ORCHESTRATION_BACKGROUND_THREADS)
+        return background_executor
+
+
+def generate_and_execute(operations, logs, serialize=False, async=None):
+    """
+    generates and executes or enqueues the operations of the pending logs of
+    generate_in_background(), logs are left in EXCEPTION state on failure
+    """
+    try:
+        scripts, backend_serialize = generate(operations)
+        serialize = serialize or backend_serialize
+        if settings.ORCHESTRATION_QUEUE_EXECUTIONS and not serialize:
+            enqueue(scripts, logs=logs)
+        else:
+            execute(scripts, serialize=serialize, async=async, logs=logs)
+    except Exception:
+        trace = traceback.format_exc()
+        # Logs being executed or waiting for a worker are already taken care of
+        pending = BackendLog.objects.filter(pk__in=[log.pk for log in logs.values()],
+            state=BackendLog.RECEIVED, job__isnull=True)
+        pending.update(state=BackendLog.EXCEPTION, stderr=trace, updated_at=timezone.now())
+        subject = 'EXCEPTION generating backend(s) %s' % list(logs.values())
+        logger.error(subject)
+        logger.error(trace)
+        mail_admins(subject, trace)
+
+
+def generate_in_background(operations, serialize=False, async=None):
+    """
+    returns pending BackendLogs right away, scripts are generated and executed or enqueued
+    by the background pool, see get_background_executor()
+    operations should have been commited to the database
+    """
+    if settings.ORCHESTRATION_DISABLE_EXECUTION:
+        logger.info('Orchestration execution is dissabled by ORCHESTRATION_DISABLE_EXECUTION.')
+        return []
+    groups = group(operations)
+    logs = OrderedDict()
+    for route, backend_cls, async_action in groups.keys():
+        logs[(route, backend_cls, async_action)] = BackendLog.objects.create(
+            backend=backend_cls.get_name(), state=BackendLog.RECEIVED, server=route.host)
+    task = db.close_connection(generate_and_execute)
+    get_background_executor().submit(task, operations, logs, serialize=serialize, async=async)
+    return list(logs.values())
+
+
+def update_log(log, backend):
+    """ completes a log created before generating its backend, see generate_in_background() """
+    log.generate_time = backend.timings.get('generate')
+    log.route_time = backend.timings.get('route')
+    if not backend.has_to_run():
+        log.state = log.NOTHING
+        log.save(update_fields=('state', 'updated_at'))
+
+
+def execute(scripts, serialize=False, async=None, logs=None):
     """
     executes the operations on the servers
     
     serialize: execute one backend at a time
     async: do not join threads (overrides route.async)
+    logs: {key: BackendLog} already created for the scripts, see generate_in_background()
+    
+    Backends run on the execution pool of the process, see get_execution_executor().
+    Concurrency is bounded by ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS and
+    ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS_PER_SERVER, backends are queued per server
+    until it has a free slot, see ExecutionDispatcher.
     """
     if settings.ORCHESTRATION_DISABLE_EXECUTION:
         logger.info('Orchestration execution is dissabled by ORCHESTRATION_DISABLE_EXECUTION.')
         return []
     # Execute scripts on each server
     executions = []
-    threads_to_join = []
-    logs = []
+    to_wait = []
+    execution_logs = []
     for key, value in scripts.items():
         route, __, async_action = key
         backend, operations = value
@@ -122,36 +459,302 @@ def execute(scripts, serialize=False, async=None):
         kwargs = {
             'async': is_async,
         }
-        # we clone the connection just in case we are isolated inside a transaction
-        with db.clone(model=BackendLog) as handle:
-            log = backend.create_log(*args, using=handle.target)
-            log._state.db = handle.origin
+        if logs is not None and key in logs:
+            log = logs[key]
+            update_log(log, backend)
+        else:
+            # we clone the connection just in case we are isolated inside a transaction
+            with db.clone(model=BackendLog) as handle:
+                log = backend.create_log(*args, using=handle.target)
+                log._state.db = handle.origin
         kwargs['log'] = log
+        operations, skipped_log = record_skipped(backend, route, log, operations)
+        if skipped_log:
+            execution_logs.append(skipped_log)
         task = keep_log(backend.execute, log, operations)
         logger.debug('%s is going to be executed on %s.' % (backend, route.host))
         if serialize:
             # Execute one backend at a time, no need for threads
-            task(*args, **kwargs)
+            limit_concurrency(task, route.host)(*args, **kwargs)
         else:
             task = db.close_connection(task)
-            thread = threading.Thread(target=task, args=args, kwargs=kwargs)
-            thread.start()
+            future = dispatcher.submit(route.host, task, *args, **kwargs)
             if not is_async:
-                threads_to_join.append(thread)
-        logs.append(log)
-    [ thread.join() for thread in threads_to_join ]
+                to_wait.append(future)
+        execution_logs.append(log)
+    futures.wait(to_wait)
+    return execution_logs
+
+
+def record_skipped(backend, route, log, operations):
+    """
+    skipped operations are executed along with log when it is NOTHING,
+    otherwise they are recorded on their own NOTHING log
+    """
+    if not backend.skipped_operations:
+        return operations, None
+    if log.state == log.NOTHING:
+        return operations + backend.skipped_operations, None
+    with db.clone(model=BackendLog) as handle:
+        skipped_log = BackendLog.objects.using(handle.target).create(
+            backend=backend.get_name(), state=BackendLog.NOTHING, server=route.host)
+        skipped_log._state.db = handle.origin
+    for operation in backend.skipped_operations:
+        operation.store(skipped_log)
+    return operations, skipped_log
+
+
+def enqueue(scripts, logs=None):
+    """
+    stores the scripts as BackendJobs executed by the orchestration workers
+    scripts with python functions can not be stored and are executed right away
+    logs: {key: BackendLog} already created for the scripts, see generate_in_background()
+    """
+    if settings.ORCHESTRATION_DISABLE_EXECUTION:
+        logger.info('Orchestration execution is dissabled by ORCHESTRATION_DISABLE_EXECUTION.')
+        return []
+    from . import tasks
+    execution_logs = []
+    inline = OrderedDict()
+    queued = False
+    for key, value in scripts.items():
+        route, __, __ = key
+        backend, operations = value
+        job_scripts = BackendJob.dump_scripts(backend)
+        if job_scripts is None:
+            inline[key] = value
+            continue
+        if logs is not None and key in logs:
+            log = logs[key]
+            update_log(log, backend)
+        else:
+            log = backend.create_log(route.host)
+        operations, skipped_log = record_skipped(backend, route, log, operations)
+        if skipped_log:
+            execution_logs.append(skipped_log)
+        start = time.time()
+        for operation in operations:
+            operation.store(log)
+        log.add_time('store', start)
+        log.save_timings()
+        if log.state != log.NOTHING:
+            digests = ''
+            if settings.ORCHESTRATION_SKIP_UNCHANGED_OPERATIONS:
+                digests = json.dumps(ScriptDigest.objects.get_records(operations))
+            BackendJob.objects.create(
+                log=log,
+                backend=backend.get_name(),
+                server=route.host,
+                scripts=job_scripts,
+                digests=digests,
+            )
+            logger.debug('%s has been queued for %s.' % (backend, route.host))
+            queued = True
+        execution_logs.append(log)
+    if inline:
+        execution_logs += execute(inline, logs=logs)
+    if queued and tasks_settings.TASKS_BACKEND == 'celery':
+        # Wake up a worker, periodic processing catches up otherwise.
+        # Thread and process task backends would execute the jobs on this web worker
+        tasks.process_jobs.apply_async()
+    return execution_logs
+
+
+def keep_leased(job, stop):
+    """ renews the lease of job until stop is set, executions may outlast the lease time """
+    duration = settings.ORCHESTRATION_JOB_LEASE_TIME
+    while not stop.wait(duration/3):
+        if not job.renew(duration):
+            logger.warning('Lease of job %s has been lost' % job)
+            break
+
+
+def execute_job(job):
+    """ executes a leased BackendJob, renewing its lease meanwhile, and acknowledges it """
+    backend = ServiceBackend.get_backend(job.backend)()
+    backend.content = job.load_scripts()
+    log = job.log
+    log.state = log.RECEIVED
+    log.stdout = log.stderr = log.traceback = ''
+    log.exit_code = None
+    log.save(update_fields=('state', 'stdout', 'stderr', 'traceback', 'exit_code', 'updated_at'))
+    # Time on the queue, including previous attempts
+    log.wait_time = (timezone.now()-job.created_at).total_seconds()
+    for phase in ('connect', 'send', 'run', 'log'):
+        setattr(log, '%s_time' % phase, None)
+    task = limit_concurrency(backend.execute, job.server)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=db.close_connection(keep_leased), args=(job, stop))
+    heartbeat.daemon = True
+    heartbeat.start()
+    try:
+        task(job.server, async=False, log=log)
+    except Exception:
+        log.state = log.EXCEPTION
+        log.traceback = traceback.format_exc()
+        log.save(update_fields=('state', 'traceback', 'updated_at'))
+        logger.error('EXCEPTION executing job %s' % job)
+        logger.error(log.traceback)
+    finally:
+        stop.set()
+        heartbeat.join()
+    log.save_timings()
+    state = job.ack()
+    logger.info('%s job executed on %s, %s' % (job.backend, job.server, state))
+    if state == job.FAILED:
+        send_report(backend.execute, (job.server,), log)
+    return log
+
+
+def process_jobs(worker=None, limit=None):
+    """ leases and executes available jobs, returns the number of executed jobs """
+    if worker is None:
+        worker = '%s-%i' % (socket.gethostname(), os.getpid())
+    executed = 0
+    while limit is None or executed < limit:
+        job = BackendJob.objects.lease(worker)
+        if job is None:
+            break
+        execute_job(job)
+        executed += 1
+    return executed
+
+
+def get_coalescing_window(backend_cls):
+    windows = settings.ORCHESTRATION_COALESCING_WINDOWS
+    return windows.get(backend_cls.get_name(), settings.ORCHESTRATION_COALESCING_WINDOW)
+
+
+def coalesce(operations):
+    """
+    defers the save operations of backends with a coalescing window, they are merged with the
+    operations of other requests and executed when the window of their (backend, route) closes
+    returns the operations to be executed right away
+    """
+    from . import tasks
+    now = timezone.now()
+    remaining = []
+    deferred = []
+    windows = {}
+    opened = set()
+    for operation in operations:
+        window = get_coalescing_window(operation.backend)
+        if not window or operation.action != Operation.SAVE or not operation.routes:
+            remaining.append(operation)
+            continue
+        backend = operation.backend.get_name()
+        content_type = ContentType.objects.get_for_model(operation.model)
+        for route in operation.routes:
+            key = (backend, route.pk)
+            try:
+                due_at = windows[key]
+            except KeyError:
+                # Join the open window, if any
+                due_at = CoalescedOperation.objects.filter(
+                    backend=backend, route=route, claimed_until__isnull=True)
+                due_at = due_at.order_by('due_at').values_list('due_at', flat=True)
+                due_at = due_at.first()
+                if due_at is None:
+                    due_at = now + datetime.timedelta(seconds=window)
+                    opened.add(window)
+                windows[key] = due_at
+            deferred.append(CoalescedOperation(
+                backend=backend, route=route, action=operation.action,
+                content_type=content_type, object_id=operation.pk, due_at=due_at,
+            ))
+            logger.debug("Coalescing %s on %s until %s" % (operation, route.host, due_at))
+    CoalescedOperation.objects.bulk_create(deferred)
+    if tasks_settings.TASKS_BACKEND == 'celery':
+        # Thread and process task backends have no countdown, the periodic flush catches up
+        for window in opened:
+            tasks.flush_coalesced_operations.apply_async(countdown=window)
+    return remaining
+
+
+def flush_coalesced():
+    """
+    executes the operations of the closed coalescing windows, one script per window
+    
+    Operations are claimed for ORCHESTRATION_JOB_LEASE_TIME seconds and deleted once their
+    executions are logged or queued. Windows failing to be flushed are logged and reported,
+    their operations are released for the next flush, up to ORCHESTRATION_JOB_MAX_ATTEMPTS.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        due = CoalescedOperation.objects.select_for_update().filter(due_at__lte=now)
+        due = due.filter(Q(claimed_until__isnull=True) | Q(claimed_until__lt=now))
+        rows = list(due.select_related('route__host').order_by('id'))
+        claimed_until = now + datetime.timedelta(seconds=settings.ORCHESTRATION_JOB_LEASE_TIME)
+        CoalescedOperation.objects.filter(pk__in=[row.pk for row in rows]).update(
+            claimed_until=claimed_until, attempts=F('attempts')+1)
+    object_ids = {}
+    for row in rows:
+        object_ids.setdefault(row.content_type_id, set()).add(row.object_id)
+    objects = {}
+    for ct_id, ids in object_ids.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        objects[ct_id] = model._default_manager.in_bulk(list(ids))
+    windows = OrderedDict()
+    for row in rows:
+        windows.setdefault((row.backend, row.route), []).append(row)
+    logs = []
+    for (backend, route), window_rows in windows.items():
+        try:
+            logs.extend(flush_window(backend, route, window_rows, objects))
+        except Exception:
+            trace = traceback.format_exc()
+            attempts = max(row.attempts for row in window_rows) + 1
+            log = BackendLog.objects.create(backend=backend, server=route.host,
+                state=BackendLog.EXCEPTION, stderr=trace)
+            logs.append(log)
+            subject = 'EXCEPTION flushing coalesced %s operations on %s, attempt %i' % (
+                backend, route.host, attempts)
+            logger.error(subject)
+            logger.error(trace)
+            mail_admins(subject, trace)
+            window_rows = CoalescedOperation.objects.filter(pk__in=[row.pk for row in window_rows])
+            if attempts < settings.ORCHESTRATION_JOB_MAX_ATTEMPTS:
+                window_rows.update(claimed_until=None)
+            else:
+                window_rows.delete()
+        else:
+            CoalescedOperation.objects.filter(pk__in=[row.pk for row in window_rows]).delete()
     return logs
 
 
+def flush_window(backend, route, rows, objects):
+    """ generates and executes or enqueues the coalesced operations of a (backend, route) """
+    try:
+        backend_cls = ServiceBackend.get_backend(backend)
+    except KeyError:
+        logger.error("%s backend is not available." % backend)
+        return []
+    operations = OrderedSet()
+    for row in rows:
+        instance = objects[row.content_type_id].get(row.object_id)
+        if instance is None:
+            # Deleted in the meantime
+            continue
+        operations.add(Operation(backend_cls, instance, row.action, routes=[route]))
+    if not operations:
+        return []
+    scripts, serialize = generate(list(operations))
+    if settings.ORCHESTRATION_QUEUE_EXECUTIONS and not serialize:
+        return enqueue(scripts)
+    return execute(scripts, serialize=serialize)
+
+
 def collect(instance, action, **kwargs):
     """ collect operations """
     operations = kwargs.get('operations', OrderedSet())
     route_cache = kwargs.get('route_cache', {})
-    for backend_cls in ServiceBackend.get_backends():
+    opts = instance._meta
+    model = '%s.%s' % (opts.app_label, opts.object_name)
+    for backend_cls, related_field in ServiceBackend.get_model_index().get(model, ()):
         # Check if there exists a related instance to be executed for this backend and action
         instances = []
         if action in backend_cls.actions:
-            if backend_cls.is_main(instance):
+            if related_field is None:
                 instances = [(instance, action)]
             else:
                 candidate = backend_cls.get_related(instance)
@@ -196,7 +799,9 @@ def collect(instance, action, **kwargs):
                             continue
             operation = Operation(backend_cls, selected, iaction)
             # Only schedule operations if the router has execution routes
+            start = time.time()
             routes = router.objects.get_for_operation(operation, cache=route_cache)
+            operation.route_time = time.time() - start
             if routes:
                 operation.routes = routes
                 if iaction != Operation.DELETE:
@@ -207,3 +812,27 @@ def collect(instance, action, **kwargs):
                     operation.preload_context()
                 operations.add(operation)
     return operations
+
+
+def collect_queryset(queryset, action, **kwargs):
+    """
+    collect operations of all the objects of a queryset, i.e. after queryset.update()
+    related objects of the backends are prefetched in bulk
+    """
+    kwargs['operations'] = kwargs.get('operations', OrderedSet())
+    kwargs['route_cache'] = kwargs.get('route_cache', {})
+    opts = queryset.model._meta
+    model = '%s.%s' % (opts.app_label, opts.object_name)
+    related_fields = set(
+        field for backend_cls, field in ServiceBackend.get_model_index().get(model, ())
+            if field is not None and action in backend_cls.actions
+    )
+    instances = queryset.prefetch_related(*related_fields)
+    try:
+        instances = list(instances)
+    except (AttributeError, ValueError):
+        # Not all related fields are relations
+        instances = list(queryset)
+    for instance in instances:
+        collect(instance, action, **kwargs)
+    return kwargs['operations']
@@ -1,13 +1,17 @@
 import inspect
 import logging
+import os
+import shlex
 import socket
 import sys
 import select
 import textwrap
+import threading
+import time
 
 from celery.datastructures import ExceptionInfo
 
-from orchestra.utils.sys import sshrun
+from orchestra.utils.sys import run, sshrun
 from orchestra.utils.python import CaptureStdout, import_class
 
 from . import settings
@@ -16,11 +20,173 @@ from . import settings
 logger = logging.getLogger(__name__)
 
 
-def Paramiko(backend, log, server, cmds, async=False, paramiko_connections={}):
+class ParamikoConnectionPool(object):
+    """
+    Process-wide pool of Paramiko connections keyed by server address
+    
+    A single transport is shared by all the backends executed on the same server,
+    each backend opens its own channel on it. Connections are health-checked before
+    being handed out, counted while checked out, and closed after being idle for
+    idle_timeout seconds with no backend using them.
+    """
+    def __init__(self, idle_timeout=None):
+        self.idle_timeout = idle_timeout
+        # {addr: [ssh, last_used, in_use]}, only accessed with self.lock held
+        self.connections = {}
+        self.addr_locks = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.connect_time = 0
+    
+    def get_addr_lock(self, addr):
+        with self.lock:
+            try:
+                return self.addr_locks[addr]
+            except KeyError:
+                lock = threading.Lock()
+                self.addr_locks[addr] = lock
+                return lock
+    
+    def is_alive(self, ssh):
+        transport = ssh.get_transport()
+        return transport is not None and transport.is_active()
+    
+    def connect(self, addr):
+        import paramiko
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        key = settings.ORCHESTRATION_SSH_KEY_PATH
+        start = time.time()
+        try:
+            ssh.connect(addr, username='root', key_filename=key)
+        except:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            connect_time = time.time()-start
+            with self.lock:
+                self.connect_time += connect_time
+        return ssh
+    
+    def get(self, addr):
+        """ checks out a live connection to addr, connecting if needed, see release() """
+        self.expire()
+        # Serializes connecting to the same server, other servers are not blocked
+        with self.get_addr_lock(addr):
+            with self.lock:
+                connection = self.connections.get(addr)
+                # is_alive() only checks the transport state, cheap enough to hold the lock
+                if connection is not None and self.is_alive(connection[0]):
+                    self.hits += 1
+                    connection[1] = time.time()
+                    connection[2] += 1
+                    return connection[0]
+                self.connections.pop(addr, None)
+            if connection is not None:
+                # Backends still holding the dead connection will fail on their own
+                connection[0].close()
+            ssh = self.connect(addr)
+            with self.lock:
+                self.misses += 1
+                self.connections[addr] = [ssh, time.time(), 1]
+            return ssh
+    
+    def release(self, addr, ssh):
+        """ checks in a connection returned by get() """
+        with self.lock:
+            connection = self.connections.get(addr)
+            # A replaced connection is no longer tracked
+            if connection is not None and connection[0] is ssh:
+                connection[1] = time.time()
+                connection[2] -= 1
+    
+    def expire(self):
+        """ closes connections idle for more than idle_timeout seconds and not in use """
+        if not self.idle_timeout:
+            return
+        now = time.time()
+        expired = []
+        with self.lock:
+            for addr, (ssh, last_used, in_use) in list(self.connections.items()):
+                if not in_use and now-last_used > self.idle_timeout:
+                    expired.append((addr, ssh))
+                    del self.connections[addr]
+        for addr, ssh in expired:
+            logger.debug('Closing idle SSH connection to %s' % addr)
+            ssh.close()
+    
+    def get_stats(self):
+        with self.lock:
+            connects = self.misses + self.errors
+            return {
+                'connections': len(self.connections),
+                'in_use': sum(in_use for ssh, last_used, in_use in self.connections.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'avg_connect_time': self.connect_time/connects if connects else 0,
+            }
+
+
+paramiko_connections = ParamikoConnectionPool(
+    idle_timeout=settings.ORCHESTRATION_SSH_POOL_IDLE_TIMEOUT)
+
+
+class LogOutputBuffer(object):
+    """
+    Accumulates the output of async executions and saves it on the backend log when
+    flush_interval seconds have passed or flush_size bytes are pending,
+    instead of rewriting the whole stdout and stderr columns for every chunk received
+    """
+    def __init__(self, log, flush_interval=None, flush_size=None, autoflush=True):
+        self.log = log
+        self.autoflush = autoflush
+        if flush_interval is None:
+            flush_interval = settings.ORCHESTRATION_LOG_FLUSH_INTERVAL
+        if flush_size is None:
+            flush_size = settings.ORCHESTRATION_LOG_FLUSH_SIZE
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.stdout = [log.stdout]
+        self.stderr = [log.stderr]
+        self.pending = 0
+        self.flushed_at = time.time()
+    
+    def write(self, stdout='', stderr=''):
+        if stdout:
+            self.stdout.append(stdout)
+        if stderr:
+            self.stderr.append(stderr)
+        self.pending += len(stdout) + len(stderr)
+        if not self.autoflush:
+            return
+        if self.pending >= self.flush_size or time.time()-self.flushed_at >= self.flush_interval:
+            self.flush()
+    
+    def update_log(self):
+        """ joins pending chunks into the log without hitting the database """
+        self.stdout = [''.join(self.stdout)]
+        self.stderr = [''.join(self.stderr)]
+        self.log.stdout = self.stdout[0]
+        self.log.stderr = self.stderr[0]
+    
+    def flush(self):
+        self.update_log()
+        if self.pending:
+            self.log.save(update_fields=('stdout', 'stderr', 'updated_at'))
+        self.pending = 0
+        self.flushed_at = time.time()
+
+
+def Paramiko(backend, log, server, cmds, async=False):
     """
     Executes cmds to remote server using Pramaiko
+    
+    Connections are reused from the process-wide paramiko_connections pool.
     """
-    import paramiko
     script = '\n'.join(cmds)
     script = script.replace('\r', '')
     log.state = log.STARTED
@@ -30,59 +196,68 @@ def Paramiko(backend, log, server, cmds, async=False, paramiko_connections={}):
         return
     channel = None
     ssh = None
+    output = None
     try:
         addr = server.get_address()
         # ssh connection
-        ssh = paramiko_connections.get(addr)
-        if not ssh:
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            key = settings.ORCHESTRATION_SSH_KEY_PATH
-            try:
-                ssh.connect(addr, username='root', key_filename=key)
-            except socket.error as e:
-                logger.error('%s timed out on %s' % (backend, addr))
-                log.state = log.TIMEOUT
-                log.stderr = str(e)
-                log.save(update_fields=('state', 'stderr', 'updated_at'))
-                return
-            paramiko_connections[addr] = ssh
+        start = time.time()
+        try:
+            ssh = paramiko_connections.get(addr)
+        except socket.error as e:
+            logger.error('%s timed out on %s' % (backend, addr))
+            log.add_time('connect', start)
+            log.state = log.TIMEOUT
+            log.stderr = str(e)
+            log.save(update_fields=('state', 'stderr', 'updated_at'))
+            return
         transport = ssh.get_transport()
         channel = transport.open_session()
+        log.add_time('connect', start)
+        start = time.time()
         channel.exec_command(backend.script_executable)
         channel.sendall(script)
         channel.shutdown_write()
+        log.add_time('send', start)
+        start = time.time()
         # Log results
         logger.debug('%s running on %s' % (backend, server))
         if async:
             second = False
+            output = LogOutputBuffer(log)
             while True:
                 # Non-blocking is the secret ingridient in the async sauce
                 select.select([channel], [], [])
                 if channel.recv_ready():
                     part = channel.recv(1024).decode('utf-8')
                     while part:
-                        log.stdout += part
+                        output.write(stdout=part)
                         part = channel.recv(1024).decode('utf-8')
                 if channel.recv_stderr_ready():
                     part = channel.recv_stderr(1024).decode('utf-8')
                     while part:
-                        log.stderr += part
+                        output.write(stderr=part)
                         part = channel.recv_stderr(1024).decode('utf-8')
-                log.save(update_fields=('stdout', 'stderr', 'updated_at'))
                 if channel.exit_status_ready():
                     if second:
                         break
                     second = True
+            # Final log.save() stores the remaining output
+            output.update_log()
         else:
             log.stdout += channel.makefile('rb', -1).read().decode('utf-8')
             log.stderr += channel.makefile_stderr('rb', -1).read().decode('utf-8')
         
         log.exit_code = channel.recv_exit_status()
+        log.add_time('run', start)
         log.state = log.SUCCESS if log.exit_code == 0 else log.FAILURE
         logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
+        start = time.time()
         log.save()
+        log.add_time('log', start)
     except:
+        if output is not None:
+            # Output received since the last flush is what explains the failure
+            output.update_log()
         log.state = log.ERROR
         log.traceback = ExceptionInfo(sys.exc_info()).traceback
         logger.error('Exception while executing %s on %s' % (backend, server))
@@ -94,11 +269,16 @@ def Paramiko(backend, log, server, cmds, async=False, paramiko_connections={}):
             log.save(update_fields=('state', 'updated_at'))
         if channel is not None:
             channel.close()
+        if ssh is not None:
+            paramiko_connections.release(addr, ssh)
 
 
 def OpenSSH(backend, log, server, cmds, async=False):
     """
     Executes cmds to remote server using SSH with connection resuse for maximum performance
+    
+    The ControlMaster socket is shared between all worker processes and closed after
+    ORCHESTRATION_SSH_POOL_IDLE_TIMEOUT seconds of inactivity.
     """
     script = '\n'.join(cmds)
     script = script.replace('\r', '')
@@ -107,24 +287,95 @@ def OpenSSH(backend, log, server, cmds, async=False):
     log.save(update_fields=('script', 'state', 'updated_at'))
     if not cmds:
         return
+    output = None
     try:
+        # Connection and transfer are part of sshrun(), they are measured as run time
+        start = time.time()
         ssh = sshrun(server.get_address(), script, executable=backend.script_executable,
-            persist=True, async=async, silent=True)
+            persist=settings.ORCHESTRATION_SSH_POOL_IDLE_TIMEOUT or True, async=async, silent=True)
         logger.debug('%s running on %s' % (backend, server))
         if async:
+            output = LogOutputBuffer(log)
             for state in ssh:
-                log.stdout += state.stdout.decode('utf8')
-                log.stderr += state.stderr.decode('utf8')
-                log.save(update_fields=('stdout', 'stderr', 'updated_at'))
+                output.write(state.stdout.decode('utf8'), state.stderr.decode('utf8'))
+            output.update_log()
             log.exit_code = state.exit_code
         else:
             log.stdout = ssh.stdout.decode('utf8')
             log.stderr = ssh.stderr.decode('utf8')
             log.exit_code = ssh.exit_code
+        log.add_time('run', start)
+        log.state = log.SUCCESS if log.exit_code == 0 else log.FAILURE
+        logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
+        start = time.time()
+        log.save()
+        log.add_time('log', start)
+    except:
+        if output is not None:
+            # Output received since the last flush is what explains the failure
+            output.update_log()
+        log.state = log.ERROR
+        log.traceback = ExceptionInfo(sys.exc_info()).traceback
+        logger.error('Exception while executing %s on %s' % (backend, server))
+        logger.debug(log.traceback)
+        log.save()
+    finally:
+        if log.state == log.STARTED:
+            log.state = log.ABORTED
+            log.save(update_fields=('state', 'updated_at'))
+
+
+def Local(backend, log, server, cmds, async=False):
+    """
+    Executes cmds on this host, inside ORCHESTRATION_LOCAL_SANDBOX_DIR
+    
+    Meant for development and benchmarking, scripts run with the privileges of orchestra.
+    Point ORCHESTRATION_SSH_METHOD_BACKEND here in order to use it instead of SSH.
+    """
+    script = '\n'.join(cmds)
+    script = script.replace('\r', '')
+    log.state = log.STARTED
+    log.script = script
+    log.save(update_fields=('script', 'state', 'updated_at'))
+    if not cmds:
+        return
+    sandbox = settings.ORCHESTRATION_LOCAL_SANDBOX_DIR
+    executable = backend.script_executable
+    if settings.ORCHESTRATION_LOCAL_NOEXEC:
+        # Syntax check only, scripts of interpreters without one are just read
+        option = {
+            'bash': '-n',
+            'sh': '-n',
+            'php': '-l',
+        }.get(os.path.basename(executable))
+        executable = '%s %s' % (executable, option) if option else 'cat > /dev/null'
+    output = None
+    try:
+        start = time.time()
+        os.makedirs(sandbox, exist_ok=True)
+        proc = run('cd %s && %s' % (shlex.quote(sandbox), executable),
+            stdin=script.encode('utf8'), async=async, silent=True)
+        logger.debug('%s running on %s' % (backend, server))
+        if async:
+            output = LogOutputBuffer(log)
+            for state in proc:
+                output.write(state.stdout.decode('utf8'), state.stderr.decode('utf8'))
+            output.update_log()
+            log.exit_code = state.exit_code
+        else:
+            log.stdout = proc.stdout.decode('utf8')
+            log.stderr = proc.stderr.decode('utf8')
+            log.exit_code = proc.exit_code
+        log.add_time('run', start)
         log.state = log.SUCCESS if log.exit_code == 0 else log.FAILURE
         logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
+        start = time.time()
         log.save()
+        log.add_time('log', start)
     except:
+        if output is not None:
+            # Output received since the last flush is what explains the failure
+            output.update_log()
         log.state = log.ERROR
         log.traceback = ExceptionInfo(sys.exc_info()).traceback
         logger.error('Exception while executing %s on %s' % (backend, server))
@@ -150,25 +401,32 @@ def Python(backend, log, server, cmds, async=False):
     log.state = log.STARTED
     log.script = '\n'.join((log.script, script))
     log.save(update_fields=('script', 'state', 'updated_at'))
-    stdout = ''
+    stdout = []
+    output = LogOutputBuffer(log, autoflush=async)
+    start = time.time()
     try:
         for cmd in cmds:
             with CaptureStdout() as stdout:
                 result = cmd(server)
             for line in stdout:
-                log.stdout += line + '\n'
+                output.write(line + '\n')
             if result:
-                log.stdout += '# Result: %s\n' % result
-            if async:
-                log.save(update_fields=('stdout', 'updated_at'))
+                output.write('# Result: %s\n' % result)
+        output.update_log()
     except:
+        # Output of the failed command along with the previous ones
+        for line in stdout:
+            output.write(line + '\n')
+        output.update_log()
         log.exit_code = 1
         log.state = log.FAILURE
-        log.stdout = '\n'.join(stdout)
         log.traceback = ExceptionInfo(sys.exc_info()).traceback
         logger.error('Exception while executing %s on %s' % (backend, server))
     else:
         log.exit_code = 0
         log.state = log.SUCCESS
         logger.debug('%s execution state on %s is %s' % (backend, server, log.state))
+    log.add_time('run', start)
+    start = time.time()
     log.save()
+    log.add_time('log', start)
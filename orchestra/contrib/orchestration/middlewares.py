@@ -9,7 +9,7 @@ from django.http.response import HttpResponseServerError
 
 from orchestra.utils.python import OrderedSet
 
-from . import manager, Operation
+from . import manager, settings, Operation
 from .helpers import message_user
 from .models import BackendLog
 
@@ -100,6 +100,18 @@ class OperationsMiddleware(object):
         if not isinstance(response, HttpResponseServerError):
             operations = self.get_pending_operations()
             if operations:
+                try:
+                    operations = manager.coalesce(operations)
+                except Exception as exception:
+                    self.leave_transaction_management(exception)
+                    raise
+            if operations and settings.ORCHESTRATION_BACKGROUND_GENERATION:
+                self.leave_transaction_management()
+                logs = manager.generate_in_background(operations)
+                if logs and resolve(request.path).app_name == 'admin':
+                    message_user(request, logs)
+                return response
+            elif operations:
                 try:
                     scripts, serialize = manager.generate(operations)
                 except Exception as exception:
@@ -108,7 +120,10 @@ class OperationsMiddleware(object):
                 # We commit transaction just before executing operations
                 # because here is when IntegrityError show up
                 self.leave_transaction_management()
-                logs = manager.execute(scripts, serialize=serialize)
+                if settings.ORCHESTRATION_QUEUE_EXECUTIONS and not serialize:
+                    logs = manager.enqueue(scripts)
+                else:
+                    logs = manager.execute(scripts, serialize=serialize)
                 if logs and resolve(request.path).app_name == 'admin':
                     message_user(request, logs)
                 return response
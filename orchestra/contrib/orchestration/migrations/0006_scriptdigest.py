@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('orchestration', '0005_auto_20150709_1016'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScriptDigest',
+            fields=[
+                ('id', models.AutoField(primary_key=True, auto_created=True, serialize=False, verbose_name='ID')),
+                ('backend', models.CharField(max_length=256, verbose_name='backend')),
+                ('object_id', models.PositiveIntegerField()),
+                ('digest', models.CharField(max_length=64, verbose_name='digest')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated')),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+                ('server', models.ForeignKey(verbose_name='server', related_name='script_digests', to='orchestration.Server')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='scriptdigest',
+            unique_together=set([('backend', 'server', 'content_type', 'object_id')]),
+        ),
+    ]
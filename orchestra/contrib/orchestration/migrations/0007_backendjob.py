@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestration', '0006_scriptdigest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackendJob',
+            fields=[
+                ('id', models.AutoField(primary_key=True, auto_created=True, serialize=False, verbose_name='ID')),
+                ('backend', models.CharField(max_length=256, verbose_name='backend')),
+                ('scripts', models.TextField(help_text='JSON [[method, [commands]]]', verbose_name='scripts')),
+                ('digests', models.TextField(help_text='JSON of the operations script digests', blank=True, verbose_name='digests')),
+                ('state', models.CharField(choices=[('QUEUED', 'Queued'), ('LEASED', 'Leased'), ('DONE', 'Done'), ('FAILED', 'Failed')], max_length=16, default='QUEUED', verbose_name='state')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('available_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='available')),
+                ('leased_until', models.DateTimeField(null=True, verbose_name='leased until')),
+                ('worker', models.CharField(max_length=256, blank=True, verbose_name='worker')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated')),
+                ('log', models.OneToOneField(verbose_name='log', related_name='job', to='orchestration.BackendLog')),
+                ('server', models.ForeignKey(verbose_name='server', related_name='jobs', to='orchestration.Server')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='backendjob',
+            index_together=set([('state', 'server', 'backend')]),
+        ),
+    ]
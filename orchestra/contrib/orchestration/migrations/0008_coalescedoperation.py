@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('orchestration', '0007_backendjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoalescedOperation',
+            fields=[
+                ('id', models.AutoField(primary_key=True, auto_created=True, serialize=False, verbose_name='ID')),
+                ('backend', models.CharField(max_length=256, verbose_name='backend')),
+                ('action', models.CharField(max_length=64, verbose_name='action')),
+                ('object_id', models.PositiveIntegerField()),
+                ('due_at', models.DateTimeField(db_index=True, verbose_name='due')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('content_type', models.ForeignKey(to='contenttypes.ContentType')),
+                ('route', models.ForeignKey(verbose_name='route', related_name='coalesced_operations', to='orchestration.Route')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='coalescedoperation',
+            index_together=set([('backend', 'route')]),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestration', '0008_coalescedoperation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backendlog',
+            name='generate_time',
+            field=models.FloatField(help_text='Script generation.', null=True, verbose_name='generate time'),
+        ),
+        migrations.AddField(
+            model_name='backendlog',
+            name='route_time',
+            field=models.FloatField(help_text='Route resolution of the operations.', null=True, verbose_name='route time'),
+        ),
+        migrations.AddField(
+            model_name='backendlog',
+            name='wait_time',
+            field=models.FloatField(help_text='Waiting on the job queue and for a free execution slot.', null=True, verbose_name='wait time'),
+        ),
+        migrations.AddField(
+            model_name='backendlog',
+            name='connect_time',
+            field=models.FloatField(help_text='Connection to the server.', null=True, verbose_name='connect time'),
+        ),
+        migrations.AddField(
+            model_name='backendlog',
+            name='send_time',
+            field=models.FloatField(help_text='Script transfer.', null=True, verbose_name='send time'),
+        ),
+        migrations.AddField(
+            model_name='backendlog',
+            name='run_time',
+            field=models.FloatField(help_text='Remote execution, including connection and transfer when they can not be measured on their own.', null=True, verbose_name='run time'),
+        ),
+        migrations.AddField(
+            model_name='backendlog',
+            name='log_time',
+            field=models.FloatField(help_text='Storage of the execution results on this log.', null=True, verbose_name='log time'),
+        ),
+        migrations.AddField(
+            model_name='backendlog',
+            name='store_time',
+            field=models.FloatField(help_text='Storage of the executed operations.', null=True, verbose_name='store time'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestration', '0009_backendlog_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coalescedoperation',
+            name='claimed_until',
+            field=models.DateTimeField(help_text='Being flushed, deleted once its execution is logged or queued. Flushed again afterwards otherwise.', null=True, verbose_name='claimed until'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orchestration', '0010_coalescedoperation_claimed_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coalescedoperation',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0, verbose_name='attempts'),
+        ),
+    ]
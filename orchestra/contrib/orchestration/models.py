@@ -1,9 +1,17 @@
+import datetime
+import json
 import logging
 import socket
+import threading
+import time
 
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import force_text
 from django.utils.functional import cached_property
 from django.utils.module_loading import autodiscover_modules
@@ -48,6 +56,18 @@ class Server(models.Model):
             return self.name
 
 
+class BackendLogQuerySet(models.QuerySet):
+    def get_timings(self, *fields):
+        """
+        sum and count of each phase timing grouped by fields, i.e. ('backend', 'server__name')
+        {'count': executions, 'run_time__sum': seconds, 'run_time__count': measures, ...}
+        """
+        aggregates = [Count('id')]
+        for phase in BackendLog.TIMING_FIELDS:
+            aggregates += [Sum(phase), Count(phase)]
+        return self.values(*fields).annotate(*aggregates).order_by(*fields)
+
+
 class BackendLog(models.Model):
     RECEIVED = 'RECEIVED'
     TIMEOUT = 'TIMEOUT'
@@ -60,6 +80,8 @@ class BackendLog(models.Model):
     NOTHING = 'NOTHING'
     # Special state for mocked backendlogs
     EXCEPTION = 'EXCEPTION'
+    # Connection and infrastructure failures, queued jobs are retried
+    RETRY_STATES = (TIMEOUT, ERROR, ABORTED, EXCEPTION)
     
     STATES = (
         (RECEIVED, RECEIVED),
@@ -85,6 +107,31 @@ class BackendLog(models.Model):
         help_text="Celery task ID when used as execution backend")
     created_at = models.DateTimeField(_("created"), auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(_("updated"), auto_now=True)
+    # Seconds spent on each phase of the execution
+    generate_time = models.FloatField(_("generate time"), null=True,
+        help_text=_("Script generation."))
+    route_time = models.FloatField(_("route time"), null=True,
+        help_text=_("Route resolution of the operations."))
+    wait_time = models.FloatField(_("wait time"), null=True,
+        help_text=_("Waiting on the job queue and for a free execution slot."))
+    connect_time = models.FloatField(_("connect time"), null=True,
+        help_text=_("Connection to the server."))
+    send_time = models.FloatField(_("send time"), null=True,
+        help_text=_("Script transfer."))
+    run_time = models.FloatField(_("run time"), null=True,
+        help_text=_("Remote execution, including connection and transfer when they can not "
+                    "be measured on their own."))
+    log_time = models.FloatField(_("log time"), null=True,
+        help_text=_("Storage of the execution results on this log."))
+    store_time = models.FloatField(_("store time"), null=True,
+        help_text=_("Storage of the executed operations."))
+    
+    objects = BackendLogQuerySet.as_manager()
+    
+    TIMING_FIELDS = (
+        'generate_time', 'route_time', 'wait_time', 'connect_time', 'send_time', 'run_time',
+        'log_time', 'store_time',
+    )
     
     class Meta:
         get_latest_by = 'id'
@@ -106,6 +153,14 @@ class BackendLog(models.Model):
     
     def backend_class(self):
         return ServiceBackend.get_backend(self.backend)
+    
+    def add_time(self, phase, start):
+        """ adds the seconds elapsed since start to the phase timing """
+        field = '%s_time' % phase
+        setattr(self, field, (getattr(self, field) or 0) + time.time() - start)
+    
+    def save_timings(self):
+        self.save(update_fields=self.TIMING_FIELDS)
 
 
 class BackendOperationQuerySet(models.QuerySet):
@@ -142,25 +197,290 @@ class BackendOperation(models.Model):
         return ServiceBackend.get_backend(self.backend)
 
 
+class ScriptDigestQuerySet(models.QuerySet):
+    def get_for_operations(self, backend_cls, server, operations):
+        """ {object_id: digest} of the objects of the operations """
+        ct = ContentType.objects.get_for_model(backend_cls.model_class())
+        digests = self.filter(
+            backend=backend_cls.get_name(),
+            server=server,
+            content_type=ct,
+            object_id__in=[operation.pk for operation in operations],
+        )
+        return dict(digests.values_list('object_id', 'digest'))
+    
+    def get_records(self, operations):
+        """ serializable (backend, content_type_id, object_id, action, digest) of operations """
+        return [
+            (operation.backend.get_name(), ContentType.objects.get_for_model(operation.model).pk,
+             operation.pk, operation.action, operation.digest)
+            for operation in operations if operation.pk is not None
+        ]
+    
+    def store(self, server, operations):
+        """ keeps the digests of successfully executed operations """
+        self.store_records(server, self.get_records(operations))
+    
+    def store_records(self, server, records):
+        """ replaces the digests of records with a single delete and a bulk insert """
+        from . import Operation
+        objects = {}
+        digests = {}
+        for backend, ct_id, object_id, action, digest in records:
+            if action not in (Operation.SAVE, Operation.DELETE):
+                continue
+            key = (backend, ct_id, object_id)
+            objects.setdefault((backend, ct_id), set()).add(object_id)
+            if action == Operation.SAVE and digest:
+                digests[key] = digest
+            else:
+                digests.pop(key, None)
+        if not objects:
+            return
+        query = Q()
+        for (backend, ct_id), object_ids in objects.items():
+            query |= Q(backend=backend, content_type_id=ct_id, object_id__in=object_ids)
+        try:
+            with transaction.atomic():
+                self.filter(query, server=server).delete()
+                self.bulk_create([
+                    self.model(backend=backend, server=server, content_type_id=ct_id,
+                        object_id=object_id, digest=digest)
+                    for (backend, ct_id, object_id), digest in digests.items()
+                ])
+        except IntegrityError:
+            # Stored concurrently, a missing digest only means not skipping the next save
+            logger.warning("Script digests of %s could not be stored." % server)
+
+
+class ScriptDigest(models.Model):
+    """
+    Digest of the last script fragment of an object successfully executed on a server,
+    saves with the same fragment are not executed again.
+    """
+    backend = models.CharField(_("backend"), max_length=256)
+    server = models.ForeignKey(Server, verbose_name=_("server"), related_name='script_digests')
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    digest = models.CharField(_("digest"), max_length=64)
+    updated_at = models.DateTimeField(_("updated"), auto_now=True)
+    
+    objects = ScriptDigestQuerySet.as_manager()
+    
+    class Meta:
+        unique_together = ('backend', 'server', 'content_type', 'object_id')
+    
+    def __str__(self):
+        return '%s@%s %s' % (self.backend, self.server, self.digest)
+
+
+class BackendJobQuerySet(models.QuerySet):
+    def lease(self, worker, scan=500):
+        """
+        leases the oldest available job of a (server, backend) pair without leased jobs,
+        jobs of the same pair are executed one at a time and in order
+        expired leases, of lost workers, are available again
+        """
+        now = timezone.now()
+        duration = datetime.timedelta(seconds=settings.ORCHESTRATION_JOB_LEASE_TIME)
+        busy = set(self.filter(state=BackendJob.LEASED, leased_until__gte=now).values_list(
+            'server_id', 'backend'))
+        pending = self.filter(state__in=(BackendJob.QUEUED, BackendJob.LEASED)).order_by('id')
+        pending = pending.values_list(
+            'id', 'server_id', 'backend', 'state', 'available_at', 'leased_until')
+        seen = set()
+        for job_id, server_id, backend, state, available_at, leased_until in pending[:scan]:
+            key = (server_id, backend)
+            if key in seen or key in busy:
+                continue
+            seen.add(key)
+            if state == BackendJob.QUEUED and available_at > now:
+                continue
+            # Another worker may have leased the job in the meantime
+            leased = self.filter(pk=job_id, state=state, leased_until=leased_until).update(
+                state=BackendJob.LEASED,
+                leased_until=now+duration,
+                worker=worker,
+                attempts=F('attempts')+1,
+            )
+            if leased:
+                return self.select_related('log', 'server').get(pk=job_id)
+        return None
+    
+    def backoff(self, server, available_at):
+        """ postpones all the queued jobs of a server """
+        self.filter(server=server, state=BackendJob.QUEUED, available_at__lt=available_at).update(
+            available_at=available_at)
+
+
+class BackendJob(models.Model):
+    """
+    Generated backend script pending to be executed on a server by an orchestration worker
+    """
+    QUEUED = 'QUEUED'
+    LEASED = 'LEASED'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    STATES = (
+        (QUEUED, _("Queued")),
+        (LEASED, _("Leased")),
+        (DONE, _("Done")),
+        (FAILED, _("Failed")),
+    )
+    
+    log = models.OneToOneField(BackendLog, verbose_name=_("log"), related_name='job')
+    backend = models.CharField(_("backend"), max_length=256)
+    server = models.ForeignKey(Server, verbose_name=_("server"), related_name='jobs')
+    scripts = models.TextField(_("scripts"), help_text=_("JSON [[method, [commands]]]"))
+    digests = models.TextField(_("digests"), blank=True,
+        help_text=_("JSON of the operations script digests"))
+    state = models.CharField(_("state"), max_length=16, choices=STATES, default=QUEUED)
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    available_at = models.DateTimeField(_("available"), default=timezone.now, db_index=True)
+    leased_until = models.DateTimeField(_("leased until"), null=True)
+    worker = models.CharField(_("worker"), max_length=256, blank=True)
+    created_at = models.DateTimeField(_("created"), auto_now_add=True)
+    updated_at = models.DateTimeField(_("updated"), auto_now=True)
+    
+    objects = BackendJobQuerySet.as_manager()
+    
+    class Meta:
+        index_together = ('state', 'server', 'backend')
+    
+    def __str__(self):
+        return "%s@%s" % (self.backend, self.server)
+    
+    @classmethod
+    def dump_scripts(cls, backend):
+        """ JSON scripts of a backend, None when they include python functions """
+        from . import methods
+        scripts = []
+        for method, commands in backend.scripts:
+            name = getattr(method, '__name__', None)
+            if getattr(methods, name or '', None) is not method:
+                return None
+            if not all(isinstance(cmd, str) for cmd in commands):
+                return None
+            scripts.append((name, commands))
+        return json.dumps(scripts)
+    
+    def load_scripts(self):
+        from . import methods
+        return [
+            (getattr(methods, name), commands) for name, commands in json.loads(self.scripts)
+        ]
+    
+    def renew(self, duration):
+        """ extends the lease of a job still leased by its worker, returns False otherwise """
+        return bool(type(self).objects.filter(
+            pk=self.pk, state=self.LEASED, worker=self.worker
+        ).update(leased_until=timezone.now()+datetime.timedelta(seconds=duration)))
+    
+    def ack(self):
+        """ acknowledges the execution of the job according to its log state """
+        log = self.log
+        if log.state == BackendLog.SUCCESS:
+            self.state = self.DONE
+            if self.digests:
+                ScriptDigest.objects.store_records(self.server, json.loads(self.digests))
+        elif (log.state in BackendLog.RETRY_STATES and
+                self.attempts < settings.ORCHESTRATION_JOB_MAX_ATTEMPTS):
+            # Exponential backoff per server
+            delay = settings.ORCHESTRATION_JOB_RETRY_BACKOFF * 2**(self.attempts-1)
+            self.available_at = timezone.now() + datetime.timedelta(seconds=delay)
+            self.state = self.QUEUED
+            type(self).objects.backoff(self.server, self.available_at)
+        else:
+            self.state = self.FAILED
+        self.leased_until = None
+        self.save(update_fields=('state', 'available_at', 'leased_until', 'updated_at'))
+        return self.state
+
+
+class CoalescedOperation(models.Model):
+    """
+    Save operation deferred until the coalescing window of its (backend, route) closes,
+    operations of many requests are merged into a single script
+    """
+    backend = models.CharField(_("backend"), max_length=256)
+    route = models.ForeignKey('orchestration.Route', verbose_name=_("route"),
+        related_name='coalesced_operations')
+    action = models.CharField(_("action"), max_length=64)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    due_at = models.DateTimeField(_("due"), db_index=True)
+    claimed_until = models.DateTimeField(_("claimed until"), null=True,
+        help_text=_("Being flushed, deleted once its execution is logged or queued. "
+                    "Flushed again afterwards otherwise."))
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    created_at = models.DateTimeField(_("created"), auto_now_add=True)
+    
+    class Meta:
+        index_together = ('backend', 'route')
+    
+    def __str__(self):
+        return '%s.%s(%s)' % (self.backend, self.action, self.object_id)
+
+
 autodiscover_modules('backends')
 
 
+class RouteTable(object):
+    """
+    Process-wide index of active routes by (backend, action)
+    
+    It is invalidated by Route post_save and post_delete signals, and also expires
+    after ORCHESTRATION_ROUTE_TABLE_TTL seconds to pick up changes made by other processes.
+    """
+    def __init__(self):
+        self.table = None
+        self.built_at = 0
+        self.lock = threading.Lock()
+    
+    def build(self, queryset=None):
+        """ {(backend, action): [routes]} of the active routes of queryset """
+        if queryset is None:
+            queryset = Route.objects.all()
+        table = {}
+        for route in queryset.filter(is_active=True).select_related('host'):
+            try:
+                backend_class = route.backend_class
+            except KeyError:
+                logger.warning("Backed '%s' not installed." % route.backend)
+            else:
+                for action in backend_class.get_actions():
+                    key = (route.backend, action)
+                    try:
+                        table[key].append(route)
+                    except KeyError:
+                        table[key] = [route]
+        return table
+    
+    def get(self):
+        with self.lock:
+            ttl = settings.ORCHESTRATION_ROUTE_TABLE_TTL
+            if self.table is None or (ttl and time.time()-self.built_at > ttl):
+                self.table = self.build()
+                self.built_at = time.time()
+            return self.table
+    
+    def invalidate(self):
+        with self.lock:
+            self.table = None
+
+
+route_table = RouteTable()
+
+
 class RouteQuerySet(models.QuerySet):
     def get_for_operation(self, operation, **kwargs):
         cache = kwargs.get('cache', {})
         if not cache:
-            for route in self.filter(is_active=True).select_related('host'):
-                try:
-                    backend_class = route.backend_class
-                except KeyError:
-                    logger.warning("Backed '%s' not installed." % route.backend)
-                else:
-                    for action in backend_class.get_actions():
-                        key = (route.backend, action)
-                        try:
-                            cache[key].append(route)
-                        except KeyError:
-                            cache[key] = [route]
+            if self.query.where:
+                # The process-wide table only holds unfiltered routes
+                cache.update(route_table.build(self))
+            else:
+                cache.update(route_table.get())
         routes = []
         backend_cls = operation.backend
         key = (backend_cls.get_name(), operation.action)
@@ -206,9 +526,27 @@ class Route(models.Model):
     def backend_class(self):
         return ServiceBackend.get_backend(self.backend)
     
-    def clean(self):
+    @property
+    def compiled_match(self):
+        """ match expression compiled once, recompiled only if it has changed """
+        match, code = getattr(self, '_compiled_match', (None, None))
+        if match != self.match:
+            code = compile(self.match, '<route %s>' % self, 'eval')
+            self._compiled_match = (self.match, code)
+        return code
+    
+    def clean_match(self):
         if not self.match:
             self.match = 'True'
+        try:
+            self.compiled_match
+        except SyntaxError as exception:
+            raise ValidationError({
+                'match': ': '.join((type(exception).__name__, str(exception)))
+            })
+    
+    def clean(self):
+        self.clean_match()
         if self.backend:
             try:
                 backend_class = self.backend_class
@@ -227,6 +565,11 @@ class Route(models.Model):
                 name = type(exception).__name__
                 raise ValidationError(': '.join((name, str(exception))))
     
+    def save(self, *args, **kwargs):
+        # Routes created by the API or the shell do not go through clean()
+        self.clean_match()
+        super(Route, self).save(*args, **kwargs)
+    
     def action_is_async(self, action):
         return action in self.async_actions
     
@@ -236,7 +579,7 @@ class Route(models.Model):
             'obj': instance,
             instance._meta.model_name: instance,
         }
-        return eval(self.match, safe_locals)
+        return eval(self.compiled_match, safe_locals)
     
     def enable(self):
         self.is_active = True
@@ -245,3 +588,13 @@ class Route(models.Model):
     def disable(self):
         self.is_active = False
         self.save()
+
+
+@receiver(post_save, sender=Route, dispatch_uid='orchestration.invalidate_route_table.save')
+@receiver(post_delete, sender=Route, dispatch_uid='orchestration.invalidate_route_table.delete')
+@receiver(post_save, sender=Server,
+    dispatch_uid='orchestration.invalidate_route_table.server_save')
+@receiver(post_delete, sender=Server,
+    dispatch_uid='orchestration.invalidate_route_table.server_delete')
+def invalidate_route_table(sender, **kwargs):
+    route_table.invalidate()
@@ -30,6 +30,12 @@ ORCHESTRATION_ROUTER = Setting('ORCHESTRATION_ROUTER',
 )
 
 
+ORCHESTRATION_ROUTE_TABLE_TTL = Setting('ORCHESTRATION_ROUTE_TABLE_TTL',
+    60,
+    help_text=_("Seconds the process-wide route table is cached. Route changes made by the same "
+                "process are applied immediately. <tt>0</tt> caches it until a route changes.")
+)
+
 
 ORCHESTRATION_DISABLE_EXECUTION = Setting('ORCHESTRATION_DISABLE_EXECUTION',
     False
@@ -47,5 +53,188 @@ ORCHESTRATION_SSH_METHOD_BACKEND = Setting('ORCHESTRATION_SSH_METHOD_BACKEND',
                 "1) <tt>orchestra.contrib.orchestration.methods.OpenSSH</tt> with ControlPersist.<br>"
                 "2) <tt>orchestra.contrib.orchestration.methods.Paramiko</tt> with connection pool.<br>"
                 "Both perform similarly, but OpenSSH has the advantage that the connections are shared between workers. "
-                "Paramiko, in contrast, has a per worker connection pool.")
+                "Paramiko, in contrast, has a per worker connection pool.<br>"
+                "<tt>orchestra.contrib.orchestration.methods.Local</tt> runs the scripts on this host instead, "
+                "for development and benchmarking.")
+)
+
+
+ORCHESTRATION_LOCAL_SANDBOX_DIR = Setting('ORCHESTRATION_LOCAL_SANDBOX_DIR',
+    '/tmp/orchestra-sandbox',
+    help_text=_("Working directory of the scripts executed by the Local method.")
+)
+
+
+ORCHESTRATION_LOCAL_NOEXEC = Setting('ORCHESTRATION_LOCAL_NOEXEC',
+    False,
+    help_text=_("Scripts executed by the Local method are only syntax checked (<tt>bash -n</tt>), "
+                "exercising the whole execution path without side effects.")
+)
+
+
+ORCHESTRATION_SSH_POOL_IDLE_TIMEOUT = Setting('ORCHESTRATION_SSH_POOL_IDLE_TIMEOUT',
+    600,
+    help_text=_("Seconds a pooled SSH connection is kept open without being used. "
+                "<tt>0</tt> keeps connections open forever.")
+)
+
+
+ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS = Setting('ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS',
+    16,
+    help_text=_("Maximum number of backends executed at the same time by all the processes sharing "
+                "ORCHESTRATION_EXECUTION_SLOTS_DIR, usually those of this host, "
+                "as well as the size of the execution thread pool of each process.<br>"
+                "Exceeding backends are queued until an execution slot becomes available.")
+)
+
+
+ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS_PER_SERVER = Setting('ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS_PER_SERVER',
+    4,
+    help_text=_("Maximum number of backends executed at the same time on a single server "
+                "by all the processes sharing ORCHESTRATION_EXECUTION_SLOTS_DIR.")
+)
+
+
+ORCHESTRATION_EXECUTION_SLOTS_DIR = Setting('ORCHESTRATION_EXECUTION_SLOTS_DIR',
+    '/tmp/orchestra-execution-slots',
+    help_text=_("Directory of the lock files that limit the concurrent executions of web and "
+                "orchestration worker processes. It should be on a local filesystem, "
+                "processes of different hosts have their own limits.")
+)
+
+
+ORCHESTRATION_LOG_FLUSH_INTERVAL = Setting('ORCHESTRATION_LOG_FLUSH_INTERVAL',
+    5,
+    help_text=_("Seconds between saves of the output of asynchronous backend executions.")
+)
+
+
+ORCHESTRATION_LOG_FLUSH_SIZE = Setting('ORCHESTRATION_LOG_FLUSH_SIZE',
+    512*1024,
+    help_text=_("Pending output size, in characters, that forces a save of the backend log "
+                "before <tt>ORCHESTRATION_LOG_FLUSH_INTERVAL</tt> is reached.")
+)
+
+
+ORCHESTRATION_GENERATE_THREADS = Setting('ORCHESTRATION_GENERATE_THREADS',
+    1,
+    help_text=_("Number of threads generating the scripts of different backends at the same time, "
+                "outside of database transactions.")
+)
+
+
+ORCHESTRATION_BACKGROUND_GENERATION = Setting('ORCHESTRATION_BACKGROUND_GENERATION',
+    False,
+    help_text=_("Commit the request changes and generate and execute the backends on the background, "
+                "responding right away with their pending logs. "
+                "Executions are enqueued when ORCHESTRATION_QUEUE_EXECUTIONS is enabled.")
+)
+
+
+ORCHESTRATION_BACKGROUND_THREADS = Setting('ORCHESTRATION_BACKGROUND_THREADS',
+    2,
+    help_text=_("Number of threads of each process generating and executing the backends of "
+                "ORCHESTRATION_BACKGROUND_GENERATION requests, other requests wait for a free thread.")
+)
+
+
+ORCHESTRATION_SKIP_UNCHANGED_OPERATIONS = Setting('ORCHESTRATION_SKIP_UNCHANGED_OPERATIONS',
+    False,
+    help_text=_("Do not execute save operations whose generated script is the same than the last one "
+                "successfully executed for the same object and server. "
+                "Saving an object again does not re-apply its configuration when enabled, "
+                "<tt>orchestrate</tt> management command always executes them.")
+)
+
+
+ORCHESTRATION_QUEUE_EXECUTIONS = Setting('ORCHESTRATION_QUEUE_EXECUTIONS',
+    False,
+    help_text=_("Store the generated scripts as jobs executed by the orchestration workers "
+                "(<tt>orchestration.process_jobs</tt> task or <tt>orchestrationworker</tt> command) "
+                "instead of executing them on the web worker. "
+                "Workers are only woken up right away with the <tt>celery</tt> TASKS_BACKEND, "
+                "otherwise jobs wait for the periodic <tt>orchestration.process_pending_jobs</tt> "
+                "task or a running <tt>orchestrationworker</tt>.")
+)
+
+
+ORCHESTRATION_JOB_LEASE_TIME = Setting('ORCHESTRATION_JOB_LEASE_TIME',
+    5*60,
+    help_text=_("Seconds a worker holds a job, renewed every third of it while the job runs. "
+                "Jobs of lost workers are executed again afterwards.")
+)
+
+
+ORCHESTRATION_JOB_MAX_ATTEMPTS = Setting('ORCHESTRATION_JOB_MAX_ATTEMPTS',
+    5,
+    help_text=_("Executions of a job failing because of connection errors, timeouts or exceptions, "
+                "as well as flushes of a failing coalescing window.")
+)
+
+
+ORCHESTRATION_JOB_RETRY_BACKOFF = Setting('ORCHESTRATION_JOB_RETRY_BACKOFF',
+    60,
+    help_text=_("Seconds before the first retry, doubled on each attempt. "
+                "All the queued jobs of the failing server are postponed.")
+)
+
+
+ORCHESTRATION_COALESCING_WINDOW = Setting('ORCHESTRATION_COALESCING_WINDOW',
+    0,
+    help_text=_("Seconds save operations are deferred, in order to merge the ones of consecutive "
+                "requests into a single script and service reload per backend and route.<br>"
+                "<tt>0</tt> executes operations at the end of each request.<br>"
+                "Windows are flushed on time with the <tt>celery</tt> TASKS_BACKEND, otherwise by "
+                "the periodic <tt>orchestration.flush_pending_coalesced_operations</tt> task, "
+                "once per minute.")
+)
+
+
+ORCHESTRATION_COALESCING_WINDOWS = Setting('ORCHESTRATION_COALESCING_WINDOWS',
+    {},
+    help_text=_("Per backend coalescing window, the maximum added latency of its operations. "
+                "e.g. <tt>{'Apache2Backend': 30, 'Bind9MasterDomainBackend': 0}</tt>")
+)
+
+
+ORCHESTRATION_RELOAD_SPOOL_DIR = Setting('ORCHESTRATION_RELOAD_SPOOL_DIR',
+    '/dev/shm/orchestra-reloads',
+    help_text=_("Remote directory where backends of the same execution register their service "
+                "reloads, each distinct reload runs once after all of them have finished.")
+)
+
+
+ORCHESTRATION_RELOAD_INTERVAL = Setting('ORCHESTRATION_RELOAD_INTERVAL',
+    5,
+    help_text=_("Minimum seconds between two reloads of the same service on a server, "
+                "reloads requested earlier wait for the interval to pass.")
+)
+
+
+ORCHESTRATION_RELOAD_BATCH_TIMEOUT = Setting('ORCHESTRATION_RELOAD_BATCH_TIMEOUT',
+    10,
+    help_text=_("Minutes after which the reloads registered by an execution that never "
+                "completed (e.g. a lost connection) are run anyway, by a watchdog left on the "
+                "server or by the next execution.")
+)
+
+
+ORCHESTRATION_METRICS_TOKEN = Setting('ORCHESTRATION_METRICS_TOKEN',
+    '',
+    help_text=_("Bearer token (<tt>Authorization: Bearer &lt;token&gt;</tt>) required for scraping "
+                "<tt>/orchestration/metrics/</tt>. Leave it empty for disabling token access.")
+)
+
+
+ORCHESTRATION_METRICS_ALLOWED_IPS = Setting('ORCHESTRATION_METRICS_ALLOWED_IPS',
+    (),
+    help_text=_("Addresses allowed to scrape <tt>/orchestration/metrics/</tt> without a token, "
+                "as seen on REMOTE_ADDR.")
+)
+
+
+ORCHESTRATION_METRICS_DAYS = Setting('ORCHESTRATION_METRICS_DAYS',
+    1,
+    help_text=_("Days of execution logs aggregated by the metrics, unless <tt>?days=</tt> "
+                "is given.")
 )
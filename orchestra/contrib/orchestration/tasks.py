@@ -3,7 +3,7 @@ from datetime import timedelta
 from celery.task.schedules import crontab
 from django.utils import timezone
 
-from orchestra.contrib.tasks import periodic_task
+from orchestra.contrib.tasks import task, periodic_task
 
 from . import settings
 from .models import BackendLog
@@ -14,3 +14,30 @@ def backend_logs_cleanup():
     days = settings.ORCHESTRATION_BACKEND_CLEANUP_DAYS
     epoch = timezone.now()-timedelta(days=days)
     return BackendLog.objects.filter(created_at__lt=epoch).only('id').delete()
+
+
+@task(name='orchestration.process_jobs')
+def process_jobs():
+    from . import manager
+    return manager.process_jobs()
+
+
+@periodic_task(run_every=crontab(minute='*'), name='orchestration.process_pending_jobs')
+def process_pending_jobs():
+    """ catches up with retries and jobs not processed on their enqueue wake up """
+    from . import manager
+    return manager.process_jobs()
+
+
+@task(name='orchestration.flush_coalesced_operations')
+def flush_coalesced_operations():
+    """ scheduled with the coalescing window as countdown """
+    from . import manager
+    return len(manager.flush_coalesced())
+
+
+@periodic_task(run_every=crontab(minute='*'), name='orchestration.flush_pending_coalesced_operations')
+def flush_pending_coalesced_operations():
+    """ catches up with windows whose flush task has been lost """
+    from . import manager
+    return len(manager.flush_coalesced())
@@ -0,0 +1,35 @@
+from ..backends import ServiceBackend, ServiceMount
+
+
+def reset_backends():
+    """ backend lookups are cached, see ServiceBackend.get_backend() and get_model_index() """
+    ServiceMount.model_index = None
+    if '_registry' in vars(ServiceBackend):
+        del ServiceBackend._registry
+
+
+def unregister_backends(*backends):
+    """
+    test backends are registered by their metaclass, otherwise they would collect the
+    operations of the whole test suite and show up as backend choices
+    """
+    for backend in backends:
+        if backend in ServiceBackend.plugins:
+            ServiceBackend.plugins.remove(backend)
+    reset_backends()
+
+
+class BackendsMixin(object):
+    """ registers BACKENDS during the tests of the class only """
+    BACKENDS = ()
+    
+    @classmethod
+    def setUpClass(cls):
+        super(BackendsMixin, cls).setUpClass()
+        ServiceBackend.plugins.extend(cls.BACKENDS)
+        reset_backends()
+    
+    @classmethod
+    def tearDownClass(cls):
+        unregister_backends(*cls.BACKENDS)
+        super(BackendsMixin, cls).tearDownClass()
@@ -0,0 +1,40 @@
+from orchestra.utils.tests import BaseTestCase
+
+from .. import backends
+from . import unregister_backends
+
+
+class ReloadTestBackend(backends.ServiceController):
+    verbose_name = 'Reload test'
+    model = 'orchestration.Server'
+    
+    def commit(self):
+        self.reload('nginx', 'service nginx reload')
+        self.reload('php', 'service php5-fpm reload')
+
+
+unregister_backends(ReloadTestBackend)
+
+
+class ReloadTests(BaseTestCase):
+    def get_script(self, backend):
+        return '\n'.join(cmd for method, cmds in backend.head + backend.tail for cmd in cmds)
+    
+    def test_uncoordinated_reload(self):
+        backend = ReloadTestBackend()
+        backend.prepare()
+        backend.commit()
+        script = self.get_script(backend)
+        self.assertEqual(1, script.count('function reload_service'))
+        self.assertTrue(script.startswith('declare -F reload_service'))
+    
+    def test_coordinated_reload(self):
+        backend = ReloadTestBackend()
+        backend.prepare()
+        backend.commit()
+        backend.coordinate_reloads('batch', participants=2, participant=1)
+        script = self.get_script(backend)
+        # Coordination is defined first, the fallback is skipped
+        self.assertTrue(script.startswith('# Coordinate service reloads'))
+        self.assertLess(script.index('function reload_service'), script.index('declare -F'))
+        self.assertIn('.exited-1', script)
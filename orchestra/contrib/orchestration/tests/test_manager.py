@@ -0,0 +1,267 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.utils.python import AttrDict
+from orchestra.utils.tests import BaseTestCase
+
+from .. import backends, manager, settings, Operation
+from ..models import BackendJob, BackendLog, CoalescedOperation, Route, ScriptDigest, Server
+from . import BackendsMixin, unregister_backends
+
+
+class DigestTestBackend(backends.ServiceController):
+    verbose_name = 'Digest test'
+    model = 'orchestration.Server'
+    
+    def save(self, server):
+        self.append("echo '%s'" % server.name)
+
+
+class FailingTestBackend(backends.ServiceController):
+    verbose_name = 'Failing test'
+    model = 'orchestration.Server'
+    
+    def save(self, server):
+        raise ValueError(server)
+
+
+unregister_backends(DigestTestBackend, FailingTestBackend)
+
+
+class SkipUnchangedTests(BaseTestCase):
+    def setUp(self):
+        self.server = Server.objects.create(name='web.example.com')
+        self.host = Server.objects.create(name='host.example.com')
+    
+    def generate(self, skip_unchanged=True):
+        operations = [Operation(DigestTestBackend, self.server, Operation.SAVE)]
+        backend = manager.generate_backend(DigestTestBackend, operations, server=self.host,
+            skip_unchanged=skip_unchanged)
+        return backend, operations
+    
+    def test_unchanged_save_is_skipped(self):
+        backend, operations = self.generate()
+        self.assertEqual([], backend.skipped_operations)
+        ScriptDigest.objects.store(self.host, operations)
+        backend, operations = self.generate()
+        self.assertEqual(operations, backend.skipped_operations)
+        self.assertFalse(backend.content)
+        self.assertFalse(backend.has_to_run())
+    
+    def test_changed_save_runs_again(self):
+        backend, operations = self.generate()
+        ScriptDigest.objects.store(self.host, operations)
+        self.server.name = 'web1.example.com'
+        backend, operations = self.generate()
+        self.assertEqual([], backend.skipped_operations)
+        self.assertTrue(backend.has_to_run())
+    
+    def test_skip_disabled(self):
+        backend, operations = self.generate()
+        ScriptDigest.objects.store(self.host, operations)
+        backend, operations = self.generate(skip_unchanged=False)
+        self.assertEqual([], backend.skipped_operations)
+        self.assertTrue(backend.has_to_run())
+    
+    def test_store_replaces_digests(self):
+        backend, operations = self.generate()
+        ScriptDigest.objects.store(self.host, operations)
+        self.server.name = 'web1.example.com'
+        backend, operations = self.generate()
+        ScriptDigest.objects.store(self.host, operations)
+        digest, = ScriptDigest.objects.filter(server=self.host)
+        self.assertEqual(operations[0].digest, digest.digest)
+        operations = [Operation(DigestTestBackend, self.server, Operation.DELETE)]
+        ScriptDigest.objects.store(self.host, operations)
+        self.assertFalse(ScriptDigest.objects.exists())
+
+
+class JobLeaseTests(BaseTestCase):
+    def setUp(self):
+        server = Server.objects.create(name='web.example.com')
+        log = BackendLog.objects.create(backend=DigestTestBackend.get_name(), server=server)
+        BackendJob.objects.create(log=log, backend=log.backend, server=server, scripts='[]')
+    
+    def test_renew(self):
+        job = BackendJob.objects.lease('worker1')
+        leased_until = job.leased_until
+        self.assertTrue(job.renew(3600))
+        job.refresh_from_db()
+        self.assertLess(leased_until, job.leased_until)
+        self.assertIsNone(BackendJob.objects.lease('worker2'))
+        # Leased again by another worker after expiring
+        job.worker = 'worker2'
+        self.assertFalse(job.renew(3600))
+    
+    def test_keep_leased(self):
+        job = BackendJob.objects.lease('worker1')
+        leased_until = job.leased_until
+        stop = threading.Event()
+        threading.Timer(0.1, stop.set).start()
+        lease_time = settings.ORCHESTRATION_JOB_LEASE_TIME
+        settings.ORCHESTRATION_JOB_LEASE_TIME = 0.03
+        try:
+            manager.keep_leased(job, stop)
+        finally:
+            settings.ORCHESTRATION_JOB_LEASE_TIME = lease_time
+        job.refresh_from_db()
+        self.assertNotEqual(leased_until, job.leased_until)
+
+
+class FlushCoalescedTests(BackendsMixin, BaseTestCase):
+    BACKENDS = (DigestTestBackend, FailingTestBackend)
+    
+    def setUp(self):
+        self.server = Server.objects.create(name='web.example.com')
+        self.disable_execution = settings.ORCHESTRATION_DISABLE_EXECUTION
+        settings.ORCHESTRATION_DISABLE_EXECUTION = True
+    
+    def tearDown(self):
+        settings.ORCHESTRATION_DISABLE_EXECUTION = self.disable_execution
+    
+    def coalesce(self, backend_cls):
+        route = Route.objects.create(backend=backend_cls.get_name(), host=self.server)
+        return CoalescedOperation.objects.create(
+            backend=backend_cls.get_name(), route=route, action=Operation.SAVE,
+            content_type=ContentType.objects.get_for_model(Server), object_id=self.server.pk,
+            due_at=timezone.now()-datetime.timedelta(seconds=1),
+        )
+    
+    def test_flushed_operations_are_deleted(self):
+        self.coalesce(DigestTestBackend)
+        manager.flush_coalesced()
+        self.assertFalse(CoalescedOperation.objects.exists())
+    
+    def test_failed_flush_is_isolated(self):
+        flushed = self.coalesce(DigestTestBackend)
+        failing = self.coalesce(FailingTestBackend)
+        logs = manager.flush_coalesced()
+        # Other windows are flushed
+        self.assertFalse(CoalescedOperation.objects.filter(pk=flushed.pk).exists())
+        # The failure is logged and the failing window released for the next flush
+        log, = logs
+        self.assertEqual(BackendLog.EXCEPTION, log.state)
+        self.assertEqual(FailingTestBackend.get_name(), log.backend)
+        self.assertIn('ValueError', log.stderr)
+        failing = CoalescedOperation.objects.get(pk=failing.pk)
+        self.assertIsNone(failing.claimed_until)
+        self.assertEqual(1, failing.attempts)
+    
+    def test_failed_flush_attempts_are_limited(self):
+        failing = self.coalesce(FailingTestBackend)
+        for attempt in range(settings.ORCHESTRATION_JOB_MAX_ATTEMPTS-1):
+            manager.flush_coalesced()
+            self.assertTrue(CoalescedOperation.objects.filter(pk=failing.pk).exists())
+        manager.flush_coalesced()
+        self.assertFalse(CoalescedOperation.objects.filter(pk=failing.pk).exists())
+        self.assertEqual(settings.ORCHESTRATION_JOB_MAX_ATTEMPTS,
+            BackendLog.objects.filter(state=BackendLog.EXCEPTION).count())
+
+
+class BackgroundGenerationTests(BackendsMixin, BaseTestCase):
+    BACKENDS = (FailingTestBackend,)
+    
+    def test_failure_ends_pending_logs(self):
+        server = Server.objects.create(name='web.example.com')
+        route = Route.objects.create(backend=FailingTestBackend.get_name(), host=server)
+        operation = Operation(FailingTestBackend, server, Operation.SAVE)
+        log = BackendLog.objects.create(backend=route.backend, server=server)
+        manager.generate_and_execute([operation], {(route, FailingTestBackend, False): log})
+        log = BackendLog.objects.get(pk=log.pk)
+        self.assertEqual(BackendLog.EXCEPTION, log.state)
+        self.assertIn('ValueError', log.stderr)
+
+
+class ExecutionSlotsTests(BaseTestCase):
+    def setUp(self):
+        self.slots_dir = settings.ORCHESTRATION_EXECUTION_SLOTS_DIR
+        settings.ORCHESTRATION_EXECUTION_SLOTS_DIR = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(settings.ORCHESTRATION_EXECUTION_SLOTS_DIR)
+        settings.ORCHESTRATION_EXECUTION_SLOTS_DIR = self.slots_dir
+    
+    def test_slots_are_exclusive(self):
+        slots = manager.ExecutionSlots('test', 2)
+        with slots.hold():
+            with slots.hold():
+                self.assertIsNone(slots.try_acquire())
+            fd = slots.try_acquire()
+            self.assertIsNotNone(fd)
+            os.close(fd)
+    
+    def test_slots_are_per_name(self):
+        with manager.ExecutionSlots('server-1', 1).hold():
+            fd = manager.ExecutionSlots('server-2', 1).try_acquire()
+            self.assertIsNotNone(fd)
+            os.close(fd)
+
+
+class TimingLog(object):
+    def __init__(self):
+        self.timings = {}
+    
+    def add_time(self, phase, start):
+        self.timings[phase] = start
+
+
+class ExecutionDispatcherTests(BaseTestCase):
+    def setUp(self):
+        self.slots_dir = settings.ORCHESTRATION_EXECUTION_SLOTS_DIR
+        self.per_server = settings.ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS_PER_SERVER
+        self.executor = manager.execution_executor
+        settings.ORCHESTRATION_EXECUTION_SLOTS_DIR = tempfile.mkdtemp()
+        settings.ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS_PER_SERVER = 1
+        manager.execution_executor = ThreadPoolExecutor(max_workers=2)
+        self.dispatcher = manager.ExecutionDispatcher()
+        self.server = AttrDict(pk=1)
+        self.other = AttrDict(pk=2)
+    
+    def tearDown(self):
+        manager.execution_executor.shutdown()
+        manager.execution_executor = self.executor
+        shutil.rmtree(settings.ORCHESTRATION_EXECUTION_SLOTS_DIR)
+        settings.ORCHESTRATION_EXECUTION_SLOTS_DIR = self.slots_dir
+        settings.ORCHESTRATION_MAX_CONCURRENT_EXECUTIONS_PER_SERVER = self.per_server
+    
+    def test_busy_server_does_not_hold_workers(self):
+        release = threading.Event()
+        running = self.dispatcher.submit(self.server, release.wait, 5)
+        queued = self.dispatcher.submit(self.server, lambda log: log, log=TimingLog())
+        # The second worker is free for the backends of other servers
+        other = self.dispatcher.submit(self.other, lambda: 'other')
+        self.assertEqual('other', other.result(timeout=5))
+        self.assertFalse(queued.done())
+        release.set()
+        self.assertTrue(running.result(timeout=5))
+        log = queued.result(timeout=5)
+        self.assertIn('wait', log.timings)
+    
+    def test_wait_time_includes_queue(self):
+        release = threading.Event()
+        self.dispatcher.submit(self.server, release.wait, 5)
+        queued = self.dispatcher.submit(self.server, lambda log: log, log=TimingLog())
+        submitted = time.time()
+        release.set()
+        log = queued.result(timeout=5)
+        self.assertLessEqual(log.timings['wait'], submitted)
+    
+    def test_slots_taken_elsewhere_are_polled(self):
+        fd = manager.ExecutionSlots.for_server(self.server).try_acquire()
+        future = self.dispatcher.submit(self.server, lambda: 'done')
+        self.assertFalse(future.done())
+        manager.ExecutionSlots.release(fd)
+        self.assertEqual('done', future.result(timeout=5))
+    
+    def test_exceptions_release_the_slot(self):
+        future = self.dispatcher.submit(self.server, int, 'invalid')
+        self.assertRaises(ValueError, future.result, 5)
+        self.assertEqual('done', self.dispatcher.submit(self.server, lambda: 'done').result(5))
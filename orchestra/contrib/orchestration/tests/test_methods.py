@@ -0,0 +1,92 @@
+import time
+
+from orchestra.utils.tests import BaseTestCase
+
+from ..methods import LogOutputBuffer, ParamikoConnectionPool
+
+
+class FakeTransport(object):
+    def __init__(self):
+        self.active = True
+    
+    def is_active(self):
+        return self.active
+
+
+class FakeSSHClient(object):
+    def __init__(self):
+        self.transport = FakeTransport()
+    
+    def get_transport(self):
+        return self.transport
+    
+    def close(self):
+        self.transport.active = False
+
+
+class FakeLog(object):
+    def __init__(self):
+        self.stdout = ''
+        self.stderr = ''
+        self.saves = 0
+    
+    def save(self, **kwargs):
+        self.saves += 1
+
+
+class FakeConnectionPool(ParamikoConnectionPool):
+    def connect(self, addr):
+        return FakeSSHClient()
+
+
+class ConnectionPoolTests(BaseTestCase):
+    def test_reuse(self):
+        pool = FakeConnectionPool()
+        ssh = pool.get('10.0.0.1')
+        pool.release('10.0.0.1', ssh)
+        self.assertIs(ssh, pool.get('10.0.0.1'))
+        self.assertEqual(1, pool.get_stats()['hits'])
+        self.assertEqual(1, pool.get_stats()['in_use'])
+    
+    def test_in_use_connections_are_not_expired(self):
+        pool = FakeConnectionPool(idle_timeout=0.01)
+        ssh = pool.get('10.0.0.1')
+        time.sleep(0.02)
+        pool.expire()
+        self.assertTrue(ssh.get_transport().is_active())
+        self.assertEqual(1, pool.get_stats()['connections'])
+        pool.release('10.0.0.1', ssh)
+        time.sleep(0.02)
+        pool.expire()
+        self.assertFalse(ssh.get_transport().is_active())
+        self.assertEqual(0, pool.get_stats()['connections'])
+    
+    def test_dead_connections_are_replaced(self):
+        pool = FakeConnectionPool()
+        ssh = pool.get('10.0.0.1')
+        ssh.close()
+        new_ssh = pool.get('10.0.0.1')
+        self.assertIsNot(ssh, new_ssh)
+        # Releasing the replaced connection does not affect the new one
+        pool.release('10.0.0.1', ssh)
+        self.assertEqual(1, pool.get_stats()['in_use'])
+
+
+class LogOutputBufferTests(BaseTestCase):
+    def test_pending_output_is_kept_on_failure(self):
+        log = FakeLog()
+        output = LogOutputBuffer(log, flush_interval=3600, flush_size=1024)
+        output.write(stdout='partial\n', stderr='error\n')
+        self.assertEqual(0, log.saves)
+        self.assertEqual('', log.stdout)
+        # What execution methods do before saving a failed log
+        output.update_log()
+        self.assertEqual('partial\n', log.stdout)
+        self.assertEqual('error\n', log.stderr)
+    
+    def test_flush_size(self):
+        log = FakeLog()
+        output = LogOutputBuffer(log, flush_interval=3600, flush_size=10)
+        output.write(stdout='0123456789')
+        self.assertEqual(1, log.saves)
+        self.assertEqual('0123456789', log.stdout)
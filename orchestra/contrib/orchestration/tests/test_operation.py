@@ -0,0 +1,73 @@
+from orchestra.utils.python import OrderedSet
+from orchestra.utils.tests import BaseTestCase
+
+from .. import backends, manager, Operation
+from ..models import Route, Server
+from . import BackendsMixin, unregister_backends
+
+
+class OperationTestBackend(backends.ServiceController):
+    verbose_name = 'Operation test'
+    model = 'orchestration.Server'
+    
+    def save(self, server):
+        pass
+    
+    def delete(self, server):
+        pass
+
+
+unregister_backends(OperationTestBackend)
+
+
+class OperationTests(BackendsMixin, BaseTestCase):
+    BACKENDS = (OperationTestBackend,)
+    
+    def setUp(self):
+        self.server = Server.objects.create(name='web.example.com')
+    
+    def test_delete_snapshot(self):
+        operation = Operation(OperationTestBackend, self.server, Operation.DELETE, preload=True)
+        self.server.delete()
+        self.assertIsNone(self.server.pk)
+        self.assertIsNot(self.server, operation.instance)
+        self.assertEqual('web.example.com', operation.instance.name)
+        self.assertIsNotNone(operation.instance.pk)
+    
+    def test_delete_is_not_preloaded_by_default(self):
+        operation = Operation(OperationTestBackend, self.server, Operation.DELETE)
+        self.assertIs(self.server, operation.instance)
+    
+    def test_create_for_action_preloads(self):
+        operations = Operation.create_for_action(self.server, Operation.DELETE)
+        self.assertTrue(operations)
+        for operation in operations:
+            self.assertIsNot(self.server, operation.instance)
+    
+    def test_routed_delete_is_preloaded(self):
+        operations = manager.collect(self.server, Operation.DELETE, operations=OrderedSet())
+        self.assertEqual(0, len(operations))
+        Route.objects.create(backend=OperationTestBackend.get_name(), host=self.server,
+            match='True')
+        operations = manager.collect(self.server, Operation.DELETE, operations=OrderedSet())
+        self.assertEqual(1, len(operations))
+        self.assertIsNot(self.server, list(operations)[0].instance)
+    
+    def test_save_is_not_copied(self):
+        operation = Operation(OperationTestBackend, self.server, Operation.SAVE)
+        self.assertIs(self.server, operation.instance)
+    
+    def test_saves_collapse(self):
+        Route.objects.create(backend=OperationTestBackend.get_name(), host=self.server,
+            match='True')
+        operations = OrderedSet()
+        manager.collect(self.server, Operation.SAVE, operations=operations)
+        self.server.name = 'web1.example.com'
+        self.server.save()
+        manager.collect(self.server, Operation.SAVE, operations=operations)
+        self.assertEqual(1, len(operations))
+        operation = list(operations)[0]
+        # Last object state
+        self.assertEqual('web1.example.com', operation.instance.name)
+        manager.collect(self.server, Operation.DELETE, operations=operations)
+        self.assertEqual([Operation.DELETE], [operation.action for operation in operations])
@@ -1,7 +1,37 @@
+from django.core.exceptions import ValidationError
+
 from orchestra.utils.tests import BaseTestCase
 
 from .. import backends, Operation
 from ..models import Route, Server
+from . import BackendsMixin, unregister_backends
+
+
+class RouteTestBackend(backends.ServiceController):
+    verbose_name = 'Route test'
+    model = 'orchestration.Server'
+    
+    def save(self, server):
+        pass
+
+
+class FilteredTestBackend(backends.ServiceController):
+    verbose_name = 'Filtered route test'
+    model = 'orchestration.Server'
+    
+    def save(self, server):
+        pass
+
+
+class ServerTestBackend(backends.ServiceController):
+    verbose_name = 'Server route test'
+    model = 'orchestration.Server'
+    
+    def save(self, server):
+        pass
+
+
+unregister_backends(RouteTestBackend, FilteredTestBackend, ServerTestBackend)
 
 
 class RouterTests(BaseTestCase):
@@ -39,3 +69,40 @@ class RouterTests(BaseTestCase):
         route = Route.objects.create(backend=backend, host=self.host2,
                 match='route.backend == "something else"')
         self.assertEqual(2, len(Route.objects.get_for_operation(operation)))
+    
+    def test_invalid_match(self):
+        backend = RouteTestBackend.get_name()
+        route = Route(backend=backend, host=self.host, match='instance.pk ==')
+        self.assertRaises(ValidationError, route.clean)
+    
+    def test_invalid_match_on_save(self):
+        backend = RouteTestBackend.get_name()
+        route = Route(backend=backend, host=self.host, match='instance.pk ==')
+        self.assertRaises(ValidationError, route.save)
+        self.assertFalse(Route.objects.filter(host=self.host).exists())
+
+
+class RouteTableTests(BackendsMixin, BaseTestCase):
+    BACKENDS = (FilteredTestBackend, ServerTestBackend)
+    
+    def setUp(self):
+        self.host = Server.objects.create(name='web.example.com')
+        self.host1 = Server.objects.create(name='web1.example.com')
+    
+    def test_filtered_get_for_operation(self):
+        backend = FilteredTestBackend.get_name()
+        Route.objects.create(backend=backend, host=self.host, match='True')
+        Route.objects.create(backend=backend, host=self.host1, match='True')
+        operation = Operation(backend=FilteredTestBackend, instance=self.host, action='save')
+        self.assertEqual(2, len(Route.objects.get_for_operation(operation)))
+        routes = Route.objects.filter(host=self.host1).get_for_operation(operation)
+        self.assertEqual([self.host1], [route.host for route in routes])
+    
+    def test_server_change_invalidates_route_table(self):
+        Route.objects.create(backend=ServerTestBackend.get_name(), host=self.host)
+        operation = Operation(backend=ServerTestBackend, instance=self.host, action='save')
+        self.assertEqual(1, len(Route.objects.get_for_operation(operation)))
+        self.host.address = '10.0.0.1'
+        self.host.save()
+        routes = Route.objects.get_for_operation(operation)
+        self.assertEqual('10.0.0.1', routes[0].host.address)
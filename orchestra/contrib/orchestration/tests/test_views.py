@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+from django.core.exceptions import PermissionDenied
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from orchestra.utils.tests import BaseTestCase
+
+from .. import settings, views
+from ..models import BackendLog, Server
+
+
+class MetricsTests(BaseTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.token = settings.ORCHESTRATION_METRICS_TOKEN
+        self.allowed_ips = settings.ORCHESTRATION_METRICS_ALLOWED_IPS
+        settings.ORCHESTRATION_METRICS_TOKEN = 'secret'
+        settings.ORCHESTRATION_METRICS_ALLOWED_IPS = ('10.0.0.1',)
+    
+    def tearDown(self):
+        settings.ORCHESTRATION_METRICS_TOKEN = self.token
+        settings.ORCHESTRATION_METRICS_ALLOWED_IPS = self.allowed_ips
+    
+    def test_authentication(self):
+        request = self.factory.get('/orchestration/metrics/')
+        self.assertRaises(PermissionDenied, views.metrics, request)
+        request = self.factory.get('/orchestration/metrics/', HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertRaises(PermissionDenied, views.metrics, request)
+        request = self.factory.get('/orchestration/metrics/', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(200, views.metrics(request).status_code)
+        request = self.factory.get('/orchestration/metrics/', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(200, views.metrics(request).status_code)
+    
+    def test_window(self):
+        server = Server.objects.create(name='web.example.com')
+        BackendLog.objects.create(backend='Apache2Backend', server=server, state=BackendLog.SUCCESS)
+        log = BackendLog.objects.create(backend='Apache2Backend', server=server,
+            state=BackendLog.FAILURE)
+        BackendLog.objects.filter(pk=log.pk).update(created_at=timezone.now()-timedelta(days=3))
+        request = self.factory.get('/orchestration/metrics/', REMOTE_ADDR='10.0.0.1')
+        metrics = views.metrics(request).content.decode()
+        self.assertIn('# TYPE orchestra_backend_executions gauge', metrics)
+        self.assertIn('state="SUCCESS"', metrics)
+        self.assertNotIn('state="FAILURE"', metrics)
+        request = self.factory.get('/orchestration/metrics/?days=7', REMOTE_ADDR='10.0.0.1')
+        self.assertIn('state="FAILURE"', views.metrics(request).content.decode())
@@ -0,0 +1,35 @@
+import hmac
+from datetime import timedelta
+
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
+from django.utils import timezone
+
+from . import settings, helpers
+from .models import BackendLog
+
+
+def is_metrics_client(request):
+    """ scrapers authenticate with ORCHESTRATION_METRICS_TOKEN or by their address """
+    if request.META.get('REMOTE_ADDR') in settings.ORCHESTRATION_METRICS_ALLOWED_IPS:
+        return True
+    token = settings.ORCHESTRATION_METRICS_TOKEN
+    if token:
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        return hmac.compare_digest(authorization.encode(), ('Bearer %s' % token).encode())
+    return False
+
+
+def render_metrics(request):
+    """ Prometheus text format of the last ORCHESTRATION_METRICS_DAYS, or ?days= """
+    days = request.GET.get('days', '')
+    days = int(days) if days.isdigit() else settings.ORCHESTRATION_METRICS_DAYS
+    logs = BackendLog.objects.filter(created_at__gte=timezone.now()-timedelta(days=days))
+    metrics = helpers.get_prometheus_metrics(logs, days)
+    return HttpResponse(metrics, content_type='text/plain; version=0.0.4')
+
+
+def metrics(request):
+    if not is_metrics_client(request):
+        raise PermissionDenied
+    return render_metrics(request)
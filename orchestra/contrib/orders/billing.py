@@ -1,65 +1,90 @@
 from django.utils.translation import ugettext_lazy as _
 
-from orchestra.contrib.bills.models import Invoice, Fee, ProForma
+from orchestra.contrib.bills.models import Invoice, Fee, ProForma, BillLine, BillSubline
+from orchestra.utils import db
 
 
 class BillsBackend(object):
     def create_bills(self, account, lines, **options):
-        bill = None
-        ant_bill = None
-        bills = []
+        return self.bulk_create_bills([(account, lines)], **options)
+    
+    def bulk_create_bills(self, accounts_lines, **options):
+        """
+        creates the bills of [(account, lines)]
+        bill lines and sublines are created in bulk, bills one by one since their number is
+        sequential and bulk_create() does not return their primary keys
+        """
         create_new = options.get('new_open', False)
         proforma = options.get('proforma', False)
-        for line in lines:
-            quantity = line.metric*line.size
-            if quantity == 0:
-                continue
-            service = line.order.service
-            # Create bill if needed
-            if proforma:
-                if ant_bill is None:
-                    if create_new:
-                        bill = ProForma.objects.create(account=account)
-                    else:
-                        bill = ProForma.objects.filter(account=account, is_open=True).last()
-                        if not bill:
-                            bill = ProForma.objects.create(account=account, is_open=True)
+        bill_class = ProForma if proforma else Invoice
+        open_bills = {}
+        if not create_new:
+            accounts = [account for account, lines in accounts_lines]
+            open_qs = bill_class.objects.filter(account__in=accounts, is_open=True).order_by('id')
+            for bill in open_qs:
+                open_bills[bill.account_id] = bill
+        bills = []
+        bill_lines = []
+        for account, lines in accounts_lines:
+            ant_bill = None
+            for line in lines:
+                quantity = line.metric*line.size
+                if quantity == 0:
+                    continue
+                service = line.order.service
+                # Create bill if needed
+                if service.is_fee and not proforma:
+                    bill = Fee.objects.create(account=account)
                     bills.append(bill)
                 else:
-                    bill = ant_bill
-                ant_bill = bill
-            elif service.is_fee:
-                bill = Fee.objects.create(account=account)
-                bills.append(bill)
-            else:
-                if ant_bill is None:
-                    if create_new:
-                        bill = Invoice.objects.create(account=account)
+                    if ant_bill is None:
+                        bill = open_bills.get(account.pk)
+                        if bill is None:
+                            bill = bill_class.objects.create(account=account, is_open=True)
+                        bills.append(bill)
                     else:
-                        bill = Invoice.objects.filter(account=account, is_open=True).last()
-                        if not bill:
-                            bill = Invoice.objects.create(account=account, is_open=True)
-                    bills.append(bill)
-                else:
-                    bill = ant_bill
-                ant_bill = bill
-            # Create bill line
-            billine = bill.lines.create(
-                rate=service.nominal_price,
-                quantity=line.metric*line.size,
-                verbose_quantity=self.get_verbose_quantity(line),
-                subtotal=line.subtotal,
-                tax=service.tax,
-                description=self.get_line_description(line),
-                start_on=line.ini,
-                end_on=line.end if service.billing_period != service.NEVER else None,
-                order=line.order,
-                order_billed_on=line.order.old_billed_on,
-                order_billed_until=line.order.old_billed_until
-            )
-            self.create_sublines(billine, line.discounts)
+                        bill = ant_bill
+                    ant_bill = bill
+                billine = BillLine(
+                    bill=bill,
+                    rate=service.nominal_price,
+                    quantity=quantity,
+                    verbose_quantity=self.get_verbose_quantity(line),
+                    subtotal=line.subtotal,
+                    tax=service.tax,
+                    description=self.get_line_description(line),
+                    start_on=line.ini,
+                    end_on=line.end if service.billing_period != service.NEVER else None,
+                    order=line.order,
+                    order_billed_on=line.order.old_billed_on,
+                    order_billed_until=line.order.old_billed_until
+                )
+                bill_lines.append((billine, line.discounts))
+        self.bulk_create_lines(bill_lines)
         return bills
     
+    def bulk_create_lines(self, lines):
+        """ lines: [(BillLine, discounts)] """
+        if not lines:
+            return
+        pks = db.allocate_pks(BillLine, len(lines))
+        if pks:
+            for (billine, discounts), pk in zip(lines, pks):
+                billine.pk = pk
+            BillLine.objects.bulk_create([billine for billine, discounts in lines])
+        else:
+            # Sublines need the pk of their line
+            BillLine.objects.bulk_create([
+                billine for billine, discounts in lines if not discounts
+            ])
+            for billine, discounts in lines:
+                if discounts:
+                    billine.save()
+        sublines = []
+        for billine, discounts in lines:
+            sublines.extend(self.get_sublines(billine, discounts))
+        BillSubline.objects.bulk_create(sublines)
+    
 #    def format_period(self, ini, end):
 #        ini = ini.strftime("%b, %Y")
 #        end = (end-datetime.timedelta(seconds=1)).strftime("%b, %Y")
@@ -88,10 +113,12 @@ class BillsBackend(object):
         return "%s&times;%s" % (metric, size)
 #        return ''
     
-    def create_sublines(self, line, discounts):
-        for discount in discounts:
-            line.sublines.create(
+    def get_sublines(self, line, discounts):
+        return [
+            BillSubline(
+                line=line,
                 description=_("Discount per %s") % discount.type.lower(),
                 total=discount.total,
                 type=discount.type,
-            )
+            ) for discount in discounts
+        ]
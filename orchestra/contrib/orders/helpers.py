@@ -1,7 +1,12 @@
+import multiprocessing
+
+from django import db
 from django.core.exceptions import ObjectDoesNotExist
 
 from orchestra.core import services
 
+from . import settings
+
 
 def get_related_object(origin, max_depth=2):
     """
@@ -37,3 +42,100 @@ def get_related_object(origin, max_depth=2):
                 new_models = list(models)
                 new_models.append(related)
                 queue.append(new_models)
+
+
+def shard_orders(queryset, num):
+    """ splits the orders into num shards of whole accounts, balanced by number of orders """
+    accounts = {}
+    for account_id, order_id in queryset.values_list('account_id', 'id'):
+        accounts.setdefault(account_id, []).append(order_id)
+    shards = [[] for ix in range(min(num, len(accounts)))]
+    # Largest accounts go first to the least loaded shard
+    for order_ids in sorted(accounts.values(), key=len, reverse=True):
+        min(shards, key=len).extend(order_ids)
+    return shards
+
+
+def get_projection(account, lines):
+    """ plain data revenue forecast of the bill lines of an account """
+    total = 0
+    projection = []
+    for line in lines:
+        discounts = [(discount.type, discount.total) for discount in line.discounts]
+        subtotal = line.subtotal + sum([total for type, total in discounts])
+        total += subtotal
+        projection.append({
+            'order': line.order.pk,
+            'service': str(line.order.service),
+            'description': line.order.description,
+            'ini': line.ini,
+            'end': line.end,
+            'size': line.size,
+            'metric': line.metric,
+            'subtotal': line.subtotal,
+            'discounts': discounts,
+            'total': subtotal,
+        })
+    return {
+        'account': account.pk,
+        'account_name': str(account),
+        'total': total,
+        'lines': projection,
+    }
+
+
+_bill_lock = None
+
+
+def _init_bill_worker(lock):
+    global _bill_lock
+    _bill_lock = lock
+
+
+def _bill_shard(args):
+    """ bills a shard of orders on a pool process, with its own database connection """
+    from .models import Order
+    order_ids, options = args
+    queryset = Order.objects.filter(pk__in=order_ids)
+    try:
+        if options.get('commit', True):
+            return [bill.pk for bill in queryset.bill(lock=_bill_lock, **options)]
+        return [get_projection(account, lines) for account, lines in queryset.bill(**options)]
+    finally:
+        db.connection.close()
+
+
+def bill_in_parallel(queryset, processes=None, **options):
+    """
+    bills the orders sharding their accounts across a pool of processes
+    
+    commit=True: returns the created bills
+    commit=False: returns the projection of every account without writing, see get_projection()
+    """
+    from orchestra.contrib.bills.models import Bill
+    if processes is None:
+        processes = settings.ORDERS_BILLING_PROCESSES
+    processes = processes or multiprocessing.cpu_count()
+    commit = options.get('commit', True)
+    shards = shard_orders(queryset, processes)
+    if len(shards) < 2 or db.connection.in_atomic_block:
+        # Workers can not join an ongoing transaction
+        results = queryset.bill(**options)
+        if commit:
+            return results
+        results = [get_projection(account, lines) for account, lines in results]
+        return sorted(results, key=lambda projection: -projection['total'])
+    # Forked processes must not share the parent connections
+    for connection in db.connections.all():
+        connection.close()
+    lock = multiprocessing.Lock()
+    pool = multiprocessing.Pool(len(shards), initializer=_init_bill_worker, initargs=(lock,))
+    try:
+        results = pool.map(_bill_shard, [(shard, options) for shard in shards], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    results = [item for result in results for item in result]
+    if commit:
+        return list(Bill.objects.filter(pk__in=results))
+    return sorted(results, key=lambda projection: -projection['total'])
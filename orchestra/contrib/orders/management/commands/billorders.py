@@ -0,0 +1,65 @@
+import json
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from orchestra.contrib.orders.helpers import bill_in_parallel
+from orchestra.contrib.orders.models import Order
+
+
+class Command(BaseCommand):
+    help = ('Bills the pending orders, sharding the accounts across a pool of processes. '
+            'With --dry-run the revenue of every account is projected without writing.')
+    
+    def add_arguments(self, parser):
+        parser.add_argument('query', nargs='*',
+            help='Query arguments for filtering the orders, i.e. account__username=orchestra.')
+        parser.add_argument('--processes', dest='processes', type=int, default=None,
+            help='Number of billing processes, defaults to ORDERS_BILLING_PROCESSES.')
+        parser.add_argument('--billing-point', dest='billing_point', default='',
+            help='Date until the orders are billed (YYYY-MM-DD), defaults to today.')
+        parser.add_argument('--fixed-point', action='store_true', dest='fixed_point',
+            default=False, help='Bills until the billing point instead of the next period.')
+        parser.add_argument('--proforma', action='store_true', dest='proforma', default=False,
+            help='Creates pro forma bills, orders are not marked as billed.')
+        parser.add_argument('--new-open', action='store_true', dest='new_open', default=False,
+            help='Creates new open bills instead of using the existing ones.')
+        parser.add_argument('--dry-run', action='store_true', dest='dry', default=False,
+            help='Only projects the bills, nothing is written.')
+        parser.add_argument('--json', action='store_true', dest='json', default=False,
+            help='Prints the projection as JSON.')
+    
+    def handle(self, *args, **options):
+        kwargs = {}
+        for comp in options.get('query', []):
+            try:
+                arg, value = comp.split('=', 1)
+            except ValueError:
+                raise CommandError("Invalid query argument '%s'." % comp)
+            kwargs[arg] = value
+        billing_point = None
+        if options.get('billing_point'):
+            try:
+                billing_point = datetime.strptime(options['billing_point'], '%Y-%m-%d').date()
+            except ValueError as exc:
+                raise CommandError(str(exc))
+        dry = options.get('dry')
+        queryset = Order.objects.filter(ignore=False, **kwargs)
+        result = bill_in_parallel(queryset, processes=options.get('processes'),
+            billing_point=billing_point,
+            fixed_point=options.get('fixed_point'),
+            proforma=options.get('proforma'),
+            new_open=options.get('new_open'),
+            commit=not dry)
+        if not dry:
+            self.stdout.write('%i bills have been created' % len(result))
+        elif options.get('json'):
+            self.stdout.write(json.dumps(result, indent=4, cls=DjangoJSONEncoder))
+        else:
+            total = 0
+            for projection in result:
+                total += projection['total']
+                self.stdout.write('%-32s %12.2f %6i lines' % (projection['account_name'],
+                    projection['total'], len(projection['lines'])))
+            self.stdout.write('%i accounts, %.2f total' % (len(result), total))
@@ -1,8 +1,10 @@
+import bisect
 import datetime
 import decimal
 import logging
 
-from django.db import models
+from django.conf import settings as djsettings
+from django.db import models, transaction
 from django.db.models import F, Q, Sum
 from django.apps import apps
 from django.contrib.contenttypes.fields import GenericForeignKey
@@ -12,6 +14,7 @@ from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from orchestra.models import queryset
+from orchestra.utils import db
 from orchestra.utils.python import import_class
 
 from . import settings
@@ -23,29 +26,59 @@ logger = logging.getLogger(__name__)
 class OrderQuerySet(models.QuerySet):
     group_by = queryset.group_by
     
-    def bill(self, **options):
+    def bill(self, lock=None, **options):
+        """
+        bills the orders of all accounts in a single transaction
+        bill lines are generated in memory and persisted in bulk, together with the orders
+        
+        lock: acquired before creating the bills and released once committed, for concurrent
+            billing processes, since bill numbers are sequential
+        """
         bills = []
         bill_backend = Order.get_bill_backend()
         qs = self.select_related('account', 'service')
         commit = options.get('commit', True)
-        for account, services in qs.group_by('account', 'service').items():
-            bill_lines = []
-            for service, orders in services.items():
-                for order in orders:
-                    # Saved for undoing support
-                    order.old_billed_on = order.billed_on
-                    order.old_billed_until = order.billed_until
-                lines = service.handler.generate_bill_lines(orders, account, **options)
-                bill_lines.extend(lines)
-            # TODO make this consistent always returning the same fucking types
-            if commit:
-                bills += bill_backend.create_bills(account, bill_lines, **options)
-            else:
-                bills += [(account, bill_lines)]
-        # TODO remove if commit and always return unique elemenets (set()) when the other todo is fixed
         if commit:
-            return list(set(bills))
-        return bills
+            # Updated in bulk by a single query, see ServiceHandler.generate_bill_lines()
+            options['billed_orders'] = billed_orders = []
+        locked = False
+        try:
+            with transaction.atomic():
+                accounts_lines = []
+                grouped = qs.group_by('account', 'service')
+                # Metric history of all the orders on a single query, see Order.get_metric()
+                MetricStorage.objects.prefetch_timelines([
+                    order for services in grouped.values()
+                        for service, orders in services.items() if service.metric
+                            for order in orders
+                ])
+                for account, services in grouped.items():
+                    bill_lines = []
+                    for service, orders in services.items():
+                        for order in orders:
+                            # Saved for undoing support
+                            order.old_billed_on = order.billed_on
+                            order.old_billed_until = order.billed_until
+                        lines = service.handler.generate_bill_lines(orders, account, **options)
+                        bill_lines.extend(lines)
+                    accounts_lines.append((account, bill_lines))
+                if not commit:
+                    # TODO make this consistent always returning the same fucking types
+                    return accounts_lines
+                db.bulk_update(billed_orders, ('billed_on', 'billed_until', 'billed_metric'))
+                if lock is not None:
+                    lock.acquire()
+                    locked = True
+                if hasattr(bill_backend, 'bulk_create_bills'):
+                    bills = bill_backend.bulk_create_bills(accounts_lines, **options)
+                else:
+                    for account, bill_lines in accounts_lines:
+                        bills += bill_backend.create_bills(account, bill_lines, **options)
+        finally:
+            if locked:
+                lock.release()
+        # TODO always return unique elemenets (set()) when the other todo is fixed
+        return list(set(bills))
     
     def givers(self, ini, end):
         return self.cancelled_and_billed().filter(billed_until__gt=ini, registered_on__lt=end)
@@ -228,6 +261,15 @@ class Order(models.Model):
         self.save(update_fields=['ignore'])
     
     def get_metric(self, *args, **kwargs):
+        """
+        get_metric(): latest metric
+        get_metric(date): metric on effect on date
+        get_metric(ini, end): latest metric of the slot
+        get_metric(ini, end, changes=True): [(ini, end, metric)] changes within the interval
+        """
+        timeline = getattr(self, 'metric_timeline', None)
+        if timeline is not None:
+            return timeline.get_metric(*args, **kwargs)
         if kwargs.pop('changes', False):
             ini, end = args
             result = []
@@ -267,7 +309,114 @@ class Order(models.Model):
             return decimal.Decimal(0)
 
 
+class MetricTimeline(object):
+    """
+    In-memory metric history of an order, answers Order.get_metric() queries with binary
+    search instead of hitting the database
+    """
+    def __init__(self, metrics):
+        # Sorted by creation, with the running latest update for 'latest on or before' queries
+        self.metrics = sorted(metrics, key=lambda metric: (metric.created_on, metric.id))
+        self.created = [metric.created_on for metric in self.metrics]
+        self.latest = []
+        latest = None
+        for metric in self.metrics:
+            if latest is None or metric.updated_on >= latest.updated_on:
+                latest = metric
+            self.latest.append(latest)
+        # Metric changes are computed by id order, usually the same as the creation order
+        self.by_id = sorted(self.metrics, key=lambda metric: metric.id)
+        self.is_monotonic = self.by_id == self.metrics
+    
+    @staticmethod
+    def as_date(value):
+        if isinstance(value, datetime.datetime):
+            if timezone.is_aware(value):
+                value = timezone.localtime(value)
+            return value.date()
+        return value
+    
+    @staticmethod
+    def as_datetime(value):
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime(year=value.year, month=value.month, day=value.day)
+        if djsettings.USE_TZ and timezone.is_naive(value):
+            value = timezone.make_aware(value, timezone.get_default_timezone())
+        return value
+    
+    def created_before(self, date, inclusive=False):
+        """ latest updated metric created before date """
+        date = self.as_date(date)
+        if inclusive:
+            ix = bisect.bisect_right(self.created, date)
+        else:
+            ix = bisect.bisect_left(self.created, date)
+        if ix:
+            return self.latest[ix-1]
+    
+    def get_changes(self, ini, end):
+        end = self.as_date(end)
+        if self.is_monotonic:
+            metrics = self.metrics[:bisect.bisect_left(self.created, end)]
+        else:
+            metrics = [metric for metric in self.by_id if metric.created_on < end]
+        if not metrics:
+            raise ValueError("Metric storage information is inconsistent.")
+        result = []
+        prev = None
+        for metric in metrics:
+            created = metric.created_on
+            if created > ini:
+                if prev is None:
+                    raise ValueError("Metric storage information is inconsistent.")
+                cini = prev.created_on
+                if not result:
+                    cini = ini
+                result.append((cini, created, prev.value))
+            prev = metric
+        if created < end:
+            result.append((created, end, metric.value))
+        return result
+    
+    def get_metric(self, *args, **kwargs):
+        if kwargs.pop('changes', False):
+            return self.get_changes(*args)
+        if kwargs:
+            raise AttributeError
+        if len(args) == 2:
+            # Slot
+            ini, end = args
+            metric = self.created_before(end)
+            if metric is not None and metric.updated_on >= self.as_datetime(ini):
+                return metric.value
+        elif len(args) == 1:
+            # On effect on date
+            date = args[0]
+            date = datetime.date(year=date.year, month=date.month, day=date.day)
+            date += datetime.timedelta(days=1)
+            metric = self.created_before(date, inclusive=True)
+            if metric is not None:
+                return metric.value
+        elif not args:
+            if not self.metrics:
+                raise MetricStorage.DoesNotExist("MetricStorage matching query does not exist.")
+            return self.latest[-1].value
+        else:
+            raise AttributeError
+        return decimal.Decimal(0)
+
+
 class MetricStorageQuerySet(models.QuerySet):
+    def prefetch_timelines(self, orders):
+        """ loads the metrics of orders in a single query, attaching their timeline """
+        if not orders:
+            return
+        metrics = {}
+        for metric in self.filter(order__in=orders):
+            metrics.setdefault(metric.order_id, []).append(metric)
+        for order in orders:
+            order.metric_timeline = MetricTimeline(metrics.get(order.pk, []))
+    
     def store(self, order, value):
         now = timezone.now()
         try:
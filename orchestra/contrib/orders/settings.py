@@ -42,3 +42,10 @@ ORDERS_BILLED_METRIC_CLEANUP_DAYS = Setting('ORDERS_BILLED_METRIC_CLEANUP_DAYS',
     40,
     help_text=("Number of days after a billed stored metric is deleted."),
 )
+
+
+ORDERS_BILLING_PROCESSES = Setting('ORDERS_BILLING_PROCESSES',
+    0,
+    help_text=("Number of processes billing accounts in parallel, "
+               "<tt>0</tt> for one per CPU and <tt>1</tt> for billing serially."),
+)
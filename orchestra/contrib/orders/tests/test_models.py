@@ -0,0 +1,231 @@
+import datetime
+import decimal
+import random
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.contrib.accounts.models import Account
+from orchestra.contrib.services.models import Service
+from orchestra.utils.python import AttrDict
+from orchestra.utils.tests import BaseTestCase
+
+from ..billing import BillsBackend
+from ..models import MetricStorage, MetricTimeline, Order
+
+
+def as_datetime(date):
+    """ DateTimeField lookups with a date, midnight on the default timezone """
+    date = datetime.datetime.combine(date, datetime.time.min)
+    return timezone.make_aware(date, timezone.get_default_timezone())
+
+
+def latest_values(metrics):
+    """ values of the latest('updated_on') candidates, any of them on ties """
+    if not metrics:
+        return {decimal.Decimal(0)}
+    updated_on = max(metric.updated_on for metric in metrics)
+    return {metric.value for metric in metrics if metric.updated_on == updated_on}
+
+
+def get_metric(metrics, *args):
+    """ Order.get_metric() queries on a list of metrics, used as reference """
+    if len(args) == 2:
+        ini, end = args
+        return latest_values([
+            metric for metric in metrics
+                if metric.created_on < end and metric.updated_on >= as_datetime(ini)
+        ])
+    elif len(args) == 1:
+        date = args[0] + datetime.timedelta(days=1)
+        return latest_values([metric for metric in metrics if metric.created_on <= date])
+    return latest_values(metrics)
+
+
+def get_changes(metrics, ini, end):
+    """ Order.get_metric(changes=True) on a list of metrics, used as reference """
+    result = []
+    prev = None
+    for metric in sorted(metrics, key=lambda metric: metric.id):
+        if metric.created_on >= end:
+            continue
+        created = metric.created_on
+        if created > ini:
+            if prev is None:
+                raise ValueError("Metric storage information is inconsistent.")
+            cini = prev.created_on
+            if not result:
+                cini = ini
+            result.append((cini, created, prev.value))
+        prev = metric
+    if created < end:
+        result.append((created, end, metric.value))
+    return result
+
+
+def create_order(account):
+    service = Service.objects.create(
+        description="Service %i" % Service.objects.count(),
+        content_type=ContentType.objects.get_for_model(Account),
+        nominal_price=10,
+    )
+    return Order.objects.create(
+        account=account,
+        content_type=service.content_type,
+        object_id=account.pk,
+        service=service,
+    )
+
+
+class BillsBackendTests(BaseTestCase):
+    DEPENDENCIES = (
+        'orchestra.contrib.services',
+        'orchestra.contrib.bills',
+    )
+    
+    def get_lines(self, account):
+        order = create_order(account)
+        order.old_billed_on = order.billed_on
+        order.old_billed_until = order.billed_until
+        ini = timezone.now().date()
+        return [AttrDict(
+            order=order,
+            metric=1,
+            size=1,
+            subtotal=10,
+            discounts=[],
+            ini=ini,
+            end=ini + datetime.timedelta(days=30),
+        )]
+    
+    def test_open_bill(self):
+        account = self.create_account()
+        backend = BillsBackend()
+        bill, = backend.create_bills(account, self.get_lines(account))
+        self.assertTrue(bill.is_open)
+        # Reused by the next billing run
+        self.assertEqual([bill], backend.create_bills(account, self.get_lines(account)))
+        self.assertEqual(2, bill.lines.count())
+    
+    def test_new_open(self):
+        account = self.create_account()
+        backend = BillsBackend()
+        open_bill, = backend.create_bills(account, self.get_lines(account))
+        bill, = backend.create_bills(account, self.get_lines(account), new_open=True)
+        # The existing open bill is not reused, the new one is also open
+        self.assertNotEqual(open_bill, bill)
+        self.assertTrue(bill.is_open)
+        self.assertEqual(1, bill.lines.count())
+        self.assertEqual(1, open_bill.lines.count())
+        self.assertEqual(2, type(bill).objects.filter(account=account, is_open=True).count())
+
+
+class MetricTimelineTests(BaseTestCase):
+    """ Equivalence of MetricTimeline against the Order.get_metric() queryset path """
+    DEPENDENCIES = (
+        'orchestra.contrib.services',
+    )
+    EXAMPLES = 300
+    
+    def setUp(self):
+        super(MetricTimelineTests, self).setUp()
+        self.random = random.Random(0)
+        self.today = timezone.now().date()
+    
+    def date(self, days):
+        return self.today + datetime.timedelta(days=days)
+    
+    def random_metrics(self, monotonic=True):
+        metrics = []
+        ids = list(range(1, self.random.randint(1, 15)+1))
+        if not monotonic:
+            self.random.shuffle(ids)
+        for metric_id in ids:
+            created_on = self.date(self.random.randint(0, 20))
+            # Few distinct times, same day updates tie
+            updated_on = created_on + datetime.timedelta(days=self.random.randint(0, 3))
+            updated_on = as_datetime(updated_on)
+            updated_on += datetime.timedelta(hours=self.random.choice((0, 12)))
+            metrics.append(AttrDict(
+                id=metric_id,
+                created_on=created_on,
+                updated_on=updated_on,
+                value=decimal.Decimal(self.random.randint(0, 100)),
+            ))
+        return metrics
+    
+    def random_slot(self, metrics):
+        """ slot boundaries on metric dates, as well as in between """
+        dates = [metric.created_on for metric in metrics]
+        dates += [metric.updated_on.date() for metric in metrics]
+        dates.append(self.date(self.random.randint(-2, 25)))
+        ini = self.random.choice(dates)
+        end = self.random.choice(dates)
+        if end <= ini:
+            end = ini + datetime.timedelta(days=self.random.randint(1, 5))
+        return ini, end
+    
+    def store(self, order, metrics):
+        """ stores metrics in id order, keeping non-monotonic ids """
+        for metric in sorted(metrics, key=lambda metric: metric.id):
+            stored = MetricStorage.objects.create(
+                order=order, value=metric.value, updated_on=metric.updated_on)
+            # created_on is auto_now_add
+            MetricStorage.objects.filter(pk=stored.pk).update(created_on=metric.created_on)
+        return list(order.metrics.all())
+    
+    def assertEquivalent(self, metrics, order=None):
+        """ timeline (and order queryset path) answers are within the reference candidates """
+        timeline = MetricTimeline(metrics)
+        paths = [timeline.get_metric]
+        if order is not None:
+            paths.append(order.get_metric)
+        if metrics:
+            for path in paths:
+                self.assertIn(path(), get_metric(metrics))
+        for __ in range(10):
+            ini, end = self.random_slot(metrics)
+            for path in paths:
+                self.assertIn(path(ini, end), get_metric(metrics, ini, end))
+                self.assertIn(path(ini), get_metric(metrics, ini))
+                self.assertIn(path(end), get_metric(metrics, end))
+            if not any(metric.created_on < end for metric in metrics):
+                continue
+            try:
+                expected = get_changes(metrics, ini, end)
+            except ValueError:
+                for path in paths:
+                    self.assertRaises(ValueError, path, ini, end, changes=True)
+            else:
+                for path in paths:
+                    self.assertEqual(expected, path(ini, end, changes=True))
+    
+    def test_get_metric(self):
+        for example in range(self.EXAMPLES):
+            self.assertEquivalent(self.random_metrics(monotonic=example % 2))
+    
+    def test_queryset_path(self):
+        for example in range(20):
+            order = create_order(self.create_account())
+            metrics = self.store(order, self.random_metrics(monotonic=example % 2))
+            self.assertEquivalent(metrics, order=order)
+    
+    def test_same_day_updates(self):
+        # Same updated_on, the queryset path may return any of them
+        updated_on = as_datetime(self.date(1))
+        metrics = [
+            AttrDict(id=1, created_on=self.date(0), updated_on=updated_on, value=1),
+            AttrDict(id=2, created_on=self.date(1), updated_on=updated_on, value=2),
+        ]
+        timeline = MetricTimeline(metrics)
+        self.assertIn(timeline.get_metric(), (1, 2))
+        self.assertIn(timeline.get_metric(self.date(0), self.date(2)), (1, 2))
+        # Slot boundaries: created_on < end and updated_on >= ini
+        self.assertEqual(1, timeline.get_metric(self.date(1), self.date(1)))
+        self.assertEqual(0, timeline.get_metric(self.date(2), self.date(3)))
+    
+    def test_empty(self):
+        timeline = MetricTimeline([])
+        self.assertRaises(MetricStorage.DoesNotExist, timeline.get_metric)
+        self.assertEqual(0, timeline.get_metric(self.today))
+        self.assertEqual(0, timeline.get_metric(self.today, self.date(1)))
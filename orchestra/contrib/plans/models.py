@@ -3,6 +3,8 @@ from functools import lru_cache
 from django.core.validators import ValidationError
 from django.db import models
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
@@ -11,6 +13,7 @@ from orchestra.models import queryset
 from orchestra.utils.python import import_class
 
 from . import settings
+from .ratings import rating_tables
 
 
 class Plan(models.Model):
@@ -100,3 +103,20 @@ class Rate(models.Model):
     @classmethod
     def get_default(cls):
         return settings.PLANS_DEFAULT_RATE_METHOD
+    
+    @classmethod
+    def get_rating_table(cls, service, rates):
+        """ compiled pricing function of service for rates, cached by the process """
+        return rating_tables.get(service, rates)
+
+
+@receiver(post_save, sender=Rate, dispatch_uid='plans.invalidate_rating_tables.rate_save')
+@receiver(post_delete, sender=Rate, dispatch_uid='plans.invalidate_rating_tables.rate_delete')
+@receiver(post_save, sender=Plan, dispatch_uid='plans.invalidate_rating_tables.plan_save')
+@receiver(post_delete, sender=Plan, dispatch_uid='plans.invalidate_rating_tables.plan_delete')
+@receiver(post_save, sender=ContractedPlan,
+    dispatch_uid='plans.invalidate_rating_tables.contract_save')
+@receiver(post_delete, sender=ContractedPlan,
+    dispatch_uid='plans.invalidate_rating_tables.contract_delete')
+def invalidate_rating_tables(sender, **kwargs):
+    rating_tables.invalidate()
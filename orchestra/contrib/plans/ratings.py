@@ -1,9 +1,17 @@
+import bisect
+import decimal
 import sys
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 
 from django.utils.translation import ugettext_lazy as _
 
+from orchestra.models.queryset import group_by
 from orchestra.utils.python import AttrDict
 
+from . import settings
+
 
 def _compute_steps(rates, metric):
     value = 0
@@ -64,14 +72,133 @@ def _standardize(rates):
     return std_rates
 
 
-def step_price(rates, metric):
-    if rates.query.order_by != ['plan', 'quantity']:
+def _check_order(rates):
+    if hasattr(rates, 'query') and rates.query.order_by != ['plan', 'quantity']:
         raise ValueError("rates queryset should be ordered by 'plan' and 'quantity'")
+
+
+def _get_plans(rates):
+    """ [(plan, standardized rates)] """
+    if isinstance(rates, CompiledRates):
+        return rates.plans
+    _check_order(rates)
+    return [(plan, _standardize(plan_rates)) for plan, plan_rates in group_by(rates, 'plan').items()]
+
+
+def _get_distinct(rates):
+    """ standardized rates without the duplicates of multiple contractions """
+    if isinstance(rates, CompiledRates):
+        return rates.distinct
+    _check_order(rates)
+    if hasattr(rates, 'distinct'):
+        return _standardize(rates.distinct())
+    return _standardize(list(OrderedDict((rate.pk, rate) for rate in rates).values()))
+
+
+class CompiledRates(tuple):
+    """
+    Evaluated rates ordered by plan and quantity, standardized once instead of on every metric
+    """
+    def __new__(cls, rates):
+        _check_order(rates)
+        return super(CompiledRates, cls).__new__(cls, rates)
+    
+    def __init__(self, rates):
+        self.plans = _get_plans(list(self))
+        self.distinct = _get_distinct(list(self)) if self else []
+
+
+class StepFunction(object):
+    """ accumulated price of positions whose price does not depend on the metric """
+    def __init__(self, steps):
+        counters = []
+        prices = []
+        accumulated = []
+        counter = 0
+        total = 0
+        for step in steps:
+            accumulated.append(total)
+            counter += step['quantity']
+            counters.append(counter)
+            prices.append(step['price'])
+            total += step['price'] * step['quantity']
+        # The last step is open-ended
+        counters[-1] = float('inf')
+        self.counters = tuple(counters)
+        self.prices = tuple(prices)
+        self.accumulated = tuple(accumulated)
+    
+    def get_price(self, metric, position=None):
+        if position is None:
+            ix = bisect.bisect_left(self.counters, metric)
+            ant_counter = self.counters[ix-1] if ix else 0
+            return self.accumulated[ix] + (metric - ant_counter) * self.prices[ix]
+        return self.prices[bisect.bisect_left(self.counters, position)]
+
+
+class MinimalFunction(tuple):
+    """ price of the cheapest plan for the metric, None if there is none """
+    def get_price(self, metric, position=None):
+        minimal = (sys.maxsize, None)
+        for function in self:
+            value = function.get_price(metric)
+            if value < minimal[0]:
+                minimal = (value, function)
+        value, function = minimal
+        if function is None:
+            return None
+        if position is None:
+            return value
+        return function.get_price(metric, position)
+
+
+class MatchFunction(object):
+    """ all positions at the unit price of the last breakpoint reached by the metric """
+    def __init__(self, breakpoints, prices):
+        self.breakpoints = tuple(breakpoints)
+        self.prices = tuple(prices)
+    
+    def get_price(self, metric, position=None):
+        ix = bisect.bisect_right(self.breakpoints, metric) - 1
+        if ix < 0 or self.prices[ix] is None:
+            return None
+        if position is None:
+            return metric * self.prices[ix]
+        return self.prices[ix]
+
+
+def compile_step_price(rates):
+    """
+    Steps of a plan are taken in order, so the steps for any metric are a prefix of
+    the steps for an unbounded one. Merging combinable plans does not hold that property.
+    """
+    plans = _get_plans(rates)
+    if len(plans) > 1 and any(plan.is_combinable for plan, __ in plans):
+        return None
+    functions = []
+    for plan, plan_rates in plans:
+        value, steps = _compute_steps(plan_rates, sys.maxsize)
+        if any(step.quantity < 0 for step in steps):
+            return None
+        functions.append(StepFunction(steps))
+    return MinimalFunction(functions)
+
+
+def compile_match_price(rates):
+    """ the matching rate only changes when the metric reaches a rate quantity """
+    breakpoints = sorted(set(rate.quantity for rate in _get_distinct(rates)))
+    prices = []
+    for quantity in breakpoints:
+        steps = match_price(rates, quantity)
+        prices.append(steps[0].price if steps else None)
+    return MatchFunction(breakpoints, prices)
+
+
+def step_price(rates, metric):
     # Step price
     group = []
     minimal = (sys.maxsize, [])
-    for plan, rates in rates.group_by('plan').items():
-        rates = _standardize(rates)
+    for plan, rates in _get_plans(rates):
         value, steps = _compute_steps(rates, metric)
         if plan.is_combinable:
             group.append(steps)
@@ -122,17 +249,17 @@ def step_price(rates, metric):
         minimal = min(minimal, (value, result), key=lambda v: v[0])
     return minimal[1]
 step_price.verbose_name = _("Step price")
+step_price.accepts_compiled = True
+step_price.compile = compile_step_price
 step_price.help_text = _("All rates with a quantity lower or equal than the metric are applied. "
                          "Nominal price will be used when initial block is missing.")
 
 
 def match_price(rates, metric):
-    if rates.query.order_by != ['plan', 'quantity']:
-        raise ValueError("rates queryset should be ordered by 'plan' and 'quantity'")
     candidates = []
     selected = False
     prev = None
-    rates = _standardize(rates.distinct())
+    rates = _get_distinct(rates)
     for rate in rates:
         if prev:
             if prev.plan != rate.plan:
@@ -154,16 +281,15 @@ def match_price(rates, metric):
         })]
     return None
 match_price.verbose_name = _("Match price")
+match_price.accepts_compiled = True
+match_price.compile = compile_match_price
 match_price.help_text = _("Only <b>the rate</b> with a) inmediate inferior metric and b) lower price is applied. "
                           "Nominal price will be used when initial block is missing.")
 
 
 def best_price(rates, metric):
-    if rates.query.order_by != ['plan', 'quantity']:
-        raise ValueError("rates queryset should be ordered by 'plan' and 'quantity'")
     candidates = []
-    for plan, rates in rates.group_by('plan').items():
-        rates = _standardize(rates)
+    for plan, rates in _get_plans(rates):
         plan_candidates = []
         for rate in rates:
             if rate.quantity > metric:
@@ -209,4 +335,135 @@ def best_price(rates, metric):
                 }))
     return results
 best_price.verbose_name = _("Best price")
+best_price.accepts_compiled = True
 best_price.help_text = _("Produces the best possible price given all active rating lines (those with quantity lower or equal to the metric).")
+
+
+class RatingTable(object):
+    """
+    Immutable pricing function of a service for a set of rates
+    
+    Methods providing a compile function are compiled once into breakpoints, so the
+    accumulated price of a metric and the price of a position are bisections. The result
+    of other methods (best_price, merged combinable plans) is memoised per metric.
+    Methods flagged with accepts_compiled get CompiledRates instead of the queryset.
+    """
+    METRICS_CACHE_SIZE = 512
+    
+    def __init__(self, method, rates, nominal_price):
+        self.method = method
+        if getattr(method, 'accepts_compiled', False):
+            rates = CompiledRates(rates)
+        self.rates = rates
+        self.nominal_price = nominal_price
+        self.function = None
+        if not self.rates:
+            self.function = StepFunction([{
+                'quantity': 0,
+                'price': nominal_price,
+            }])
+        elif hasattr(method, 'compile'):
+            self.function = method.compile(self.rates)
+        self.get_steps = lru_cache(maxsize=self.METRICS_CACHE_SIZE)(self.compile_steps)
+    
+    def compile_steps(self, metric):
+        """ (counters, prices, accumulated prices before each step, is monotonic) """
+        rates = None
+        if self.rates:
+            rates = self.method(self.rates, metric)
+        if not rates:
+            rates = [{
+                'quantity': metric,
+                'price': self.nominal_price,
+            }]
+        counters = []
+        prices = []
+        accumulated = []
+        counter = 0
+        total = 0
+        for rate in rates:
+            accumulated.append(total)
+            counter += rate['quantity']
+            counters.append(counter)
+            prices.append(rate['price'])
+            total += rate['price'] * rate['quantity']
+        is_monotonic = all(prev <= cur for prev, cur in zip(counters, counters[1:]))
+        return tuple(counters), tuple(prices), tuple(accumulated), is_monotonic
+    
+    def find(self, counters, value, is_monotonic):
+        """ first step whose counter reaches value """
+        if is_monotonic:
+            ix = bisect.bisect_left(counters, value)
+            if ix < len(counters):
+                return ix
+        else:
+            for ix, counter in enumerate(counters):
+                if counter >= value:
+                    return ix
+        raise RuntimeError("Rating algorithm bad result")
+    
+    def get_price(self, metric, position=None):
+        """
+        if position is provided an specific price for that position is returned,
+        accumulated price is returned otherwise
+        """
+        if self.function is not None:
+            return self.get_compiled_price(metric, position)
+        counters, prices, accumulated, is_monotonic = self.get_steps(metric)
+        if position is None:
+            ix = self.find(counters, metric, is_monotonic)
+            ant_counter = counters[ix-1] if ix else 0
+            total = accumulated[ix] + (metric - ant_counter) * prices[ix]
+            total = round(total, 2)
+            return decimal.Decimal(str(total))
+        if metric < position:
+            raise ValueError("Metric can not be less than the position.")
+        ix = self.find(counters, position, is_monotonic)
+        return decimal.Decimal(str(prices[ix]))
+    
+    def get_compiled_price(self, metric, position=None):
+        if position is not None and metric < position:
+            raise ValueError("Metric can not be less than the position.")
+        price = self.function.get_price(metric, position)
+        if price is None:
+            # Nominal price when the method has no rates for the metric
+            price = metric * self.nominal_price if position is None else self.nominal_price
+        if position is None:
+            price = round(price, 2)
+        return decimal.Decimal(str(price))
+
+
+class RatingTableCache(object):
+    """
+    Process-wide LRU of rating tables, keyed by service and the contents of its rates
+    
+    Accounts with the same plans share their table. It is invalidated by Rate, Plan and
+    ContractedPlan post_save and post_delete signals.
+    """
+    def __init__(self):
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+    
+    def get_key(self, service, rates):
+        return (service.pk, service.rate_algorithm, service.nominal_price, tuple(
+            (rate.pk, rate.plan_id, rate.plan.is_combinable, rate.quantity, rate.price)
+                for rate in rates
+        ))
+    
+    def get(self, service, rates):
+        key = self.get_key(service, rates)
+        with self.lock:
+            table = self.tables.pop(key, None)
+            if table is None:
+                table = RatingTable(service.rate_method, rates, service.nominal_price)
+            self.tables[key] = table
+            while len(self.tables) > settings.PLANS_RATING_TABLES_CACHE_SIZE:
+                self.tables.popitem(last=False)
+        return table
+    
+    def invalidate(self):
+        with self.lock:
+            self.tables.clear()
+
+
+rating_tables = RatingTableCache()
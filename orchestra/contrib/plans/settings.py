@@ -13,3 +13,9 @@ PLANS_RATE_METHODS = Setting('PLANS_RATE_METHODS',
 PLANS_DEFAULT_RATE_METHOD = Setting('PLANS_DEFAULT_RATE_METHOD',
     'orchestra.contrib.plans.ratings.step_price',
 )
+
+
+PLANS_RATING_TABLES_CACHE_SIZE = Setting('PLANS_RATING_TABLES_CACHE_SIZE',
+    256,
+    help_text="Number of compiled rating tables kept in memory by each process.",
+)
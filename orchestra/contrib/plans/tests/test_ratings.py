@@ -0,0 +1,183 @@
+import decimal
+
+from django.contrib.contenttypes.models import ContentType
+
+from orchestra.contrib.accounts.models import Account
+from orchestra.contrib.services.models import Service
+from orchestra.utils.tests import BaseTestCase
+
+from ..models import ContractedPlan, Plan, Rate
+from ..ratings import CompiledRates, RatingTable, rating_tables
+
+
+def get_price(service, rates, metric, position=None):
+    """ Former Service.get_price() on the queryset, used as reference """
+    if rates:
+        rates = service.rate_method(rates, metric)
+    if not rates:
+        rates = [{
+            'quantity': metric,
+            'price': service.nominal_price,
+        }]
+    counter = 0
+    if position is None:
+        ant_counter = 0
+        accumulated = 0
+        for rate in rates:
+            counter += rate['quantity']
+            if counter >= metric:
+                counter = metric
+                accumulated += (counter - ant_counter) * rate['price']
+                accumulated = round(accumulated, 2)
+                return decimal.Decimal(str(accumulated))
+            ant_counter = counter
+            accumulated += rate['price'] * rate['quantity']
+        raise RuntimeError("Rating algorithm bad result")
+    for rate in rates:
+        counter += rate['quantity']
+        if counter >= position:
+            return decimal.Decimal(str(rate['price']))
+    raise RuntimeError("Rating algorithm bad result")
+
+
+class RatingTests(BaseTestCase):
+    DEPENDENCIES = (
+        'orchestra.contrib.orders',
+        'orchestra.contrib.services',
+    )
+    METHODS = (
+        'orchestra.contrib.plans.ratings.step_price',
+        'orchestra.contrib.plans.ratings.match_price',
+        'orchestra.contrib.plans.ratings.best_price',
+    )
+    METRICS = range(0, 36)
+    
+    def setUp(self):
+        super(RatingTests, self).setUp()
+        rating_tables.invalidate()
+        self.account = self.create_account()
+        self.service = Service.objects.create(
+            description="Rated service",
+            content_type=ContentType.objects.get_for_model(Account),
+            match='',
+            metric='',
+            nominal_price=10,
+            tax=0,
+        )
+    
+    def create_plan(self, name, rates, contracts=1, **kwargs):
+        plan = Plan.objects.create(name=name, **kwargs)
+        for quantity, price in rates:
+            self.service.rates.create(plan=plan, quantity=quantity, price=price)
+        for __ in range(contracts):
+            self.account.plans.create(plan=plan)
+        return plan
+    
+    def create_plans(self):
+        """ combinable, multiple contractions, incomplete and non-combinable rates """
+        self.create_plan('SUPER', ((1, 0), (3, 10), (4, 9), (10, 1)))
+        self.create_plan('DUPE', ((1, 0), (3, 9)), contracts=2, allow_multiple=True)
+        self.create_plan('INCOMPLETE', ((4, 8), (12, 2)))
+        self.create_plan('HYPER', ((1, 0), (20, 5)), is_combinable=False)
+    
+    def get_rates(self):
+        return self.service.get_rates(self.account, cache=False)
+    
+    def as_tuples(self, rates):
+        return [(rate['quantity'], rate['price']) for rate in rates or []]
+    
+    def assertEquivalent(self):
+        for algorithm in self.METHODS:
+            self.service.rate_algorithm = algorithm
+            method = self.service.rate_method
+            rates = self.get_rates()
+            compiled = CompiledRates(rates)
+            table = RatingTable(method, rates, self.service.nominal_price)
+            for metric in self.METRICS:
+                if rates:
+                    self.assertEqual(
+                        self.as_tuples(method(rates, metric)),
+                        self.as_tuples(method(compiled, metric)))
+                self.assertEqual(
+                    get_price(self.service, rates, metric), table.get_price(metric))
+                for position in range(1, metric+1):
+                    self.assertEqual(
+                        get_price(self.service, rates, metric, position=position),
+                        table.get_price(metric, position=position))
+    
+    def test_compiled_rates(self):
+        self.assertEquivalent()
+        self.create_plans()
+        self.assertEquivalent()
+    
+    def test_compiled_rates_combinable(self):
+        self.create_plans()
+        Plan.objects.filter(name='HYPER').update(is_combinable=True)
+        self.assertEquivalent()
+    
+    def test_compiled_functions(self):
+        """ step and match prices are bisections, merges and best price are memoised """
+        self.create_plans()
+        Plan.objects.update(is_combinable=False)
+        self.METRICS = list(range(0, 36)) + [1000]
+        self.assertEquivalent()
+        rates = self.get_rates()
+        for algorithm, is_compiled in (('step_price', True), ('match_price', True), ('best_price', False)):
+            self.service.rate_algorithm = 'orchestra.contrib.plans.ratings.' + algorithm
+            table = RatingTable(self.service.rate_method, rates, self.service.nominal_price)
+            self.assertEqual(is_compiled, table.function is not None)
+        Plan.objects.update(is_combinable=True)
+        self.service.rate_algorithm = 'orchestra.contrib.plans.ratings.step_price'
+        table = RatingTable(self.service.rate_method, self.get_rates(), self.service.nominal_price)
+        self.assertIsNone(table.function)
+    
+    def test_shared_tables(self):
+        self.create_plans()
+        rates = self.get_rates()
+        table = rating_tables.get(self.service, rates)
+        self.assertIs(table, rating_tables.get(self.service, self.get_rates()))
+        # Same plans on another account, same table
+        account = self.create_account()
+        for contract in self.account.plans.all():
+            ContractedPlan.objects.create(plan=contract.plan, account=account)
+        rates = self.service.get_rates(account, cache=False)
+        self.assertIs(table, rating_tables.get(self.service, rates))
+        self.assertEqual(1, len(rating_tables.tables))
+    
+    def test_rate_invalidation(self):
+        plan = self.create_plan('SUPER', ((0, 5),))
+        self.assertEqual(50, self.service.get_price(self.account, 10, rates=self.get_rates()))
+        self.assertEqual(1, len(rating_tables.tables))
+        rate = self.service.rates.create(plan=plan, quantity=5, price=1)
+        self.assertEqual(0, len(rating_tables.tables))
+        self.assertEqual(26, self.service.get_price(self.account, 10, rates=self.get_rates()))
+        rate.price = 2
+        rate.save()
+        self.assertEqual(0, len(rating_tables.tables))
+        self.assertEqual(32, self.service.get_price(self.account, 10, rates=self.get_rates()))
+        rate.delete()
+        self.assertEqual(0, len(rating_tables.tables))
+        self.assertEqual(50, self.service.get_price(self.account, 10, rates=self.get_rates()))
+    
+    def test_contracted_plan_invalidation(self):
+        plan = Plan.objects.create(name='SUPER')
+        self.service.rates.create(plan=plan, quantity=0, price=1)
+        self.assertEqual(100, self.service.get_price(self.account, 10, rates=self.get_rates()))
+        self.assertEqual(1, len(rating_tables.tables))
+        contract = self.account.plans.create(plan=plan)
+        self.assertEqual(0, len(rating_tables.tables))
+        self.assertEqual(10, self.service.get_price(self.account, 10, rates=self.get_rates()))
+        contract.delete()
+        self.assertEqual(0, len(rating_tables.tables))
+        self.assertEqual(100, self.service.get_price(self.account, 10, rates=self.get_rates()))
+    
+    def test_service_instance_cache(self):
+        plan = self.create_plan('SUPER', ((0, 5),))
+        self.assertEqual(50, self.service.get_price(self.account, 10))
+        rate = Rate.objects.get(plan=plan)
+        rate.price = 1
+        rate.save()
+        # Rates and tables are cached by the service instance
+        self.assertEqual(50, self.service.get_price(self.account, 10))
+        service = Service.objects.get(pk=self.service.pk)
+        self.assertEqual(10, service.get_price(self.account, 10))
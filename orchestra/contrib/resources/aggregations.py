@@ -1,7 +1,9 @@
 import datetime
 import decimal
 import itertools
+from operator import itemgetter, mul, sub
 
+from django.db.models import Sum
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
@@ -9,10 +11,40 @@ from orchestra.utils.python import AttrDict
 
 from orchestra import plugins
 
+from . import settings
+
+
+# Rounding of the computed averages, ResourceData.used precision
+USAGE_PLACES = decimal.Decimal('0.001')
+
+
+def to_microseconds(delta):
+    return (delta.days*86400 + delta.seconds)*10**6 + delta.microseconds
+
 
 class Aggregation(plugins.Plugin, metaclass=plugins.PluginMount):
     """ filters and computes dataset usage """
     aggregated_history = False
+    # Coarsest MonitorDataRollup period that satisfies the usage and history computations
+    rollup_period = None
+    history_rollup_period = None
+    
+    def get_queryset(self, period=None):
+        """ dataset to aggregate, rollups of the given period when they are enabled """
+        from .models import MonitorData, MonitorDataRollup
+        if period is None:
+            period = self.rollup_period
+        if period and settings.RESOURCES_MONITOR_DATA_ROLLUPS:
+            return MonitorDataRollup.objects.filter(period=period)
+        return MonitorData.objects.all()
+    
+    def get_history_queryset(self):
+        """ finest rollups available of each date, history may span beyond the hourly ones """
+        from .models import MonitorData, MonitorDataRollup
+        period = self.history_rollup_period
+        if period and settings.RESOURCES_MONITOR_DATA_ROLLUPS:
+            return MonitorDataRollup.objects.history(period)
+        return MonitorData.objects.all()
     
     def filter(self, dataset):
         """ Filter the dataset to get the relevant data according to the period """
@@ -22,6 +54,19 @@ class Aggregation(plugins.Plugin, metaclass=plugins.PluginMount):
         """ given a dataset computes its usage according to the method (avg, sum, ...) """
         raise NotImplementedError
     
+    def compute_usages(self, dataset):
+        """
+        given an unfiltered dataset of many objects computes the usage of each one
+        returns {object_id: usage}
+        """
+        usages = {}
+        object_ids = dataset.order_by().values_list('object_id', flat=True).distinct()
+        for object_id in object_ids:
+            usage = self.compute_usage(self.filter(dataset.filter(object_id=object_id)))
+            if usage is not None:
+                usages[object_id] = usage
+        return usages
+    
     def aggregate_history(self, dataset):
         raise NotImplementedError
 
@@ -30,6 +75,7 @@ class Last(Aggregation):
     """ Sum of the last value of all monitors """
     name = 'last'
     verbose_name = _("Last value")
+    history_rollup_period = 'HOURLY'
     
     def filter(self, dataset, date=None):
         dataset = dataset.order_by('object_id', '-id').distinct('monitor')
@@ -43,9 +89,16 @@ class Last(Aggregation):
             return sum(values)
         return None
     
+    def compute_usages(self, dataset):
+        dataset = dataset.order_by('object_id', '-id').distinct('object_id')
+        return dict(dataset.values_list('object_id', 'value'))
+    
     def aggregate_history(self, dataset):
         prev_object_id = None
         for mdata in dataset.order_by('object_id', 'created_at'):
+            if hasattr(mdata, 'average'):
+                # Downsampled history
+                mdata.value = mdata.average
             object_id = mdata.object_id
             if object_id != prev_object_id:
                 if prev_object_id is not None:
@@ -63,6 +116,8 @@ class MonthlySum(Last):
     name = 'monthly-sum'
     verbose_name = _("Monthly Sum")
     aggregated_history = True
+    rollup_period = 'MONTHLY'
+    history_rollup_period = 'MONTHLY'
     
     def filter(self, dataset, date=None):
         if date is None:
@@ -72,6 +127,12 @@ class MonthlySum(Last):
             created_at__month=date.month,
         )
     
+    def compute_usages(self, dataset):
+        dataset = self.filter(dataset).order_by().values('object_id').annotate(usage=Sum('value'))
+        return {
+            data['object_id']: data['usage'] for data in dataset
+        }
+    
     def aggregate_history(self, dataset):
         prev = None
         prev_object_id = None
@@ -80,7 +141,11 @@ class MonthlySum(Last):
             created_at=AttrDict(year=-1, month=-1))
         for mdata in itertools.chain(dataset.order_by('object_id', 'created_at'), [sink]):
             object_id = mdata.object_id
-            ymonth = (mdata.created_at.year, mdata.created_at.month)
+            created_at = mdata.created_at
+            if mdata is not sink:
+                # Same months as created_at__month lookups
+                created_at = timezone.localtime(created_at)
+            ymonth = (created_at.year, created_at.month)
             if object_id != prev_object_id or ymonth != prev.ymonth:
                 if prev_object_id is not None:
                     data = AttrDict(
@@ -110,6 +175,8 @@ class MonthlyAvg(MonthlySum):
     name = 'monthly-avg'
     verbose_name = _("Monthly AVG")
     aggregated_history = False
+    rollup_period = None
+    history_rollup_period = 'HOURLY'
     
     def get_epoch(self, date=None):
         if date is None:
@@ -120,30 +187,59 @@ class MonthlyAvg(MonthlySum):
             day=1,
         )
     
+    def get_epoch_datetime(self, date):
+        epoch = self.get_epoch(date=timezone.localtime(date))
+        if not isinstance(epoch, datetime.datetime):
+            epoch = timezone.make_aware(datetime.datetime.combine(epoch, datetime.time.min),
+                timezone.get_current_timezone())
+        return epoch
+    
+    def get_columns(self, dataset):
+        """ yields (object_id, created_ats, values) columns of a dataset """
+        dataset = dataset.order_by('object_id', 'created_at')
+        dataset = dataset.values_list('object_id', 'created_at', 'value')
+        for object_id, rows in itertools.groupby(dataset.iterator(), key=itemgetter(0)):
+            __, created_ats, values = zip(*rows)
+            yield object_id, created_ats, values
+    
+    def compute_average(self, created_ats, values):
+        """
+        time weighted average of a serie ordered by created_at, each value weights the time
+        elapsed since the previous one (or since the epoch)
+        
+        Values are handled as integer hundredths (MonitorData.value precision) and times as
+        integer microseconds, hence the weighted sum is exact and the average is rounded
+        once, half even, to USAGE_PLACES. Per value Decimal(str(slot/total)) weights differ
+        from the exact ones by less than 2**-52 relative, so both methods match after
+        rounding unless the average lies that close to a rounding boundary.
+        """
+        epoch = self.get_epoch_datetime(created_ats[-1])
+        offsets = [to_microseconds(created_at-epoch) for created_at in created_ats]
+        total = offsets[-1]
+        if total <= 0:
+            return values[-1].quantize(USAGE_PLACES, rounding=decimal.ROUND_HALF_EVEN)
+        slots = map(sub, offsets, [0] + offsets[:-1])
+        hundredths = (int(value*100) for value in values)
+        weighted = sum(map(mul, hundredths, slots))
+        with decimal.localcontext() as context:
+            context.prec = 64
+            average = decimal.Decimal(weighted) / (total*100)
+            return average.quantize(USAGE_PLACES, rounding=decimal.ROUND_HALF_EVEN)
+    
     def compute_usage(self, dataset):
-        result = 0
-        has_result = False
-        aggregate = []
-        for object_id, dataset in dataset.order_by('created_at').group_by('object_id').items():
-            try:
-                last = dataset[-1]
-            except IndexError:
-                continue
-            epoch = self.get_epoch(date=last.created_at)
-            total = (last.created_at-epoch).total_seconds()
-            ini = epoch
-            current = 0
-            for mdata in dataset:
-                has_result = True
-                slot = (mdata.created_at-ini).total_seconds()
-                current += mdata.value * decimal.Decimal(str(slot/total))
-                ini = mdata.created_at
-            else:
-                result += current
-        if has_result:
-            return result
+        averages = self.compute_usages(dataset, filtered=True)
+        if averages:
+            return sum(averages.values())
         return None
     
+    def compute_usages(self, dataset, filtered=False):
+        if not filtered:
+            dataset = self.filter(dataset)
+        return {
+            object_id: self.compute_average(created_ats, values)
+                for object_id, created_ats, values in self.get_columns(dataset)
+        }
+    
     def aggregate_history(self, dataset):
         yield from super(MonthlySum, self).aggregate_history(dataset)
 
@@ -1,4 +1,6 @@
 import datetime
+import logging
+import textwrap
 
 from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
@@ -6,8 +8,175 @@ from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
 from orchestra.contrib.orchestration import ServiceBackend
+from orchestra.utils.python import format_exception
 
-from . import helpers
+from . import helpers, settings
+
+
+logger = logging.getLogger(__name__)
+
+
+PYTHON_LOG_READER = textwrap.dedent("""\
+    import json
+    import os
+    import sys
+    
+    
+    class LogReader(object):
+        \"\"\"
+        Reads a log file and its rotated copies (newest first), remembering for each object
+        key the inode and byte offset of the lines already accounted, when offsets_dir is set
+        
+        The offsets read by a run are kept pending until the master has stored its output,
+        the next run acknowledges them when the last stored date of the key (last_dates) is
+        the date of that run. Otherwise the lines are read again.
+        \"\"\"
+        offsets_dir = %(offsets_dir)r
+        run = %(run)r
+        # {key: date of its last stored data}
+        last_dates = {}
+        
+        def __init__(self, logs):
+            self.logs = logs
+            self.state = {}
+            self.pending = {}
+            self.state_path = None
+            self.keys = []
+            self.inode = None
+            self.newer_inode = None
+            self.position = 0
+            self.end = None
+            if self.offsets_dir:
+                name = %(prefix)r + logs[0].replace('/', '_')
+                self.state_path = os.path.join(self.offsets_dir, name)
+                try:
+                    with open(self.state_path) as handler:
+                        state = json.load(handler)
+                    self.state = state['offsets']
+                    self.pending = state['pending']
+                except (IOError, ValueError, KeyError, TypeError):
+                    pass
+        
+        def acknowledge(self):
+            \"\"\" offsets pending from a run whose output has been stored are accounted \"\"\"
+            for key in self.keys:
+                pending = self.pending.pop(key, None)
+                if pending and pending[2] == self.last_dates.get(key):
+                    self.state[key] = pending[:2]
+        
+        def get_start(self, size):
+            \"\"\" offset from where the current file needs to be read, None if it does not \"\"\"
+            start = None
+            for key in self.keys:
+                inode, offset = self.state.get(key, (None, 0))
+                if inode == self.inode:
+                    if offset > size:
+                        # truncated
+                        offset = 0
+                        self.state[key] = (inode, offset)
+                elif inode is not None and inode == self.newer_inode:
+                    continue
+                else:
+                    offset = 0
+                start = offset if start is None else min(start, offset)
+            return start
+        
+        def is_new(self, key):
+            \"\"\" whether the current line has not been accounted for key yet \"\"\"
+            inode, offset = self.state.get(key, (None, 0))
+            if inode == self.inode:
+                return self.position >= offset
+            return inode is None or inode != self.newer_inode
+        
+        def readlines(self, keys):
+            self.keys = list(keys)
+            self.acknowledge()
+            try:
+                current_inode = os.stat(self.logs[0]).st_ino
+            except OSError:
+                current_inode = None
+            # Oldest first
+            logs = [(log, current_inode) for log in reversed(self.logs[1:])]
+            logs.append((self.logs[0], None))
+            for log, newer_inode in logs:
+                try:
+                    handler = open(log, 'rb')
+                except IOError as e:
+                    sys.stderr.write(str(e)+'\\n')
+                    continue
+                with handler:
+                    stat = os.fstat(handler.fileno())
+                    self.inode = stat.st_ino
+                    self.newer_inode = newer_inode
+                    start = self.get_start(stat.st_size)
+                    if start is None:
+                        continue
+                    handler.seek(start)
+                    self.position = start
+                    for line in handler:
+                        if not line.endswith(b'\\n'):
+                            # Partially written line
+                            break
+                        yield line.decode('utf-8', 'replace')
+                        self.position += len(line)
+                    if newer_inode is None:
+                        self.end = (self.inode, self.position)
+        
+        def save(self):
+            \"\"\" stores the offsets once all the lines have been read, pending of acknowledgement \"\"\"
+            if not self.state_path or self.end is None:
+                return
+            for key in self.keys:
+                self.pending[key] = list(self.end) + [self.run]
+            dirname = os.path.dirname(self.state_path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self.state_path + '.tmp', 'w') as handler:
+                json.dump({'offsets': self.state, 'pending': self.pending}, handler)
+            os.rename(self.state_path + '.tmp', self.state_path)
+    
+    """)
+
+
+BASH_LOG_READER = textwrap.dedent("""\
+    function read_new_lines () {
+        # Prints the lines of a log file and its rotated copy appended since the last
+        # acknowledged call, the offsets of a call are acknowledged by the next one when
+        # LAST_DATE, the date of the last stored data, is the date of that call
+        LOG_FILE="$1"
+        LAST_DATE="$2"
+        OFFSETS_DIR="%(offsets_dir)s"
+        if [[ -z "${OFFSETS_DIR}" ]]; then
+            cat "${LOG_FILE}" "${LOG_FILE}.1" 2> /dev/null || true
+            return 0
+        fi
+        STATE_FILE="${OFFSETS_DIR}/%(prefix)s$(echo "${LOG_FILE}" | tr '/' '_')"
+        { read INODE OFFSET PENDING_INODE PENDING_OFFSET PENDING_RUN < "${STATE_FILE}"; } 2> /dev/null \\
+            || { INODE="-"; OFFSET=0; PENDING_RUN=""; }
+        if [[ -n "${PENDING_RUN}" && "${PENDING_RUN}" == "${LAST_DATE}" ]]; then
+            # The output of the previous call has been stored
+            INODE="${PENDING_INODE}"
+            OFFSET="${PENDING_OFFSET}"
+        fi
+        ACKNOWLEDGED="${INODE} ${OFFSET}"
+        CURRENT_INODE=$(stat -c %%i "${LOG_FILE}" 2> /dev/null || echo "")
+        SIZE=$(stat -c %%s "${LOG_FILE}" 2> /dev/null || echo 0)
+        if [[ "${INODE}" != "${CURRENT_INODE}" || ${SIZE} -lt ${OFFSET} ]]; then
+            # Rotated or truncated
+            if [[ "${INODE}" != "-" && $(stat -c %%i "${LOG_FILE}.1" 2> /dev/null) == "${INODE}" ]]; then
+                tail -c +$((OFFSET+1)) "${LOG_FILE}.1"
+            else
+                cat "${LOG_FILE}.1" 2> /dev/null || true
+            fi
+            OFFSET=0
+        fi
+        if [[ -n "${CURRENT_INODE}" ]]; then
+            # Apache writes each line with a single write(), SIZE is at a line boundary
+            tail -c +$((OFFSET+1)) "${LOG_FILE}" | head -c $((SIZE-OFFSET))
+            mkdir -p "${OFFSETS_DIR}"
+            echo "${ACKNOWLEDGED} ${CURRENT_INODE} ${SIZE} %(run)s" > "${STATE_FILE}"
+        fi
+    }""")
 
 
 class ServiceMonitor(ServiceBackend):
@@ -50,6 +219,30 @@ class ServiceMonitor(ServiceBackend):
         except MonitorData.DoesNotExist:
             return None
         
+    @property
+    def incremental_logs(self):
+        return bool(settings.RESOURCES_MONITOR_LOG_OFFSETS_DIR)
+    
+    def get_log_reader(self, executable='python'):
+        """
+        Source code of the log reader helper used by log parsing monitors
+        
+        When RESOURCES_MONITOR_LOG_OFFSETS_DIR is set only the lines appended since the
+        last run are read, otherwise the whole log files are read on every run.
+        The offsets of a run are only accounted once its output has been stored: the next
+        run compares the last stored date of each object, get_last_date(), with the date
+        of the run. Runs whose output is lost or fails to be stored are read again.
+        """
+        context = {
+            'offsets_dir': settings.RESOURCES_MONITOR_LOG_OFFSETS_DIR,
+            'prefix': self.get_name(),
+            # MonitorData.created_at of the stored output, formatted as the last dates
+            'run': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
+        }
+        if executable == 'python':
+            return PYTHON_LOG_READER % context
+        return BASH_LOG_READER % context
+    
     def get_last_date(self, object_id):
         data = self.get_last_data(object_id)
         if data is None:
@@ -67,23 +260,56 @@ class ServiceMonitor(ServiceBackend):
         return result
     
     def store(self, log):
-        """ stores monitored values from stdout """
-        from .models import MonitorData
+        """
+        stores monitored values from stdout
+        
+        Objects are resolved and values inserted in batches of RESOURCES_MONITOR_DATA_BATCH_SIZE,
+        lines that can not be parsed are reported on log.stderr instead of aborting the batch
+        """
+        from .models import MonitorData, MonitorDataRollup
         name = self.get_name()
         app_label, model_name = self.model.split('.')
         ct = ContentType.objects.get_by_natural_key(app_label, model_name.lower())
-        for line in log.stdout.splitlines():
+        batch_size = settings.RESOURCES_MONITOR_DATA_BATCH_SIZE
+        results = []
+        errors = []
+        for num, line in enumerate(log.stdout.splitlines(), 1):
             line = line.strip()
-            object_id, value, state = self.process(line)
+            try:
+                object_id, value, state = self.process(line)
+                object_id = int(object_id)
+            except Exception as exc:
+                errors.append("line %i: %s" % (num, format_exception(exc)))
+                continue
             if isinstance(value, bytes):
                 value = value.decode('ascii')
             if isinstance(state, bytes):
                 state = state.decode('ascii')
-            content_object = ct.get_object_for_this_type(pk=object_id)
-            MonitorData.objects.create(
+            results.append((num, object_id, value, state))
+        ids = sorted(set(result[1] for result in results))
+        objects = {}
+        manager = ct.model_class()._default_manager
+        for ix in range(0, len(ids), batch_size):
+            objects.update(manager.in_bulk(ids[ix:ix+batch_size]))
+        datas = []
+        for num, object_id, value, state in results:
+            try:
+                content_object = objects[object_id]
+            except KeyError:
+                errors.append("line %i: %s with id %i does not exist" % (num, model_name, object_id))
+                continue
+            datas.append(MonitorData(
                 monitor=name, object_id=object_id, content_type=ct, value=value, state=state,
                 created_at=self.current_date, content_object_repr=str(content_object),
-            )
+            ))
+        MonitorData.objects.bulk_create(datas, batch_size=batch_size)
+        if settings.RESOURCES_MONITOR_DATA_ROLLUPS:
+            MonitorDataRollup.objects.ingest(datas, batch_size=batch_size)
+        if errors:
+            msg = "%s could not store %i values" % (name, len(errors))
+            logger.error(msg)
+            log.stderr += '\n'.join(['', msg] + errors)
+            log.save(update_fields=('stderr', 'updated_at'))
     
     def execute(self, *args, **kwargs):
         log = super(ServiceMonitor, self).execute(*args, **kwargs)
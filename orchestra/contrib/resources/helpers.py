@@ -1,5 +1,6 @@
 import decimal
 
+from django.db.models import Case, When, Value
 from django.template.defaultfilters import date as date_format
 
 
@@ -29,7 +30,8 @@ def get_history_data(queryset):
         monitors = []
         scale = options['scale']
         all_dates = options['dates']
-        for monitor_name, dataset in rdata.get_monitor_datasets():
+        history = aggregation.get_history_queryset()
+        for monitor_name, dataset in rdata.get_monitor_datasets(queryset=history):
             datasets = {}
             for content_object, datas in aggregation.aggregate_history(dataset):
                 if aggregation.aggregated_history:
@@ -83,52 +85,67 @@ def get_history_data(queryset):
     return result
 
 
+def delete_in_chunks(dataset, ids, chunk_size=1000):
+    for ix in range(0, len(ids), chunk_size):
+        dataset.model.objects.filter(pk__in=ids[ix:ix+chunk_size]).delete()
+    return len(ids)
+
+
 def delete_old_equal_values(dataset):
     """ only first and last values of an equal serie (+-error) are kept """
     prev_value = None
     prev_key = None
-    delete_count = 0
+    prev_id = None
+    to_delete = []
     error = decimal.Decimal('0.005')
     third = False
-    for mdata in dataset.order_by('content_type_id', 'object_id', 'created_at'):
-        key = (mdata.content_type_id, mdata.object_id)
+    dataset = dataset.order_by('content_type_id', 'object_id', 'created_at')
+    for mdata_id, ct_id, object_id, value in dataset.values_list(
+            'id', 'content_type_id', 'object_id', 'value').iterator():
+        key = (ct_id, object_id)
         if prev_key == key:
-            if prev_value is not None and mdata.value*(1-error) < prev_value < mdata.value*(1+error):
+            if prev_value is not None and value*(1-error) < prev_value < value*(1+error):
                 if third:
-                    prev.delete()
-                    delete_count += 1
+                    to_delete.append(prev_id)
                 else:
                     third = True
             else:
                 third = False
-            prev_value = mdata.value
+            prev_value = value
             prev_key = key
         else:
             prev_value = None
             prev_key = key
-        prev = mdata
-    return delete_count
+        prev_id = mdata_id
+    return delete_in_chunks(dataset, to_delete)
 
 
-def monthly_sum_old_values(dataset):
+def monthly_sum_old_values(dataset, chunk_size=1000):
     aggregated = 0
     prev_key = None
     prev = None
+    month_ids = []
     to_delete = []
-    delete_count = 0
-    for mdata in dataset.order_by('content_type_id', 'object_id', 'created_at'):
-        key = (mdata.content_type_id, mdata.object_id, mdata.created_at.year, mdata.created_at.month)
+    to_update = {}
+    dataset = dataset.order_by('content_type_id', 'object_id', 'created_at')
+    for mdata in dataset.values_list(
+            'id', 'content_type_id', 'object_id', 'created_at', 'value').iterator():
+        mdata_id, ct_id, object_id, created_at, value = mdata
+        key = (ct_id, object_id, created_at.year, created_at.month)
         if prev_key is not None and prev_key != key:
-            if prev.value != aggregated:
-                prev.value = aggregated
-                prev.save(update_fields=('value',))
-            for obj in to_delete[:-1]:
-                obj.delete()
-                delete_count += 1
+            if prev[4] != aggregated:
+                to_update[prev[0]] = aggregated
+            to_delete.extend(month_ids[:-1])
             aggregated = 0
-            to_delete = []
+            month_ids = []
         prev = mdata
         prev_key = key
-        aggregated += mdata.value
-        to_delete.append(mdata)
-    return delete_count
+        aggregated += value
+        month_ids.append(mdata_id)
+    ids = list(to_update.keys())
+    for ix in range(0, len(ids), chunk_size):
+        whens = [When(pk=pk, then=Value(to_update[pk])) for pk in ids[ix:ix+chunk_size]]
+        dataset.model.objects.filter(pk__in=ids[ix:ix+chunk_size]).update(
+            value=Case(*whens, output_field=dataset.model._meta.get_field('value'))
+        )
+    return delete_in_chunks(dataset, to_delete)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from ...models import MonitorData, MonitorDataRollup
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the hourly, daily and monthly rollups from the stored monitor data.'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('monitors', nargs='*',
+            help='Monitors to rebuild, all of them by default.')
+    
+    def handle(self, *args, **options):
+        dataset = MonitorData.objects.all()
+        if options['monitors']:
+            dataset = dataset.filter(monitor__in=options['monitors'])
+        MonitorDataRollup.objects.rebuild(dataset)
+        self.stdout.write("%i rollups" % MonitorDataRollup.objects.count())
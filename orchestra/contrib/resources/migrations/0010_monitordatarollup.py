@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('resources', '0009_auto_20150804_1450'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonitorDataRollup',
+            fields=[
+                ('id', models.AutoField(primary_key=True, auto_created=True, serialize=False, verbose_name='ID')),
+                ('monitor', models.CharField(choices=[('Apache2Traffic', '[M] Apache 2 Traffic'), ('DovecotMaildirDisk', '[M] Dovecot Maildir size'), ('Exim4Traffic', '[M] Exim4 traffic'), ('MailmanSubscribers', '[M] Mailman subscribers'), ('MailmanTraffic', '[M] Mailman traffic'), ('MysqlDisk', '[M] MySQL disk'), ('OpenVZTraffic', '[M] OpenVZTraffic'), ('PostfixMailscannerTraffic', '[M] Postfix-Mailscanner traffic'), ('UNIXUserDisk', '[M] UNIX user disk'), ('VsFTPdTraffic', '[M] VsFTPd traffic')], max_length=256, verbose_name='monitor')),
+                ('object_id', models.PositiveIntegerField(verbose_name='object id')),
+                ('period', models.CharField(choices=[('HOURLY', 'Hourly'), ('DAILY', 'Daily'), ('MONTHLY', 'Monthly')], max_length=16, verbose_name='period')),
+                ('created_at', models.DateTimeField(db_index=True, verbose_name='period start')),
+                ('value', models.DecimalField(decimal_places=2, max_digits=20, verbose_name='value')),
+                ('count', models.PositiveIntegerField(verbose_name='count')),
+                ('content_object_repr', models.CharField(editable=False, max_length=256, verbose_name='content object representation')),
+                ('content_type', models.ForeignKey(verbose_name='content type', to='contenttypes.ContentType')),
+            ],
+            options={
+                'verbose_name_plural': 'monitor data rollups',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='monitordatarollup',
+            unique_together=set([('monitor', 'content_type', 'object_id', 'period', 'created_at')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='monitordatarollup',
+            index_together=set([('monitor', 'content_type', 'period', 'created_at')]),
+        ),
+    ]
@@ -1,7 +1,13 @@
+import datetime
+import decimal
+import itertools
+from operator import itemgetter
+
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
 from django.apps import apps
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, When, Value, Q
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
@@ -11,7 +17,7 @@ from orchestra.core import validators
 from orchestra.models import queryset, fields
 from orchestra.models.utils import get_model_field_path
 
-from . import tasks
+from . import settings, tasks
 from .backends import ServiceMonitor
 from .aggregations import Aggregation
 from .validators import validate_scale
@@ -153,6 +159,41 @@ class Resource(models.Model):
     def get_verbose_name(self):
         return self.verbose_name or self.name
     
+    def get_usages(self, ids=None):
+        """
+        Computes the scaled usage of all the objects (or ids) of this resource
+        with one grouped query per monitor, returns {object_id: used}
+        """
+        aggregation = self.aggregation_instance
+        usages = {}
+        for monitor in self.monitors:
+            path = self.get_model_path(monitor)
+            monitor_model = ServiceMonitor.get_backend(monitor).model_class()
+            ct = ContentType.objects.get_for_model(monitor_model)
+            dataset = aggregation.get_queryset().filter(monitor=monitor, content_type=ct)
+            owners = None
+            if path == []:
+                if ids is not None:
+                    dataset = dataset.filter(object_id__in=ids)
+            else:
+                field = '__'.join(path)
+                objects = monitor_model.objects.all()
+                if ids is not None:
+                    objects = objects.filter(**{'%s__in' % field: ids})
+                owners = dict(objects.values_list('id', field))
+                dataset = dataset.filter(object_id__in=objects.values('id'))
+            for object_id, usage in aggregation.compute_usages(dataset).items():
+                if owners is not None:
+                    try:
+                        object_id = owners[object_id]
+                    except KeyError:
+                        continue
+                usages[object_id] = usages.get(object_id, 0) + usage
+        scale = self.get_scale()
+        return {
+            object_id: float(usage)/scale for object_id, usage in usages.items()
+        }
+    
     def monitor(self, async=True):
         if async:
             return tasks.monitor.apply_async(self.pk)
@@ -174,6 +215,57 @@ class ResourceDataQuerySet(models.QuerySet):
                 resource=resource,
                 allocated=resource.default_allocation
             ), True
+    
+    def update_usages(self, resource, ids=None, batch_size=500):
+        """
+        Computes and stores the usage of all the objects (or ids) of resource in bulk,
+        returns their ResourceData
+        """
+        model = resource.content_type.model_class()
+        objects = model.objects.all()
+        if ids is not None:
+            objects = objects.filter(id__in=ids)
+        usages = resource.get_usages(ids=ids)
+        existing = self.filter(resource=resource, content_type=resource.content_type_id)
+        if ids is not None:
+            existing = existing.filter(object_id__in=ids)
+        existing = {
+            data.object_id: data for data in existing
+        }
+        now = timezone.now()
+        created = []
+        updated = []
+        for obj in objects:
+            try:
+                data = existing[obj.pk]
+            except KeyError:
+                data = self.model(
+                    resource=resource,
+                    allocated=resource.default_allocation,
+                )
+                created.append(data)
+            else:
+                updated.append(data)
+            # Also caches the related object
+            data.content_object = obj
+            data.used = usages.get(obj.pk) or 0
+            data.updated_at = now
+            data.content_object_repr = str(obj)
+        self.bulk_create(created, batch_size=batch_size)
+        used_field = self.model._meta.get_field('used')
+        repr_field = self.model._meta.get_field('content_object_repr')
+        for ix in range(0, len(updated), batch_size):
+            batch = updated[ix:ix+batch_size]
+            self.filter(pk__in=[data.pk for data in batch]).update(
+                used=Case(*[
+                    When(pk=data.pk, then=Value(data.used)) for data in batch
+                ], output_field=used_field),
+                content_object_repr=Case(*[
+                    When(pk=data.pk, then=Value(data.content_object_repr)) for data in batch
+                ], output_field=repr_field),
+                updated_at=now,
+            )
+        return created + updated
 
 
 class ResourceData(models.Model):
@@ -206,7 +298,8 @@ class ResourceData(models.Model):
         resource = self.resource
         total = 0
         has_result = False
-        for monitor, dataset in self.get_monitor_datasets():
+        queryset = resource.aggregation_instance.get_queryset()
+        for monitor, dataset in self.get_monitor_datasets(queryset=queryset):
             dataset = resource.aggregation_instance.filter(dataset)
             usage = resource.aggregation_instance.compute_usage(dataset)
             if usage is not None:
@@ -228,12 +321,15 @@ class ResourceData(models.Model):
             return tasks.monitor.delay(self.resource_id, ids=ids)
         return tasks.monitor(self.resource_id, ids=ids)
     
-    def get_monitor_datasets(self):
+    def get_monitor_datasets(self, queryset=None):
+        """ queryset: MonitorData (default) or MonitorDataRollup queryset """
+        if queryset is None:
+            queryset = MonitorData.objects.all()
         resource = self.resource
         for monitor in resource.monitors:
             path = resource.get_model_path(monitor)
             if path == []:
-                dataset = MonitorData.objects.filter(
+                dataset = queryset.filter(
                     monitor=monitor,
                     content_type=self.content_type_id,
                     object_id=self.object_id,
@@ -244,7 +340,7 @@ class ResourceData(models.Model):
                 objects = monitor_model.objects.filter(**{fields: self.object_id})
                 pks = objects.values_list('id', flat=True)
                 ct = ContentType.objects.get_for_model(monitor_model)
-                dataset = MonitorData.objects.filter(
+                dataset = queryset.filter(
                     monitor=monitor,
                     content_type=ct,
                     object_id__in=pks,
@@ -284,6 +380,194 @@ class MonitorData(models.Model):
         return self.resource.unit
 
 
+class MonitorDataRollupQuerySet(models.QuerySet):
+    group_by = queryset.group_by
+    
+    def aggregate_rows(self, rows):
+        """
+        rows: (monitor, content_type_id, object_id, created_at, value, content_object_repr)
+        returns {(monitor, content_type_id, object_id, period, created_at): [value, count, repr]}
+        """
+        rollups = {}
+        for monitor, ct_id, object_id, created_at, value, content_object_repr in rows:
+            for period, __ in MonitorDataRollup.PERIODS:
+                date = MonitorDataRollup.get_period_start(created_at, period)
+                key = (monitor, ct_id, object_id, period, date)
+                try:
+                    rollup = rollups[key]
+                except KeyError:
+                    rollups[key] = [value, 1, content_object_repr]
+                else:
+                    rollup[0] += value
+                    rollup[1] += 1
+                    rollup[2] = content_object_repr
+        return rollups
+    
+    def create_rollups(self, rollups, batch_size=1000):
+        self.bulk_create([
+            self.model(
+                monitor=monitor, content_type_id=ct_id, object_id=object_id, period=period,
+                created_at=created_at, value=value, count=count, content_object_repr=obj_repr,
+            ) for (monitor, ct_id, object_id, period, created_at), (value, count, obj_repr)
+                in rollups.items()
+        ], batch_size=batch_size)
+    
+    def get_existing(self, keys):
+        """ locks the existing rollups of keys """
+        return self.select_for_update().filter(
+            monitor__in=set(key[0] for key in keys),
+            content_type__in=set(key[1] for key in keys),
+            object_id__in=set(key[2] for key in keys),
+            created_at__in=set(key[4] for key in keys),
+        )
+    
+    def merge_rollups(self, rollups, batch_size=1000):
+        """ adds rollups to the existing ones, within the current transaction """
+        to_delete = []
+        for rollup in self.get_existing(list(rollups.keys())):
+            key = (rollup.monitor, rollup.content_type_id, rollup.object_id, rollup.period,
+                   rollup.created_at)
+            try:
+                current = rollups[key]
+            except KeyError:
+                continue
+            current[0] += rollup.value
+            current[1] += rollup.count
+            to_delete.append(rollup.pk)
+        # Replacing is cheaper than updating each row
+        for ix in range(0, len(to_delete), batch_size):
+            self.filter(pk__in=to_delete[ix:ix+batch_size]).delete()
+        self.create_rollups(rollups, batch_size=batch_size)
+    
+    def ingest(self, datas, batch_size=1000, attempts=3):
+        """
+        adds MonitorData instances to their hourly, daily and monthly rollups
+        
+        select_for_update() does not lock the rollups that do not exist yet, concurrent
+        ingests of the same monitor may create them first. The conflicting ingest is
+        rolled back to its savepoint and retried, now merging the committed rollups.
+        """
+        rollups = self.aggregate_rows(
+            (data.monitor, data.content_type_id, data.object_id, data.created_at,
+             decimal.Decimal(str(data.value)), data.content_object_repr) for data in datas
+        )
+        if not rollups:
+            return
+        for attempt in range(1, attempts+1):
+            try:
+                with transaction.atomic():
+                    self.merge_rollups({
+                        key: list(value) for key, value in rollups.items()
+                    }, batch_size=batch_size)
+            except IntegrityError:
+                if attempt == attempts:
+                    raise
+            else:
+                return
+    
+    def history(self, period):
+        """
+        rollups of the given period while they are kept (RESOURCES_*_ROLLUP_DAYS) and the
+        coarser ones before, so pruned periods are still covered
+        """
+        now = timezone.now()
+        model = self.model
+        retention = {
+            # period: (days kept, coarser period, margin up to a complete coarser period)
+            model.HOURLY: (settings.RESOURCES_HOURLY_ROLLUP_DAYS, model.DAILY, 2),
+            model.DAILY: (settings.RESOURCES_DAILY_ROLLUP_DAYS, model.MONTHLY, 32),
+        }
+        query = Q()
+        until = None
+        while period in retention:
+            days, coarser, margin = retention[period]
+            since = model.get_period_start(now-datetime.timedelta(days=days-margin), coarser)
+            period_query = Q(period=period, created_at__gte=since)
+            if until is not None:
+                period_query &= Q(created_at__lt=until)
+            query |= period_query
+            period, until = coarser, since
+        period_query = Q(period=period)
+        if until is not None:
+            period_query &= Q(created_at__lt=until)
+        return self.filter(query | period_query)
+    
+    def rebuild(self, dataset=None, batch_size=1000):
+        """ (re)builds the rollups of a MonitorData dataset, streaming it ordered by object """
+        if dataset is None:
+            dataset = MonitorData.objects.all()
+        monitors = dataset.order_by().values_list('monitor', flat=True).distinct()
+        with transaction.atomic():
+            self.filter(monitor__in=list(monitors)).delete()
+            rows = dataset.order_by('monitor', 'content_type_id', 'object_id').values_list(
+                'monitor', 'content_type_id', 'object_id', 'created_at', 'value',
+                'content_object_repr').iterator()
+            for __, object_rows in itertools.groupby(rows, key=itemgetter(0, 1, 2)):
+                self.create_rollups(self.aggregate_rows(object_rows), batch_size=batch_size)
+
+
+class MonitorDataRollup(models.Model):
+    """
+    Hourly, daily and monthly sum of the monitored data, maintained on MonitorData ingestion.
+    Shares field names with MonitorData in order to be used as an aggregation dataset.
+    """
+    HOURLY = 'HOURLY'
+    DAILY = 'DAILY'
+    MONTHLY = 'MONTHLY'
+    PERIODS = (
+        (HOURLY, _("Hourly")),
+        (DAILY, _("Daily")),
+        (MONTHLY, _("Monthly")),
+    )
+    
+    monitor = models.CharField(_("monitor"), max_length=256,
+        choices=ServiceMonitor.get_choices())
+    content_type = models.ForeignKey(ContentType, verbose_name=_("content type"))
+    object_id = models.PositiveIntegerField(_("object id"))
+    period = models.CharField(_("period"), max_length=16, choices=PERIODS)
+    created_at = models.DateTimeField(_("period start"), db_index=True)
+    value = models.DecimalField(_("value"), max_digits=20, decimal_places=2)
+    count = models.PositiveIntegerField(_("count"))
+    content_object_repr = models.CharField(_("content object representation"), max_length=256,
+        editable=False)
+    
+    content_object = GenericForeignKey()
+    objects = MonitorDataRollupQuerySet.as_manager()
+    
+    class Meta:
+        unique_together = ('monitor', 'content_type', 'object_id', 'period', 'created_at')
+        index_together = ('monitor', 'content_type', 'period', 'created_at')
+        verbose_name_plural = _("monitor data rollups")
+    
+    def __str__(self):
+        return "%s %s" % (self.monitor, self.period)
+    
+    @property
+    def average(self):
+        return self.value/self.count
+    
+    @classmethod
+    def get_period_start(cls, date, period):
+        """
+        period start on the current timezone, so months match created_at__month lookups
+        
+        Hours are truncated with aware arithmetic, and days are localized with is_dst=False,
+        so neither ambiguous nor non-existent local times raise on DST transitions.
+        """
+        tz = timezone.get_current_timezone()
+        local = timezone.localtime(date, tz)
+        date = date - datetime.timedelta(
+            minutes=local.minute, seconds=local.second, microseconds=local.microsecond)
+        if period == cls.HOURLY:
+            return date
+        date = local.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        if period == cls.MONTHLY:
+            date = date.replace(day=1)
+        if hasattr(tz, 'localize'):
+            return tz.normalize(tz.localize(date, is_dst=False))
+        return timezone.make_aware(date, tz)
+
+
 def create_resource_relation():
     class ResourceHandler(object):
         """ account.resources.web """
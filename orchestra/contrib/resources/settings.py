@@ -1,6 +1,44 @@
+from django.utils.translation import ugettext_lazy as _
+
 from orchestra.contrib.settings import Setting
 
 
 RESOURCES_OLD_MONITOR_DATA_DAYS = Setting('RESOURCES_OLD_MONITOR_DATA_DAYS',
     40,
 )
+
+
+RESOURCES_MONITOR_DATA_BATCH_SIZE = Setting('RESOURCES_MONITOR_DATA_BATCH_SIZE',
+    1000,
+    help_text=_("Number of monitored values resolved and inserted per query.")
+)
+
+
+RESOURCES_MONITOR_LOG_OFFSETS_DIR = Setting('RESOURCES_MONITOR_LOG_OFFSETS_DIR',
+    '',
+    help_text=_("Directory on the monitored servers where traffic monitors keep the inode and "
+                "offset of the last accounted line of each log file, so only new lines are read "
+                "on each run. Offsets are only advanced once the read values have been stored, "
+                "lines of failed runs are read again.<br>"
+                "Leave it empty for reading the whole log files on every run.")
+)
+
+
+RESOURCES_MONITOR_DATA_ROLLUPS = Setting('RESOURCES_MONITOR_DATA_ROLLUPS',
+    False,
+    help_text=_("Maintain hourly, daily and monthly rollups of the monitored data at ingest time, "
+               "serve usage and history queries from them and keep only "
+               "RESOURCES_OLD_MONITOR_DATA_DAYS days of raw data.<br>"
+               "Run <tt>python manage.py rollupmonitordata</tt> after enabling it.")
+)
+
+
+RESOURCES_HOURLY_ROLLUP_DAYS = Setting('RESOURCES_HOURLY_ROLLUP_DAYS',
+    40,
+)
+
+
+RESOURCES_DAILY_ROLLUP_DAYS = Setting('RESOURCES_DAILY_ROLLUP_DAYS',
+    400,
+    help_text=_("Monthly rollups are never deleted.")
+)
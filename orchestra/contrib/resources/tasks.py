@@ -19,8 +19,10 @@ def monitor(resource_id, ids=None):
         from .models import ResourceData, Resource
         resource = Resource.objects.get(pk=resource_id)
         resource_model = resource.content_type.model_class()
-        logs = []
-        # Execute monitors
+        # Execute all monitors in a single batch, manager.execute() runs each backend
+        # on its own thread, bounded by the per-server concurrency limits, and
+        # ServiceMonitor.execute() stores the results as soon as each backend finishes
+        monitorings = []
         for monitor_name in resource.monitors:
             backend = ServiceMonitor.get_backend(monitor_name)
             model = backend.model_class()
@@ -31,23 +33,16 @@ def monitor(resource_id, ids=None):
                 kwargs = {
                     path: ids
                 }
-            # Execute monitor
-            monitorings = []
             for obj in model.objects.filter(**kwargs):
                 op = Operation(backend, obj, Operation.MONITOR)
                 monitorings.append(op)
-            logs += Operation.execute(monitorings, async=False)
+        logs = Operation.execute(monitorings, async=False)
         
-        kwargs = {'id__in': ids} if ids else {}
         # Update used resources and trigger resource exceeded and revovery
         triggers = []
-        model = resource.content_type.model_class()
-        for obj in model.objects.filter(**kwargs):
-            data, __ = ResourceData.objects.get_or_create(obj, resource)
-            data.update()
+        for data in ResourceData.objects.update_usages(resource, ids=ids or None):
             if not resource.disable_trigger:
-                a = data.used
-                b = data.allocated
+                obj = data.content_object
                 if data.used > (data.allocated or 0):
                     op = Operation(backend, obj, Operation.EXCEEDED)
                     triggers.append(op)
@@ -61,13 +56,29 @@ def monitor(resource_id, ids=None):
 @periodic_task(run_every=crontab(hour=2, minute=30), name='resources.cleanup_old_monitors')
 @transaction.atomic
 def cleanup_old_monitors(queryset=None):
+    from .models import MonitorData, MonitorDataRollup
     if queryset is None:
-        from .models import MonitorData
         queryset = MonitorData.objects.all()
+    now = timezone.now()
     delta = datetime.timedelta(days=settings.RESOURCES_OLD_MONITOR_DATA_DAYS)
-    threshold = timezone.now() - delta
+    threshold = now - delta
     queryset = queryset.filter(created_at__lt=threshold)
     delete_counts = []
+    if settings.RESOURCES_MONITOR_DATA_ROLLUPS:
+        # Old data is served by the rollups, only the last value of each object is kept
+        latest = MonitorData.objects.order_by(
+            'monitor', 'content_type_id', 'object_id', '-created_at'
+        ).distinct('monitor', 'content_type_id', 'object_id').values('id')
+        dataset = queryset.exclude(pk__in=latest)
+        delete_counts.append(('MonitorData', dataset.count()))
+        dataset.delete()
+        for period, days in ((MonitorDataRollup.HOURLY, settings.RESOURCES_HOURLY_ROLLUP_DAYS),
+                             (MonitorDataRollup.DAILY, settings.RESOURCES_DAILY_ROLLUP_DAYS)):
+            dataset = MonitorDataRollup.objects.filter(
+                period=period, created_at__lt=now-datetime.timedelta(days=days))
+            delete_counts.append(('MonitorDataRollup %s' % period, dataset.count()))
+            dataset.delete()
+        return delete_counts
     for monitor in ServiceMonitor.get_plugins():
         dataset = queryset.filter(monitor=monitor)
         delete_count = monitor.aggregate(dataset)
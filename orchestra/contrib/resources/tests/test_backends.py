@@ -0,0 +1,87 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+from orchestra.utils.tests import BaseTestCase
+
+from ..backends import BASH_LOG_READER, PYTHON_LOG_READER
+
+
+class LogReaderMixin(object):
+    """ runs of the log readers, where the output of a run is stored when its date is passed """
+    RUNS = (
+        '2015-06-01 10:00:00 UTC',
+        '2015-06-01 11:00:00 UTC',
+        '2015-06-01 12:00:00 UTC',
+    )
+    NEVER_STORED = '2015-05-31 10:00:00 UTC'
+    
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.offsets_dir = os.path.join(self.tmp, 'offsets')
+        self.log_path = os.path.join(self.tmp, 'access.log')
+    
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+    
+    def write(self, *lines):
+        with open(self.log_path, 'a') as handler:
+            for line in lines:
+                handler.write(line + '\n')
+    
+    def get_context(self, run):
+        return {
+            'offsets_dir': self.offsets_dir,
+            'prefix': 'TestMonitor',
+            'run': run,
+        }
+    
+    def test_stored_runs(self):
+        self.write('a', 'b')
+        self.assertEqual(['a', 'b'], self.read(self.RUNS[0], self.NEVER_STORED))
+        self.write('c')
+        self.assertEqual(['c'], self.read(self.RUNS[1], self.RUNS[0]))
+        self.assertEqual([], self.read(self.RUNS[2], self.RUNS[1]))
+    
+    def test_failed_store(self):
+        """ lines of a run whose output has not been stored are read again """
+        self.write('a', 'b')
+        self.assertEqual(['a', 'b'], self.read(self.RUNS[0], self.NEVER_STORED))
+        self.write('c')
+        # The output of the first run has been lost
+        self.assertEqual(['a', 'b', 'c'], self.read(self.RUNS[1], self.NEVER_STORED))
+        self.assertEqual(['a', 'b', 'c'], self.read(self.RUNS[2], self.RUNS[0]))
+        # The third run is the one acknowledged, not the first one
+        self.write('d')
+        self.assertEqual(['d'], self.read(self.RUNS[0], self.RUNS[2]))
+
+
+class PythonLogReaderTests(LogReaderMixin, BaseTestCase):
+    def read(self, run, last_date, key='site'):
+        namespace = {}
+        exec(PYTHON_LOG_READER % self.get_context(run), namespace)
+        LogReader = namespace['LogReader']
+        LogReader.last_dates[key] = last_date
+        reader = LogReader((self.log_path, self.log_path + '.1'))
+        lines = [line.strip() for line in reader.readlines([key]) if reader.is_new(key)]
+        reader.save()
+        return lines
+    
+    def test_keys_are_acknowledged_on_their_own(self):
+        self.write('a')
+        self.assertEqual(['a'], self.read(self.RUNS[0], self.NEVER_STORED, key='stored'))
+        self.assertEqual(['a'], self.read(self.RUNS[1], self.NEVER_STORED, key='failed'))
+        self.write('b')
+        self.assertEqual(['b'], self.read(self.RUNS[2], self.RUNS[0], key='stored'))
+        self.assertEqual(['a', 'b'], self.read(self.RUNS[2], self.NEVER_STORED, key='failed'))
+
+
+class BashLogReaderTests(LogReaderMixin, BaseTestCase):
+    def read(self, run, last_date):
+        script = '\n'.join((
+            BASH_LOG_READER % self.get_context(run),
+            'read_new_lines "$1" "$2"',
+        ))
+        output = subprocess.check_output(['bash', '-c', script, 'bash', self.log_path, last_date])
+        return output.decode('utf-8').splitlines()
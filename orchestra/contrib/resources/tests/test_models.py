@@ -0,0 +1,92 @@
+import datetime
+import decimal
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+
+from orchestra.utils.tests import BaseTestCase
+
+from ..models import MonitorData, MonitorDataRollup, MonitorDataRollupQuerySet
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=timezone.utc)
+
+
+class MonitorDataRollupTests(BaseTestCase):
+    def get_period_starts(self, date):
+        return [
+            MonitorDataRollup.get_period_start(date, period)
+                for period in (MonitorDataRollup.HOURLY, MonitorDataRollup.DAILY,
+                               MonitorDataRollup.MONTHLY)
+        ]
+    
+    def test_ambiguous_hours(self):
+        with timezone.override('Europe/Madrid'):
+            # 02:30 CEST and 02:30 CET, clocks go back at 03:00 CEST
+            self.assertEqual(
+                [utc(2015, 10, 25, 0), utc(2015, 10, 24, 22), utc(2015, 9, 30, 22)],
+                self.get_period_starts(utc(2015, 10, 25, 0, 30)))
+            self.assertEqual(
+                [utc(2015, 10, 25, 1), utc(2015, 10, 24, 22), utc(2015, 9, 30, 22)],
+                self.get_period_starts(utc(2015, 10, 25, 1, 30)))
+    
+    def test_non_existent_hours(self):
+        with timezone.override('Europe/Madrid'):
+            # 03:30 CEST, clocks go forward at 02:00 CET
+            self.assertEqual(
+                [utc(2015, 3, 29, 1), utc(2015, 3, 28, 23), utc(2015, 2, 28, 23)],
+                self.get_period_starts(utc(2015, 3, 29, 1, 30)))
+        with timezone.override('America/Sao_Paulo'):
+            # Midnight does not exist, the day starts at 01:00 BRST
+            self.assertEqual(
+                [utc(2015, 10, 18, 12), utc(2015, 10, 18, 3), utc(2015, 10, 1, 3)],
+                self.get_period_starts(utc(2015, 10, 18, 12, 15)))
+    
+    def test_half_hour_offsets(self):
+        with timezone.override('Asia/Kolkata'):
+            self.assertEqual(
+                [utc(2015, 6, 1, 10, 30), utc(2015, 5, 31, 18, 30), utc(2015, 5, 31, 18, 30)],
+                self.get_period_starts(utc(2015, 6, 1, 10, 45)))
+
+
+class MonitorDataRollupIngestTests(BaseTestCase):
+    def setUp(self):
+        self.ct = ContentType.objects.get_for_model(ContentType)
+    
+    def get_datas(self, *values):
+        return [
+            MonitorData(monitor='TestMonitor', content_type=self.ct, object_id=self.ct.pk,
+                value=value, created_at=utc(2015, 6, 1, 10, 15), content_object_repr='test')
+                for value in values
+        ]
+    
+    def assertRollups(self, value, count):
+        rollups = MonitorDataRollup.objects.filter(monitor='TestMonitor')
+        self.assertEqual(len(MonitorDataRollup.PERIODS), rollups.count())
+        for rollup in rollups:
+            self.assertEqual(decimal.Decimal(value), rollup.value)
+            self.assertEqual(count, rollup.count)
+    
+    def test_ingest(self):
+        MonitorDataRollup.objects.ingest(self.get_datas(1, 2))
+        MonitorDataRollup.objects.ingest(self.get_datas(3))
+        self.assertRollups(6, 3)
+    
+    def test_concurrent_ingest_of_new_keys(self):
+        MonitorDataRollup.objects.ingest(self.get_datas(1, 2))
+        # A concurrent ingest does not see the rollups created meanwhile by the first one
+        get_existing = MonitorDataRollupQuerySet.get_existing
+        calls = []
+        def stale_get_existing(queryset, keys):
+            calls.append(keys)
+            if len(calls) == 1:
+                return queryset.none()
+            return get_existing(queryset, keys)
+        MonitorDataRollupQuerySet.get_existing = stale_get_existing
+        try:
+            MonitorDataRollup.objects.ingest(self.get_datas(3))
+        finally:
+            MonitorDataRollupQuerySet.get_existing = get_existing
+        self.assertEqual(2, len(calls))
+        self.assertRollups(6, 3)
@@ -14,6 +14,8 @@ class ApacheTrafficByHost(ServiceMonitor):
     Compatible log format:
     <tt>LogFormat "%h %l %u %t \"%r\" %>s %O %{Host}i" host</tt>
     <tt>CustomLog /home/pangea/logs/apache/host_blog.pangea.org.log host</tt>
+    
+    Only new log lines are read when <tt>RESOURCES_MONITOR_LOG_OFFSETS_DIR</tt> is set.
     """
     model = 'saas.SaaS'
     script_executable = '/usr/bin/python'
@@ -27,6 +29,7 @@ class ApacheTrafficByHost(ServiceMonitor):
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
             'ignore_hosts': str(settings.SAAS_TRAFFIC_IGNORE_HOSTS),
         }
+        self.append(self.get_log_reader())
         self.append(textwrap.dedent("""\
             import sys
             from datetime import datetime
@@ -41,6 +44,9 @@ class ApacheTrafficByHost(ServiceMonitor):
             # Use local timezone
             end_date = to_local_timezone('{current_date}')
             end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
+            if LogReader.offsets_dir:
+                # Lines read incrementally are accounted even if written after current_date
+                end_date = 99999999999999
             access_logs = {access_logs}
             sites = {{}}
             months = {{
@@ -60,36 +66,36 @@ class ApacheTrafficByHost(ServiceMonitor):
             
             def prepare(object_id, site_domain, ini_date):
                 global sites
+                LogReader.last_dates[site_domain] = ini_date
                 ini_date = to_local_timezone(ini_date)
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 sites[site_domain] = [ini_date, object_id, 0]
             
             def monitor(sites, end_date, months, access_logs):
-                for access_log in access_logs:
+                reader = LogReader(access_logs)
+                for line in reader.readlines(sites):
+                    line = line.split()
+                    host, __, __, date = line[:4]
+                    if host in {ignore_hosts}:
+                        continue
+                    size, hostname = line[-2:]
                     try:
-                        with open(access_log, 'r') as handler:
-                            for line in handler.readlines():
-                                line = line.split()
-                                host, __, __, date = line[:4]
-                                if host in {ignore_hosts}:
-                                    continue
-                                size, hostname = line[-2:]
-                                try:
-                                    site = sites[hostname]
-                                except KeyError:
-                                    continue
-                                else:
-                                    # [16/Sep/2015:11:40:38
-                                    day, month, date = date[1:].split('/')
-                                    year, hour, min, sec = date.split(':')
-                                    date = year + months[month] + day + hour + min + sec
-                                    if site[0] < int(date) < end_date:
-                                        site[2] += int(size)
-                    except IOError as e:
-                        sys.stderr.write(str(e)+'\\n')
+                        site = sites[hostname]
+                    except KeyError:
+                        continue
+                    else:
+                        if not reader.is_new(hostname):
+                            continue
+                        # [16/Sep/2015:11:40:38
+                        day, month, date = date[1:].split('/')
+                        year, hour, min, sec = date.split(':')
+                        date = year + months[month] + day + hour + min + sec
+                        if site[0] < int(date) < end_date:
+                            site[2] += int(size)
                 for opts in sites.values():
                     ini_date, object_id, size = opts
                     sys.stdout.write('%s %s\\n' % (object_id, size))
+                reader.save()
             """).format(**context)
         )
     
@@ -623,6 +623,10 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
         return lines
     
     def generate_bill_lines(self, orders, account, **options):
+        """
+        billed_orders: list where billed orders are appended instead of being saved,
+        for updating them in bulk
+        """
         if options.get('proforma', False):
             options['commit'] = False
         if not self.metric:
@@ -631,10 +635,14 @@ class ServiceHandler(plugins.Plugin, metaclass=plugins.PluginMount):
             lines = self.bill_with_metric(orders, account, **options)
         if options.get('commit', True):
             now = timezone.now().date()
+            billed_orders = options.get('billed_orders')
             for line in lines:
                 order = line.order
                 order.billed_on = now
                 order.billed_metric = getattr(order, 'new_billed_metric', order.billed_metric)
                 order.billed_until = getattr(order, 'new_billed_until', order.billed_until)
-                order.save(update_fields=('billed_on', 'billed_until', 'billed_metric'))
+                if billed_orders is None:
+                    order.save(update_fields=('billed_on', 'billed_until', 'billed_metric'))
+                else:
+                    billed_orders.append(order)
         return lines
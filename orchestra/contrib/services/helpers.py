@@ -1,24 +1,34 @@
-def get_chunks(porders, ini, end, ix=0):
-    if ix >= len(porders):
-        return [[ini, end, []]]
-    order = porders[ix]
-    ix += 1
-    bu = getattr(order, 'new_billed_until', order.billed_until)
-    if not bu or bu <= ini or order.registered_on >= end:
-        return get_chunks(porders, ini, end, ix=ix)
-    result = []
-    if order.registered_on < end and order.registered_on > ini:
-        ro = order.registered_on
-        result = get_chunks(porders, ini, ro, ix=ix)
-        ini = ro
-    if bu < end:
-        result += get_chunks(porders, bu, end, ix=ix)
-        end = bu
-    chunks = get_chunks(porders, ini, end, ix=ix)
-    for chunk in chunks:
-        chunk[2].insert(0, order)
-        result.append(chunk)
-    return result
+import bisect
+from operator import itemgetter
+
+
+def get_chunks(porders, ini, end):
+    """
+    splits [ini, end) into chunks of concurrent orders: [[ini, end, orders]]
+    sweep line over the boundaries of the orders, that keep porders ordering within each chunk
+    """
+    starts = {}
+    stops = {}
+    for ix, order in enumerate(porders):
+        bu = getattr(order, 'new_billed_until', order.billed_until)
+        if not bu or bu <= ini or order.registered_on >= end:
+            continue
+        start = max(order.registered_on, ini)
+        stop = min(bu, end)
+        # Orders registered after being billed do not overlap the interval
+        if start < stop:
+            starts.setdefault(start, []).append(ix)
+            stops.setdefault(stop, []).append(ix)
+    points = sorted(set(starts).union(stops, (ini, end)))
+    chunks = []
+    active = []
+    for chunk_ini, chunk_end in zip(points, points[1:]):
+        for ix in stops.get(chunk_ini, ()):
+            del active[bisect.bisect_left(active, ix)]
+        for ix in starts.get(chunk_ini, ()):
+            bisect.insort(active, ix)
+        chunks.append([chunk_ini, chunk_end, [porders[ix] for ix in active]])
+    return chunks
 
 
 def cmp_billed_until_or_registered_on(a, b):
@@ -71,6 +81,12 @@ class Interval(object):
             return None
     
     def intersect_set(self, others, remaining_self=None, remaining_other=None):
+        if isinstance(others, IntervalTree):
+            if remaining_self is None and remaining_other is None:
+                # Only the overlapping intervals can intersect
+                others = others.search(self.ini, self.end)
+            else:
+                others = others.intervals
         intersections = []
         for interval in others:
             intersection = self.intersect(interval, remaining_self, remaining_other)
@@ -79,7 +95,58 @@ class Interval(object):
         return intersections
 
 
+class IntervalTree(object):
+    """
+    augmented interval tree for finding the overlapping intervals in O(log n + k)
+    implicit balanced tree over the intervals sorted by ini, each node holding the max end
+    of its subtree
+    """
+    def __init__(self, intervals):
+        self.intervals = list(intervals)
+        self.nodes = sorted(enumerate(self.intervals), key=lambda node: node[1].ini)
+        self.max_end = [None] * len(self.nodes)
+        if self.nodes:
+            self.build(0, len(self.nodes)-1)
+    
+    def __iter__(self):
+        return iter(self.intervals)
+    
+    def __len__(self):
+        return len(self.intervals)
+    
+    def build(self, lo, hi):
+        mid = (lo+hi)//2
+        max_end = self.nodes[mid][1].end
+        if lo < mid:
+            max_end = max(max_end, self.build(lo, mid-1))
+        if mid < hi:
+            max_end = max(max_end, self.build(mid+1, hi))
+        self.max_end[mid] = max_end
+        return max_end
+    
+    def search(self, ini, end):
+        """ intervals overlapping [ini, end), in their original order """
+        found = []
+        stack = [(0, len(self.nodes)-1)] if self.nodes else []
+        while stack:
+            lo, hi = stack.pop()
+            mid = (lo+hi)//2
+            if self.max_end[mid] <= ini:
+                # Nothing on this subtree ends after ini
+                continue
+            if lo < mid:
+                stack.append((lo, mid-1))
+            position, interval = self.nodes[mid]
+            if interval.ini < end:
+                if interval.end > ini:
+                    found.append((position, interval))
+                if mid < hi:
+                    stack.append((mid+1, hi))
+        return [interval for position, interval in sorted(found, key=itemgetter(0))]
+
+
 def get_intersections(order_intervals, compensations):
+    order_intervals = IntervalTree(order_intervals)
     intersections = []
     for compensation in compensations:
         intersection = compensation.intersect_set(order_intervals)
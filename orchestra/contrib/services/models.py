@@ -1,5 +1,4 @@
 import calendar
-import decimal
 
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
@@ -196,52 +195,39 @@ class Service(models.Model):
         if position is provided an specific price for that position is returned,
         accumulated price is returned otherwise
         """
-        if rates is None:
-            rates = self.get_rates(account)
-        if rates:
-            rates =  self.rate_method(rates, metric)
-        if not rates:
-            rates = [{
-                'quantity': metric,
-                'price': self.nominal_price,
-            }]
-        counter = 0
-        if position is None:
-            ant_counter = 0
-            accumulated = 0
-            for rate in rates:
-                counter += rate['quantity']
-                if counter >= metric:
-                    counter = metric
-                    accumulated += (counter - ant_counter) * rate['price']
-                    accumulated = round(accumulated, 2)
-                    return decimal.Decimal(str(accumulated))
-                ant_counter = counter
-                accumulated += rate['price'] * rate['quantity']
-            raise RuntimeError("Rating algorithm bad result")
-        else:
-            if metric < position:
-                raise ValueError("Metric can not be less than the position.")
-            for rate in rates:
-                counter += rate['quantity']
-                if counter >= position:
-                    price = round(rate['price'], 2)
-                    return decimal.Decimal(str(rate['price']))
-            raise RuntimeError("Rating algorithm bad result")
+        table = self.get_rating_table(account, rates=rates)
+        return table.get_price(metric, position=position)
     
     def get_rates(self, account, cache=True):
-        # rates are cached per account
+        """
+        rates are cached per account on this Service instance, along with their rating tables,
+        Rate and ContractedPlan changes are only seen by a fresh instance or with cache=False
+        """
         if not cache:
             return self.rates.by_account(account)
-        if not hasattr(self, '__cached_rates'):
-            self.__cached_rates = {}
+        if not hasattr(self, '_cached_rates'):
+            self._cached_rates = {}
         try:
-            return self.__cached_rates[account.id]
+            return self._cached_rates[account.id]
         except KeyError:
             rates = self.rates.by_account(account)
-            self.__cached_rates[account.id] = rates
+            self._cached_rates[account.id] = rates
             return rates
     
+    def get_rating_table(self, account, rates=None):
+        """ compiled pricing function of the account rates, see plans.ratings.RatingTable """
+        if rates is None:
+            rates = self.get_rates(account)
+        if not hasattr(self, '_cached_tables'):
+            self._cached_tables = {}
+        try:
+            return self._cached_tables[id(rates)][1]
+        except KeyError:
+            table = rate_class.get_rating_table(self, rates)
+            # Keeping a reference to rates prevents its id from being reused
+            self._cached_tables[id(rates)] = (rates, table)
+            return table
+    
     @property
     def rate_method(self):
         return rate_class.get_methods()[self.rate_algorithm]
@@ -0,0 +1,144 @@
+import datetime
+import random
+
+from django.utils import timezone
+
+from orchestra.utils.tests import BaseTestCase
+
+from .. import helpers
+
+
+class Order(object):
+    """ Fake order for testing """
+    def __init__(self, registered_on, billed_until=None, new_billed_until=None):
+        self.registered_on = registered_on
+        self.billed_until = billed_until
+        if new_billed_until:
+            self.new_billed_until = new_billed_until
+
+
+def get_chunks(porders, ini, end, ix=0):
+    """ Former recursive implementation, used as reference """
+    if ix >= len(porders):
+        return [[ini, end, []]]
+    order = porders[ix]
+    ix += 1
+    bu = getattr(order, 'new_billed_until', order.billed_until)
+    if not bu or bu <= ini or order.registered_on >= end:
+        return get_chunks(porders, ini, end, ix=ix)
+    result = []
+    if order.registered_on < end and order.registered_on > ini:
+        ro = order.registered_on
+        result = get_chunks(porders, ini, ro, ix=ix)
+        ini = ro
+    if bu < end:
+        result += get_chunks(porders, bu, end, ix=ix)
+        end = bu
+    chunks = get_chunks(porders, ini, end, ix=ix)
+    for chunk in chunks:
+        chunk[2].insert(0, order)
+        result.append(chunk)
+    return result
+
+
+class HelperPropertyTests(BaseTestCase):
+    """ Equivalence of the sweep line and interval tree against the naive implementations """
+    EXAMPLES = 500
+    
+    def setUp(self):
+        super(HelperPropertyTests, self).setUp()
+        self.random = random.Random(0)
+        self.now = timezone.now().date()
+    
+    def date(self, days):
+        return self.now + datetime.timedelta(days=days)
+    
+    def random_order(self):
+        registered_on = self.random.randint(-30, 400)
+        billed_until = None
+        new_billed_until = None
+        if self.random.random() > 0.2:
+            billed_until = registered_on + self.random.randint(1, 400)
+            if self.random.random() > 0.5:
+                new_billed_until = billed_until + self.random.randint(0, 200)
+        return Order(
+            registered_on=self.date(registered_on),
+            billed_until=billed_until and self.date(billed_until),
+            new_billed_until=new_billed_until and self.date(new_billed_until),
+        )
+    
+    def random_intervals(self, num):
+        intervals = []
+        for ix in range(num):
+            ini = self.random.randint(0, 400)
+            # Includes empty and inverted intervals
+            end = ini + self.random.randint(-10, 100)
+            intervals.append(helpers.Interval(self.date(ini), self.date(end), order=ix))
+        return intervals
+    
+    def as_tuples(self, intervals):
+        return [(interval.ini, interval.end, interval.order) for interval in intervals]
+    
+    def test_get_chunks(self):
+        for example in range(self.EXAMPLES):
+            porders = [self.random_order() for ix in range(self.random.randint(0, 30))]
+            ini = self.date(self.random.randint(-30, 300))
+            end = ini + datetime.timedelta(days=self.random.randint(1, 400))
+            expected = sorted(get_chunks(porders, ini, end), key=lambda chunk: chunk[0])
+            self.assertEqual(expected, helpers.get_chunks(porders, ini, end))
+    
+    def test_get_chunks_contiguous(self):
+        porders = [self.random_order() for ix in range(300)]
+        ini, end = self.date(0), self.date(365)
+        chunks = helpers.get_chunks(porders, ini, end)
+        self.assertEqual(ini, chunks[0][0])
+        self.assertEqual(end, chunks[-1][1])
+        for previous, chunk in zip(chunks, chunks[1:]):
+            self.assertEqual(previous[1], chunk[0])
+    
+    def test_interval_tree_search(self):
+        for example in range(self.EXAMPLES):
+            intervals = self.random_intervals(self.random.randint(0, 30))
+            tree = helpers.IntervalTree(intervals)
+            ini = self.date(self.random.randint(-10, 450))
+            end = ini + datetime.timedelta(days=self.random.randint(0, 100))
+            expected = [
+                interval for interval in intervals if interval.ini < end and interval.end > ini
+            ]
+            self.assertEqual(expected, tree.search(ini, end))
+    
+    def test_intersect_set(self):
+        for example in range(self.EXAMPLES):
+            intervals = self.random_intervals(self.random.randint(0, 30))
+            interval = self.random_intervals(1)[0]
+            expected = interval.intersect_set(intervals)
+            result = interval.intersect_set(helpers.IntervalTree(intervals))
+            self.assertEqual(self.as_tuples(expected), self.as_tuples(result))
+    
+    def test_compensate(self):
+        for example in range(self.EXAMPLES):
+            compensations = self.random_intervals(self.random.randint(0, 15))
+            ini = self.random.randint(0, 300)
+            order = helpers.Interval(self.date(ini), self.date(ini+self.random.randint(1, 300)))
+            remaining, applied = helpers.compensate(order, list(compensations))
+            # Naive compensation: greatest intersection first, without interval trees
+            naive_remaining, naive_applied = [], []
+            intervals = [order]
+            pending = list(compensations)
+            while True:
+                intersections = []
+                for compensation in pending:
+                    length = sum(map(len, compensation.intersect_set(intervals)))
+                    intersections.append((length, compensation))
+                intersections.sort(key=lambda i: i[0])
+                if not intersections or intersections[-1][0] <= 0:
+                    break
+                __, compensation = intersections.pop()
+                pending = [compensation for __, compensation in intersections]
+                remaining_order = []
+                naive_applied += compensation.intersect_set(
+                    intervals, naive_remaining, remaining_order)
+                intervals = remaining_order
+            naive_remaining += pending
+            self.assertEqual(self.as_tuples(naive_remaining), self.as_tuples(remaining))
+            self.assertEqual(self.as_tuples(naive_applied), self.as_tuples(applied))
@@ -247,6 +247,7 @@ class UNIXUserDisk(ServiceMonitor):
 class Exim4Traffic(ServiceMonitor):
     """
     Exim4 mainlog parser for mails sent on the webserver by system users (e.g. via PHP <tt>mail()</tt>)
+    Only new log lines are read when <tt>RESOURCES_MONITOR_LOG_OFFSETS_DIR</tt> is set.
     """
     model = 'systemusers.SystemUser'
     resource = ServiceMonitor.TRAFFIC
@@ -263,6 +264,7 @@ class Exim4Traffic(ServiceMonitor):
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
             'mainlogs': str((mainlog, mainlog+'.1')),
         }
+        self.append(self.get_log_reader())
         self.append(textwrap.dedent("""\
             import re
             import sys
@@ -279,38 +281,41 @@ class Exim4Traffic(ServiceMonitor):
             # Use local timezone
             end_date = to_local_timezone('{current_date}')
             end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
+            if LogReader.offsets_dir:
+                # Lines read incrementally are accounted even if written after current_date
+                end_date = 99999999999999
             users = {{}}
             
             def prepare(object_id, username, ini_date):
                 global users
+                LogReader.last_dates[username] = ini_date
                 ini_date = to_local_timezone(ini_date)
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 users[username] = [ini_date, object_id, 0]
             
             def monitor(users, end_date, mainlogs):
                 user_regex = re.compile(r' U=([^ ]+) ')
-                for mainlog in mainlogs:
-                    try:
-                        with open(mainlog, 'r') as mainlog:
-                            for line in mainlog.readlines():
-                                if ' <= ' in line and 'P=local' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        sender = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        date, time, id, __, __, user, protocol, size = line.split()[:8]
-                                        date = date.replace('-', '')
-                                        date += time.replace(':', '')
-                                        if sender[0] < int(date) < end_date:
-                                            sender[2] += int(size[2:])
-                    except IOError as e:
-                        sys.stderr.write(e)
+                reader = LogReader(mainlogs)
+                for line in reader.readlines(users):
+                    if ' <= ' in line and 'P=local' in line:
+                        username = user_regex.search(line).groups()[0]
+                        try:
+                            sender = users[username]
+                        except KeyError:
+                            continue
+                        else:
+                            if not reader.is_new(username):
+                                continue
+                            date, time, id, __, __, user, protocol, size = line.split()[:8]
+                            date = date.replace('-', '')
+                            date += time.replace(':', '')
+                            if sender[0] < int(date) < end_date:
+                                sender[2] += int(size[2:])
                 
                 for username, opts in users.iteritems():
                     __, object_id, size = opts
                     print object_id, size
+                reader.save()
             """).format(**context)
         )
     
@@ -333,6 +338,7 @@ class Exim4Traffic(ServiceMonitor):
 class VsFTPdTraffic(ServiceMonitor):
     """
     vsFTPd log parser.
+    Only new log lines are read when <tt>RESOURCES_MONITOR_LOG_OFFSETS_DIR</tt> is set.
     """
     model = 'systemusers.SystemUser'
     resource = ServiceMonitor.TRAFFIC
@@ -349,6 +355,7 @@ class VsFTPdTraffic(ServiceMonitor):
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
             'vsftplogs': str((vsftplog, vsftplog+'.1')),
         }
+        self.append(self.get_log_reader())
         self.append(textwrap.dedent("""\
             import re
             import sys
@@ -365,12 +372,16 @@ class VsFTPdTraffic(ServiceMonitor):
             # Use local timezone
             end_date = to_local_timezone('{current_date}')
             end_date = int(end_date.strftime('%Y%m%d%H%M%S'))
+            if LogReader.offsets_dir:
+                # Lines read incrementally are accounted even if written after current_date
+                end_date = 99999999999999
             users = {{}}
             months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
             months = dict((m, '%02d' % n) for n, m in enumerate(months, 1))
             
             def prepare(object_id, username, ini_date):
                 global users
+                LogReader.last_dates[username] = ini_date
                 ini_date = to_local_timezone(ini_date)
                 ini_date = int(ini_date.strftime('%Y%m%d%H%M%S'))
                 users[username] = [ini_date, object_id, 0]
@@ -378,28 +389,27 @@ class VsFTPdTraffic(ServiceMonitor):
             def monitor(users, end_date, months, vsftplogs):
                 user_regex = re.compile(r'\] \[([^ ]+)\] (OK|FAIL) ')
                 bytes_regex = re.compile(r', ([0-9]+) bytes, ')
-                for vsftplog in vsftplogs:
-                    try:
-                        with open(vsftplog, 'r') as vsftplog:
-                            for line in vsftplog.readlines():
-                                if ' bytes, ' in line:
-                                    username = user_regex.search(line).groups()[0]
-                                    try:
-                                        user = users[username]
-                                    except KeyError:
-                                        continue
-                                    else:
-                                        __, month, day, time, year = line.split()[:5]
-                                        date = year + months[month] + day + time.replace(':', '')
-                                        if user[0] < int(date) < end_date:
-                                            bytes = bytes_regex.search(line).groups()[0]
-                                            user[2] += int(bytes)
-                    except IOError as e:
-                        sys.stderr.write(e)
+                reader = LogReader(vsftplogs)
+                for line in reader.readlines(users):
+                    if ' bytes, ' in line:
+                        username = user_regex.search(line).groups()[0]
+                        try:
+                            user = users[username]
+                        except KeyError:
+                            continue
+                        else:
+                            if not reader.is_new(username):
+                                continue
+                            __, month, day, time, year = line.split()[:5]
+                            date = year + months[month] + day + time.replace(':', '')
+                            if user[0] < int(date) < end_date:
+                                bytes = bytes_regex.search(line).groups()[0]
+                                user[2] += int(bytes)
                 
                 for username, opts in users.items():
                     __, object_id, size = opts
                     print object_id, size
+                reader.save()
             """).format(**context)
         )
     
@@ -138,53 +138,15 @@ class PHPBackend(WebAppServiceMixin, ServiceController):
             self.append("rm -f %(wrapper_path)s" % context_copy)
             self.append("rm -f %(cmd_options_path)s" % context_copy)
     
-    def prepare(self):
-        super(PHPBackend, self).prepare()
-        # Coordinate apache restart with php backend in order not to overdo it
-        self.append(textwrap.dedent("""
-            backend="PHPBackend"
-            echo "$backend" >> /dev/shm/restart.apache2""")
-        )
-    
     def commit(self):
-        context = {
-            'reload_pool': settings.WEBAPPS_PHPFPM_RELOAD_POOL,
-        }
-        self.append(textwrap.dedent("""
-            # Apply changes if needed
-            if [[ $UPDATED_FPM -eq 1 ]]; then
-                %(reload_pool)s
-            fi
-            
-            # Coordinate Apache restart with other concurrent backends (e.g. Apache2Backend)
-            is_last=0
-            mv /dev/shm/restart.apache2 /dev/shm/restart.apache2.locked || {
-                sleep 0.2
-                mv /dev/shm/restart.apache2 /dev/shm/restart.apache2.locked
-            }
-            state="$(grep -v "$backend" /dev/shm/restart.apache2.locked)" || is_last=1
-            [[ $is_last -eq 0 ]] && {
-                echo "$state" | grep -v ' RESTART$' || is_last=1
-            }
-            if [[ $is_last -eq 1 ]]; then
-                if [[ $UPDATED_APACHE -eq 1 || "$state" =~ .*RESTART$ ]]; then
-                    if service apache2 status > /dev/null; then
-                        service apache2 reload
-                    else
-                        service apache2 start
-                    fi
-                fi
-                rm /dev/shm/restart.apache2.locked
+        """ reload PHP-FPM and Apache2 if needed """
+        self.reload('php-fpm', settings.WEBAPPS_PHPFPM_RELOAD_POOL, condition='$UPDATED_FPM -eq 1')
+        self.reload('apache2', textwrap.dedent("""\
+            if service apache2 status > /dev/null; then
+                service apache2 reload
             else
-                echo -n "$state" > /dev/shm/restart.apache2.locked
-                if [[ $UPDATED_APACHE -eq 1 ]]; then
-                    echo -e "Apache will be restarted by another backend:\\n${state}"
-                    echo "$backend RESTART" >> /dev/shm/restart.apache2.locked
-                fi
-                mv /dev/shm/restart.apache2.locked /dev/shm/restart.apache2
-            fi
-            # End of coordination
-            """) % context
+                service apache2 start
+            fi"""), condition='$UPDATED_APACHE -eq 1'
         )
         super(PHPBackend, self).commit()
     
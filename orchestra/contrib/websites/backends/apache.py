@@ -138,46 +138,14 @@ class Apache2Backend(ServiceController):
             """) % context
         )
     
-    def prepare(self):
-        super(Apache2Backend, self).prepare()
-        # Coordinate apache restart with php backend in order not to overdo it
-        self.append(textwrap.dedent("""
-            backend="Apache2Backend"
-            echo "$backend" >> /dev/shm/restart.apache2""")
-        )
-    
     def commit(self):
         """ reload Apache2 if necessary """
-        self.append(textwrap.dedent("""
-            # Coordinate Apache restart with other concurrent backends (e.g. PHPBackend)
-            is_last=0
-            mv /dev/shm/restart.apache2 /dev/shm/restart.apache2.locked || {
-                sleep 0.2
-                mv /dev/shm/restart.apache2 /dev/shm/restart.apache2.locked
-            }
-            state="$(grep -v "$backend" /dev/shm/restart.apache2.locked)" || is_last=1
-            [[ $is_last -eq 0 ]] && {
-                echo "$state" | grep -v ' RESTART$' || is_last=1
-            }
-            if [[ $is_last -eq 1 ]]; then
-                if [[ $UPDATED_APACHE -eq 1 || "$state" =~ .*RESTART$ ]]; then
-                    if service apache2 status > /dev/null; then
-                        service apache2 reload
-                    else
-                        service apache2 start
-                    fi
-                fi
-                rm /dev/shm/restart.apache2.locked
+        self.reload('apache2', textwrap.dedent("""\
+            if service apache2 status > /dev/null; then
+                service apache2 reload
             else
-                echo -n "$state" > /dev/shm/restart.apache2.locked
-                if [[ $UPDATED_APACHE -eq 1 ]]; then
-                    echo -e "Apache will be restarted by another backend:\\n${state}"
-                    echo "$backend RESTART" >> /dev/shm/restart.apache2.locked
-                fi
-                mv /dev/shm/restart.apache2.locked /dev/shm/restart.apache2
-            fi
-            # End of coordination
-            """)
+                service apache2 start
+            fi"""), condition='$UPDATED_APACHE -eq 1'
         )
         super(Apache2Backend, self).commit()
     
@@ -417,6 +385,7 @@ class Apache2Traffic(ServiceMonitor):
     """
     Parses apache logs,
     looking for the size of each request on the last word of the log line.
+    Only new log lines are read when <tt>RESOURCES_MONITOR_LOG_OFFSETS_DIR</tt> is set.
     """
     model = 'websites.Website'
     resource = ServiceMonitor.TRAFFIC
@@ -431,16 +400,22 @@ class Apache2Traffic(ServiceMonitor):
         ignore_hosts = '\\|'.join(settings.WEBSITES_TRAFFIC_IGNORE_HOSTS)
         context = {
             'current_date': self.current_date.strftime("%Y-%m-%d %H:%M:%S %Z"),
-            'ignore_hosts': '-v "%s"' % ignore_hosts if ignore_hosts else '',
+            'ignore_hosts': 'grep -v "%s"' % ignore_hosts if ignore_hosts else 'cat',
+            'incremental_logs': str(self.incremental_logs).lower(),
         }
+        self.append(self.get_log_reader(executable='bash'))
         self.append(textwrap.dedent("""\
             function monitor () {
                 OBJECT_ID=$1
                 INI_DATE=$(date "+%%Y%%m%%d%%H%%M%%S" -d "$2")
                 END_DATE=$(date '+%%Y%%m%%d%%H%%M%%S' -d '%(current_date)s')
+                if %(incremental_logs)s; then
+                    # Lines read incrementally are accounted even if written after current_date
+                    END_DATE=99999999999999
+                fi
                 LOG_FILE="$3"
                 {
-                    { grep %(ignore_hosts)s ${LOG_FILE} || echo -e '\\r'; } \\
+                    { read_new_lines "${LOG_FILE}" "$2" | %(ignore_hosts)s || echo -e '\\r'; } \\
                         | awk -v ini="${INI_DATE}" -v end="${END_DATE}" '
                             BEGIN {
                                 sum = 0
@@ -480,7 +455,7 @@ class Apache2Traffic(ServiceMonitor):
     
     def get_context(self, site):
         return {
-            'log_file': '%s{,.1}' % site.get_www_access_log_path(),
+            'log_file': site.get_www_access_log_path(),
             'last_date': self.get_last_date(site.pk).strftime("%Y-%m-%d %H:%M:%S %Z"),
             'object_id': site.pk,
         }
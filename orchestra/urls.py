@@ -20,6 +20,11 @@ urlpatterns = [
         'rest_framework.authtoken.views.obtain_auth_token',
         name='api-token-auth'
     ),
+    # Prometheus metrics, authenticated by token or address
+    url(r'^orchestration/metrics/$',
+        'orchestra.contrib.orchestration.views.metrics',
+        name='orchestration-metrics'
+    ),
     url(r'^media/(.+)/(.+)/(.+)/(.+)/(.+)$',
         'orchestra.views.serve_private_media',
         name='private-media'
@@ -60,3 +60,66 @@ class clone(object):
         db.connections[self.target].close()
         djsettings.DATABASES.pop(self.target)
         db.connections = self.old_connections
+
+
+def allocate_pks(model, num, using=None):
+    """
+    reserves num primary keys of model, None if the database does not support it
+    bulk_create() does not set the primary keys of the created objects
+    """
+    using = using or db.router.db_for_write(model)
+    connection = db.connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    opts = model._meta
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)",
+            (opts.db_table, opts.pk.column, num)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def bulk_update(objs, fields, using=None, batch_size=1000):
+    """
+    updates fields of objs with a single UPDATE ... FROM (VALUES ...) per batch,
+    one UPDATE per object on databases other than PostgreSQL
+    signals are not sent
+    """
+    if not objs:
+        return
+    model = objs[0]._meta.concrete_model
+    opts = model._meta
+    using = using or db.router.db_for_write(model)
+    connection = db.connections[using]
+    fields = [opts.get_field(name) for name in fields]
+    if connection.vendor != 'postgresql':
+        queryset = model._base_manager.using(using)
+        for obj in objs:
+            queryset.filter(pk=obj.pk).update(**{
+                field.attname: getattr(obj, field.attname) for field in fields
+            })
+        return
+    qn = connection.ops.quote_name
+    columns = [opts.pk] + fields
+    casts = []
+    for field in columns:
+        db_type = 'integer' if field is opts.pk else field.db_type(connection)
+        casts.append('%%s::%s' % db_type)
+    row = '(%s)' % ', '.join(casts)
+    sql = 'UPDATE {table} SET {sets} FROM (VALUES {rows}) AS v ({columns}) WHERE {table}.{pk} = v.{pk}'
+    with connection.cursor() as cursor:
+        for ix in range(0, len(objs), batch_size):
+            batch = objs[ix:ix+batch_size]
+            params = []
+            for obj in batch:
+                params.append(obj.pk)
+                for field in fields:
+                    params.append(field.get_db_prep_save(getattr(obj, field.attname), connection))
+            cursor.execute(sql.format(
+                table=qn(opts.db_table),
+                sets=', '.join('%s = v.%s' % (qn(f.column), qn(f.column)) for f in fields),
+                rows=', '.join([row]*len(batch)),
+                columns=', '.join(qn(f.column) for f in columns),
+                pk=qn(opts.pk.column),
+            ), params)
@@ -161,7 +161,7 @@ def sshrun(addr, command, *args, executable='bash', persist=False, **kwargs):
     if persist:
         options.extend((
             'ControlMaster=auto',
-            'ControlPersist=yes',
+            'ControlPersist=%s' % ('yes' if persist is True else persist),
             'ControlPath=' + settings.ORCHESTRA_SSH_CONTROL_PATH,
         ))
     options = ' -o '.join(options)